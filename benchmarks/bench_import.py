@@ -0,0 +1,51 @@
+'''
+Benchmark `import btlite` in fresh interpreters, as paid by each worker process of a sweep, and check that heavy optional
+dependencies (plotting, notebook display, hdf5, exchange calendars) are not loaded until they are used.
+
+    PYTHONPATH=. python benchmarks/bench_import.py [--repeat N] [--max-seconds S]
+
+Exits with an error if a heavy module is imported eagerly or the median import time exceeds max-seconds.
+'''
+import argparse
+import json
+import subprocess
+import sys
+import numpy as np
+
+HEAVY_MODULES = ['plotly', 'IPython', 'h5py', 'pandas_market_calendars', 'statsmodels']
+
+_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import btlite  # noqa
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'loaded': [m for m in %r if m in sys.modules]}))
+''' % HEAVY_MODULES
+
+
+def time_import(repeat: int) -> tuple[list[float], list[str]]:
+    '''Returns import time of each run and the heavy modules loaded by the import'''
+    seconds = []
+    loaded: set[str] = set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', _SCRIPT], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().split('\n')[-1])
+        seconds.append(result['seconds'])
+        loaded.update(result['loaded'])
+    return seconds, sorted(loaded)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=2.)
+    args = parser.parse_args()
+    seconds, loaded = time_import(args.repeat)
+    median = float(np.median(seconds))
+    print(f'import btlite: median: {median:.3f}s min: {min(seconds):.3f}s max: {max(seconds):.3f}s')
+    errors = []
+    if len(loaded): errors.append(f'heavy modules imported eagerly: {loaded}')
+    if median > args.max_seconds: errors.append(f'median import time: {median:.3f}s above: {args.max_seconds:.3f}s')
+    for error in errors:
+        print(f'REGRESSION: {error}')
+    if len(errors): sys.exit(1)
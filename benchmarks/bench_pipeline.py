@@ -0,0 +1,191 @@
+'''
+Benchmark the backtest pipeline on synthetic minute bars: Strategy.run, roundtrip_trades, get_daily_pnl,
+compute_return_metrics and an hdf5 round trip.  Reports throughput and peak memory per stage and writes them to a json file
+so results can be compared across commits.
+
+    PYTHONPATH=. python benchmarks/bench_pipeline.py [--symbols N] [--years Y] [--output bench_output.json]
+                                                     [--baseline previous.json] [--tolerance 0.2]
+
+With --baseline, exits with an error if any throughput is more than tolerance below the baseline.
+'''
+import argparse
+import sys
+import json
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+import tracemalloc
+import numpy as np
+import pandas as pd
+from typing import Any, Callable
+from btlite.bt_io import df_to_hdf5, hdf5_to_df
+from btlite.bt_types import Contract, Order, Trade, TimeInForce, set_fast_validation
+from btlite.metrics import compute_return_metrics
+from btlite.price_store import PriceStore
+from btlite.strategy import Strategy, roundtrip_trades
+
+
+class EntryRule:
+    '''Buy a fixed dollar amount of each flat symbol whose price is below its price at the previous entry time'''
+    def __init__(self, prices: PriceStore) -> None:
+        self.prices = prices
+        self.last_price = np.full(len(prices.symbols), np.nan)
+
+    def __call__(self, strategy: Strategy, timestamp: np.datetime64) -> list[Order]:
+        idx = self.prices.timestamp_index(timestamp)
+        prices = self.prices.prices[:, idx]
+        signal = prices < self.last_price
+        self.last_price = prices
+        orders = []
+        for symbol_id in np.flatnonzero(signal):
+            symbol = self.prices.symbols[symbol_id]
+            if strategy.get_position(symbol) != 0 or strategy.order_book.has_live(symbol): continue
+            orders.append(Order(order_id=f'enter_{symbol}_{timestamp}', contract=Contract.get_or_create(symbol), timestamp=timestamp,
+                                qty=np.floor(1e4 / prices[symbol_id]), reason_code='ENTER', time_in_force=TimeInForce.FOK))
+        return orders
+
+
+class ExitRule:
+    '''Flatten all positions'''
+    def __call__(self, strategy: Strategy, timestamp: np.datetime64) -> list[Order]:
+        return [Order(order_id=f'exit_{symbol}_{timestamp}', contract=Contract.get_or_create(symbol), timestamp=timestamp,
+                      qty=-qty, reason_code='EXIT', time_in_force=TimeInForce.GTC)
+                for symbol, qty in strategy.get_positions().items() if qty != 0 and not strategy.order_book.has_live(symbol)]
+
+
+class MarketSim:
+    '''Fill every ready order at the bar price'''
+    def __init__(self, prices: PriceStore) -> None:
+        self.prices = prices
+
+    def __call__(self, strategy: Strategy, timestamp: np.datetime64, orders: list[Order]) -> list[Trade]:
+        trades = []
+        for order in orders:
+            price = self.prices.get((order.contract.symbol, timestamp))
+            if price is None or not np.isfinite(price): continue
+            trades.append(Trade(order.contract, order, timestamp, order.remaining_qty, price,
+                                properties=SimpleNamespace(trade_id=order.order_id)))
+            order.fill()
+        return trades
+
+
+def make_strategy(num_symbols: int, years: float, seed: int = 0) -> tuple[Strategy, PriceStore]:
+    Contract.clear_cache()
+    strategy = Strategy(initial_cash=1e4 * num_symbols * 2)
+    strategy.log_orders = False
+    strategy.log_trades = False
+    start_date = np.datetime64('2020-01-02')
+    end_date = start_date + np.timedelta64(int(years * 365), 'D')
+    strategy.set_market_calendar(start_date, end_date)
+    timestamps = strategy.timestamps
+    rng = np.random.default_rng(seed)
+    rets = rng.normal(0, 0.0005, size=(num_symbols, len(timestamps)))
+    prices = PriceStore([f'S{i}' for i in range(num_symbols)], timestamps, 100. * np.exp(np.cumsum(rets, axis=1)))
+    minutes = (timestamps - timestamps.astype('M8[D]')).astype(int)
+    strategy.add_rule('entry', EntryRule(prices))
+    strategy.add_rule('exit', ExitRule())
+    strategy.enable_rule('entry', timestamps[(minutes % 30 == 0) & (minutes < 15 * 60)])
+    strategy.enable_rule('exit', timestamps[minutes == 15 * 60 + 50])
+    strategy.add_market_sim(MarketSim(prices))
+    return strategy, prices
+
+
+def run_pipeline(num_symbols: int, years: float, measure: Callable[[str, Callable[[], Any]], Any]) -> dict[str, Any]:
+    '''
+    Run each stage through measure(stage name, func) and return the number of items processed by each stage
+    '''
+    counts: dict[str, Any] = {}
+    strategy, prices = measure('setup', lambda: make_strategy(num_symbols, years))
+    counts['bars'] = len(strategy.timestamps)
+    counts['symbol_bars'] = len(strategy.timestamps) * num_symbols
+    measure('run', strategy.run)
+    counts['trades'] = len(strategy.trade_history)
+    rts = measure('roundtrip_trades', lambda: roundtrip_trades(strategy.trade_history))
+    counts['roundtrips'] = len(rts)
+    pnl = measure('get_daily_pnl', lambda: strategy.get_daily_pnl(prices))
+    counts['days'] = len(pnl)
+    dates = pnl.timestamp.values.astype('M8[D]')
+    rets = pnl.ret.fillna(0.).values
+    measure('compute_return_metrics', lambda: compute_return_metrics(dates, rets, strategy.calendar))
+    df = pd.DataFrame({'symbol': np.repeat(prices.symbols, len(prices.timestamps)),
+                       'timestamp': np.tile(prices.timestamps, len(prices.symbols)),
+                       'c': prices.prices.ravel()})
+    counts['hdf5_mb'] = sum(df[col].values.nbytes for col in ['timestamp', 'c']) / 1e6
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'bench.hdf5')
+        measure('hdf5_write', lambda: df_to_hdf5(df, filename, 'bars'))
+        measure('hdf5_read', lambda: hdf5_to_df(filename, 'bars'))
+    return counts
+
+
+def run(num_symbols: int, years: float, track_memory: bool = True) -> dict[str, Any]:
+    set_fast_validation(False)
+    seconds: dict[str, float] = {}
+
+    def timed(name: str, func: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = func()
+        seconds[name] = time.perf_counter() - start
+        return result
+
+    counts = run_pipeline(num_symbols, years, timed)
+
+    peak_mb: dict[str, float] = {}
+    if track_memory:
+        # separate pass since tracing slows down python code considerably
+        def traced(name: str, func: Callable[[], Any]) -> Any:
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            result = func()
+            peak_mb[name] = (tracemalloc.get_traced_memory()[1] - start) / 1e6
+            return result
+
+        tracemalloc.start()
+        run_pipeline(num_symbols, years, traced)
+        tracemalloc.stop()
+
+    throughput = {'run': {'bars_per_sec': counts['bars'] / seconds['run'],
+                          'symbol_bars_per_sec': counts['symbol_bars'] / seconds['run'],
+                          'trades_per_sec': counts['trades'] / seconds['run']},
+                  'roundtrip_trades': {'trades_per_sec': counts['trades'] / seconds['roundtrip_trades']},
+                  'get_daily_pnl': {'roundtrips_per_sec': counts['roundtrips'] / seconds['get_daily_pnl']},
+                  'compute_return_metrics': {'days_per_sec': counts['days'] / seconds['compute_return_metrics']},
+                  'hdf5_write': {'mb_per_sec': counts['hdf5_mb'] / seconds['hdf5_write']},
+                  'hdf5_read': {'mb_per_sec': counts['hdf5_mb'] / seconds['hdf5_read']}}
+    stages = {name: {'seconds': seconds[name], **throughput.get(name, {}), 'peak_mb': peak_mb.get(name)}
+              for name in seconds.keys()}
+    return {'config': {'symbols': num_symbols, 'years': years}, 'counts': counts, 'stages': stages}
+
+
+def find_regressions(results: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    '''Returns a message for each throughput that is more than tolerance below the baseline'''
+    regressions = []
+    for stage, stats in results['stages'].items():
+        for name, value in stats.items():
+            if not name.endswith('_per_sec'): continue
+            base_value = baseline['stages'].get(stage, {}).get(name)
+            if base_value and value < base_value * (1 - tolerance):
+                regressions.append(f'{stage} {name}: {value:,.1f} baseline: {base_value:,.1f}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbols', type=int, default=20)
+    parser.add_argument('--years', type=float, default=0.25)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory pass')
+    parser.add_argument('--baseline', help='json output of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    results = run(args.symbols, args.years, not args.no_memory)
+    print(pd.DataFrame(results['stages']).T.to_string(float_format='{:,.3f}'.format))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if len(regressions): sys.exit(1)
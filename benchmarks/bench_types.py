@@ -0,0 +1,60 @@
+'''
+Measure memory and construction throughput of Order and Trade objects.
+
+    PYTHONPATH=. python benchmarks/bench_types.py [--num N]
+'''
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import btlite.bt_types as bt_types
+from btlite.bt_types import Contract, Order, Trade
+
+
+def _bytes_per_object(create, num: int) -> float:
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    objects = [create(i) for i in range(num)]
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(objects) == num
+    return (end - start) / num
+
+
+def _objects_per_sec(create, num: int) -> float:
+    start = time.perf_counter()
+    for i in range(num):
+        create(i)
+    return num / (time.perf_counter() - start)
+
+
+def run(num: int) -> dict[str, float]:
+    Contract.clear_cache()
+    contract = Contract.create('IBM')
+    timestamp = np.datetime64('2024-01-02 09:30')
+    order = Order(order_id='1', contract=contract, timestamp=timestamp, qty=100)
+    price = np.float64(10.5)
+
+    def create_order(i: int) -> Order:
+        return Order(order_id='1', contract=contract, timestamp=timestamp, qty=100)
+
+    def create_trade(i: int) -> Trade:
+        return Trade(contract, order, timestamp, 100, price, 0., 1.)
+
+    results = {'order_bytes': _bytes_per_object(create_order, num),
+               'order_per_sec': _objects_per_sec(create_order, num),
+               'trade_bytes': _bytes_per_object(create_trade, num),
+               'trade_per_sec': _objects_per_sec(create_trade, num)}
+    if hasattr(bt_types, 'set_fast_validation'):
+        bt_types.set_fast_validation(True)
+        results['trade_per_sec_fast'] = _objects_per_sec(create_trade, num)
+        bt_types.set_fast_validation(False)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num', type=int, default=200_000)
+    args = parser.parse_args()
+    for name, value in run(args.num).items():
+        print(f'{name}: {value:,.0f}')
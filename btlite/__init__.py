@@ -2,8 +2,18 @@
 from btlite.bt_types import *
 from btlite.bt_utils import *
 from btlite.bt_io import *
+from btlite.price_store import *
 from btlite.holiday_calendars import *
+from btlite.order_book import *
+from btlite.trade_log import *
+from btlite.roundtrips import *
+from btlite.pnl import *
+from btlite.baskets import *
+from btlite.rolling_metrics import *
+from btlite.profiler import *
+from btlite.checkpoint import *
 from btlite.strategy import *
+from btlite.sweep import *
 
 
 
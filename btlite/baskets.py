@@ -0,0 +1,103 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import numpy as np
+from btlite.bt_types import ContractRegistry
+from btlite.bt_utils import assert_
+from btlite.price_store import PriceStore
+
+
+class BasketMatrix:
+    '''
+    Weights of basket contracts, i.e. contracts with components, as a baskets x contracts matrix indexed by registry id,
+    so baskets can be priced, exploded into components and valued with one matrix product over all bars.
+
+    One unit of a basket holds weight units of each component, so the basket price is the value of its components
+    divided by its multiplier, sum(weight * price * component multiplier) / basket multiplier.
+    Components must themselves not be baskets.
+
+    >>> registry = ContractRegistry()
+    >>> aapl, ibm = registry.create('AAPL'), registry.create('IBM')
+    >>> basket = registry.create('TECH', components=[(aapl, 2.), (ibm, 1.)])
+    >>> baskets = BasketMatrix(registry)
+    >>> prices = np.array([[10., 11.], [100., np.nan], [np.nan, np.nan]])  # contracts x bars
+    >>> assert np.array_equal(baskets.prices(prices), [[120., np.nan]], equal_nan=True)
+    >>> prices[1, 1] = 99.
+    >>> assert np.array_equal(baskets.explode(np.array([5., 0., 3.])), [11., 3., 0.])
+    >>> assert np.array_equal(baskets.basket_pnl(np.array([[3., 3.]]), prices), [[0., 3.]])
+    '''
+    def __init__(self, registry: ContractRegistry) -> None:
+        self.registry = registry
+        self.basket_ids = np.array([i for i, contract in enumerate(registry) if contract.is_basket()], dtype=np.int64)
+        self.weights = np.zeros((len(self.basket_ids), len(registry)))  # units of each component per unit of basket
+        for row, basket_id in enumerate(self.basket_ids):
+            basket = registry[basket_id]
+            for component, weight in basket.components:
+                component_id = registry.id_of(component.symbol)
+                assert_(component_id != -1, f'component: {component.symbol} of basket: {basket.symbol} is not in the registry')
+                assert_(not component.is_basket(), f'nested basket: {component.symbol} in basket: {basket.symbol}')
+                self.weights[row, component_id] += weight
+        multipliers = registry.multipliers()
+        self.basket_multipliers = multipliers[self.basket_ids]
+        self._price_weights = self.weights * multipliers[np.newaxis, :] / self.basket_multipliers[:, np.newaxis]
+
+    def prices(self, prices: np.ndarray) -> np.ndarray:
+        '''
+        Basket prices from contract prices.
+        Args:
+            prices: contracts x bars matrix, or a vector with one price per contract, in registry id order.
+                Basket rows are ignored
+        Return:
+            baskets x bars matrix, or a vector with one price per basket.  NaN if any component price is NaN
+        '''
+        is_missing = np.isnan(prices)
+        basket_prices = self._price_weights @ np.where(is_missing, 0., prices)
+        # only NaNs of a basket's own components make its price NaN
+        basket_prices[(self.weights != 0).astype(np.float64) @ is_missing > 0] = np.nan
+        return basket_prices
+
+    def fill_prices(self, prices: np.ndarray) -> np.ndarray:
+        '''Copy of a contracts x bars price matrix with basket rows replaced by basket prices'''
+        prices = prices.copy()
+        prices[self.basket_ids] = self.prices(prices)
+        return prices
+
+    def price_store(self, prices: PriceStore) -> PriceStore:
+        '''
+        A PriceStore with rows in registry id order and basket prices filled in, so baskets can be marked and traded
+        anywhere a price source is accepted
+        '''
+        store = prices.align(self.registry.symbols)
+        return PriceStore(store.symbols, store.timestamps, self.fill_prices(store.prices))
+
+    def explode(self, positions: np.ndarray) -> np.ndarray:
+        '''
+        Replace basket positions by the component positions they hold.
+        Args:
+            positions: one position per contract, or a contracts x bars matrix, in registry id order
+        '''
+        component_positions = positions.astype(np.float64)
+        component_positions[self.basket_ids] = 0.
+        component_positions += self.weights.T @ positions[self.basket_ids]
+        return component_positions
+
+    def basket_pnl(self, basket_positions: np.ndarray, prices: np.ndarray) -> np.ndarray:
+        '''
+        Pnl of each basket on each bar from the change in basket price since the previous bar
+        Args:
+            basket_positions: baskets x bars matrix of positions held at the end of each bar
+            prices: contracts x bars matrix of prices in registry id order
+        Return:
+            baskets x bars matrix, 0 on the first bar
+        '''
+        basket_prices = self.prices(prices)
+        pnl = np.zeros(basket_positions.shape)
+        pnl[:, 1:] = basket_positions[:, :-1] * np.diff(basket_prices, axis=1) * self.basket_multipliers[:, np.newaxis]
+        return pnl
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -2,7 +2,6 @@
 # $$_code
 # $$_ %%checkall
 from __future__ import annotations
-import h5py
 import string
 import os
 import numpy as np
@@ -41,6 +40,7 @@ def np_arrays_to_hdf5(data: dict[str, np.ndarray],
     if as_utf8 is None:
         as_utf8 = []
     
+    import h5py
     with h5py.File(filename, 'a') as f:
         if tmp_key in f: del f[tmp_key]
         grp = f.create_group(tmp_key)
@@ -88,6 +88,7 @@ def hdf5_to_np_arrays(filename: str, key: str) -> dict[str, np.ndarray]:
         a list of numpy arrays along with their names
         '''
     ret: dict[str, np.ndarray] = {}
+    import h5py
     with h5py.File(filename, 'r') as f:
         if key not in f:
             _logger.info(f'{key} not found in {filename}')
@@ -144,6 +145,7 @@ def hdf5_repack(in_filename: str, out_filename: str) -> None:
     Serves the same purpose as the h5repack command line tool, i.e. 
     discards empty space in the input file so the output file may be smaller
     '''
+    import h5py
     with h5py.File(in_filename, 'r') as inf:
         num_items = len(list(inf.keys()))
         with h5py.File(out_filename + '.tmp', 'w') as outf:
@@ -160,6 +162,7 @@ def hdf5_copy(in_filename: str, in_key: str, out_filename: str, out_key: str | N
     Args:
         skip_if_exists: if set, we will skip any groups in the output that already exist.
         Otherwise we replace them.
+    >>> import h5py
     >>> tempdir = get_temp_dir()
     >>> in_filename = tempdir + '/temp_in.hdf5'
     >>> out_filename = tempdir + '/temp_out.hdf5'
@@ -181,6 +184,7 @@ def hdf5_copy(in_filename: str, in_key: str, out_filename: str, out_key: str | N
     
     '''
     if out_key is None: out_key = in_key
+    import h5py
     with h5py.File(in_filename, 'r') as inf:
         assert_(in_key in inf, f'could not find {in_key} in {in_filename}')
         with h5py.File(out_filename, 'a') as outf:
@@ -9,12 +9,23 @@ import math
 import datetime
 from dataclasses import dataclass, field
 from types import SimpleNamespace
-from typing import ClassVar
+from typing import Any, ClassVar, Iterator
 from enum import Enum
 from btlite.bt_utils import assert_, get_child_logger
 
 _logger = get_child_logger(__name__)
 
+_fast_validation = False
+
+
+def set_fast_validation(fast: bool) -> None:
+    '''
+    If set, we skip per object checks such as checking that trade prices are finite when creating
+    orders and trades.  Use for large backtests once a strategy has been debugged
+    '''
+    global _fast_validation
+    _fast_validation = fast
+
 
 def _format(obj: SimpleNamespace | None) -> str:
     if obj is None: return ''
@@ -24,7 +35,7 @@ def _format(obj: SimpleNamespace | None) -> str:
 
 @dataclass
 class Contract:
-    _instances: ClassVar[dict[str, Contract]] = {}
+    registry: ClassVar[ContractRegistry]  # default registry used by the static methods below
     symbol: str
     expiry: np.datetime64 | None
     multiplier: float
@@ -39,6 +50,7 @@ class Contract:
                components: list[tuple[Contract, float]] | None = None,
                properties: SimpleNamespace | None = None) -> 'Contract':
         '''
+        Create a contract in the default registry.  See ContractRegistry.create
         Args:
             symbol: A unique string reprenting this contract. e.g IBM or ESH9
             expiry: In the case of a future or option, the date and time when the 
@@ -49,28 +61,21 @@ class Contract:
             properties: Any data you want to store with this contract.
                 For example, you may want to store option strike.  Default None
         '''
-        assert_(isinstance(symbol, str) and len(symbol) > 0)
-        assert_(symbol not in Contract._instances, f'Contract with symbol: {symbol} already exists')
-        assert_(multiplier > 0)
-        if components is None: components = []
-        if properties is None: properties = types.SimpleNamespace()
-        contract = Contract(symbol, expiry, multiplier, components, properties)
-        Contract._instances[symbol] = contract
-        return contract
+        return Contract.registry.create(symbol, expiry, multiplier, components, properties)
     
     def is_basket(self) -> bool:
         return len(self.components) > 0
     
     @staticmethod
     def exists(name) -> bool:
-        return name in Contract._instances
+        return Contract.registry.exists(name)
     
     @staticmethod
     def get(name) -> Contract | None:
         '''
         Returns an existing contrat or none if it does not exist
         '''
-        return Contract._instances.get(name)
+        return Contract.registry.get(name)
     
     @staticmethod
     def get_or_create(symbol: str, 
@@ -78,23 +83,127 @@ class Contract:
                       multiplier: float = 1., 
                       components: list[tuple[Contract, float]] | None = None,
                       properties: SimpleNamespace | None = None) -> Contract:
-        if symbol in Contract._instances:
-            contract = Contract._instances.get(symbol)
-        else:
-            contract = Contract.create(symbol, expiry, multiplier, components, properties)
-        return contract  # type: ignore
+        return Contract.registry.get_or_create(symbol, expiry, multiplier, components, properties)
     
     @staticmethod
     def clear_cache() -> None:
         '''
-        Remove our cache of contract groups
+        Remove all contracts from the default registry
         '''
-        Contract._instances = dict()
+        Contract.registry.clear()
         
     def __repr__(self) -> str:
         return f'{self.symbol}' + (f' {self.multiplier}' if self.multiplier != 1 else '') + (
             f' expiry: {self.expiry.astype(datetime.datetime):%Y-%m-%d %H:%M:%S}' if self.expiry is not None else '') + (
             f' {_format(self.properties)}')
+
+
+class ContractRegistry:
+    '''
+    Contracts keyed by symbol, each with a dense integer id assigned in order of creation, so prices, positions and
+    other per contract data can be stored in arrays indexed by id instead of dicts keyed by symbol.
+    Contract.create and friends use a process wide default registry, Contract.registry.  Give a strategy its own registry
+    to keep contracts of strategies running in the same process separate.
+    Pickling only stores the contracts, ids are rebuilt when unpickling.
+
+    >>> registry = ContractRegistry()
+    >>> ibm = registry.create('IBM')
+    >>> es = registry.get_or_create('ESH9', multiplier=50)
+    >>> assert registry.id_of('ESH9') == 1 and registry[1] is es and registry.id_of('AAPL') == -1
+    >>> assert list(registry.ids(['ESH9', 'IBM'])) == [1, 0] and list(registry.multipliers()) == [1., 50.]
+    >>> import pickle
+    >>> copy = pickle.loads(pickle.dumps(registry))
+    >>> assert copy.symbols == ['IBM', 'ESH9'] and copy.id_of('ESH9') == 1
+    '''
+    def __init__(self, contracts: list[Contract] | None = None) -> None:
+        self._contracts: list[Contract] = []
+        self._ids: dict[str, int] = {}
+        if contracts is not None:
+            for contract in contracts: self.add(contract)
+
+    def add(self, contract: Contract) -> int:
+        '''Add an existing contract object and return its id'''
+        assert_(contract.symbol not in self._ids, f'Contract with symbol: {contract.symbol} already exists')
+        contract_id = len(self._contracts)
+        self._ids[contract.symbol] = contract_id
+        self._contracts.append(contract)
+        return contract_id
+
+    def create(self,
+               symbol: str, 
+               expiry: np.datetime64 | None = None, 
+               multiplier: float = 1., 
+               components: list[tuple[Contract, float]] | None = None,
+               properties: SimpleNamespace | None = None) -> Contract:
+        '''See Contract.create'''
+        assert_(isinstance(symbol, str) and len(symbol) > 0)
+        assert_(symbol not in self._ids, f'Contract with symbol: {symbol} already exists')
+        assert_(multiplier > 0)
+        if components is None: components = []
+        if properties is None: properties = types.SimpleNamespace()
+        contract = Contract(symbol, expiry, multiplier, components, properties)
+        self.add(contract)
+        return contract
+
+    def get_or_create(self,
+                      symbol: str, 
+                      expiry: np.datetime64 | None = None, 
+                      multiplier: float = 1., 
+                      components: list[tuple[Contract, float]] | None = None,
+                      properties: SimpleNamespace | None = None) -> Contract:
+        contract_id = self._ids.get(symbol)
+        if contract_id is not None: return self._contracts[contract_id]
+        return self.create(symbol, expiry, multiplier, components, properties)
+
+    def get(self, symbol: str) -> Contract | None:
+        contract_id = self._ids.get(symbol)
+        return None if contract_id is None else self._contracts[contract_id]
+
+    def exists(self, symbol: str) -> bool:
+        return symbol in self._ids
+
+    def id_of(self, symbol: str) -> int:
+        '''Id of a contract or -1 if it does not exist'''
+        return self._ids.get(symbol, -1)
+
+    def ids(self, symbols: list[str] | np.ndarray) -> np.ndarray:
+        '''Ids of a sequence of symbols, -1 for ones that don't exist'''
+        return np.array([self._ids.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+
+    @property
+    def symbols(self) -> list[str]:
+        '''Symbols in id order'''
+        return [contract.symbol for contract in self._contracts]
+
+    def multipliers(self) -> np.ndarray:
+        '''Contract multipliers in id order'''
+        return np.array([contract.multiplier for contract in self._contracts], dtype=np.float64)
+
+    def clear(self) -> None:
+        self._contracts.clear()
+        self._ids.clear()
+
+    def __getitem__(self, contract_id: int) -> Contract:
+        return self._contracts[contract_id]
+
+    def __len__(self) -> int:
+        return len(self._contracts)
+
+    def __iter__(self) -> Iterator[Contract]:
+        return iter(self._contracts)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._ids
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {'contracts': self._contracts}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self._contracts = state['contracts']
+        self._ids = {contract.symbol: i for i, contract in enumerate(self._contracts)}
+
+
+Contract.registry = ContractRegistry()
     
 
 class OrderStatus(Enum):
@@ -119,46 +228,65 @@ class ModificationType(Enum):
     CANCEL = 2
 
 
-@dataclass
+@dataclass(slots=True)
 class ModRequest:
     modification_type: ModificationType
     request_time: np.datetime64
-    qty: int = 0
+    qty: float = 0
     limit_price: float = np.nan
 
 
-@dataclass(kw_only=True)
 class Order:
-    '''
-    Args:
-        contract: The contract this order is for
-        timestamp: Time the order was placed
-        qty:  Number of contracts or shares.  Use a negative quantity for sell orders
-        limit_price: Limit price for the order
-        reason_code: The reason this order was created. Default ''
-        properties: Any order specific data we want to store.  Default None
-        status: Status of the order, "open", "filled", etc. Default "open"
-    '''
-    order_id: str
-    contract: Contract
-    timestamp: np.datetime64 = np.datetime64()
-    qty: int = 0
-    remaining_qty: int = 0
-    limit_price: float = math.nan
-    reason_code: str = ''
-    time_in_force: TimeInForce = TimeInForce.FOK
-    properties: SimpleNamespace = field(default_factory=SimpleNamespace)
-    status: OrderStatus = OrderStatus.NEW
-    pending_mod: ModRequest | None = None
-
-    def __post_init__(self) -> None:
-        self.pending_mod = ModRequest(ModificationType.OPEN, self.timestamp)
-        self.remaining_qty = self.qty
+    __slots__ = ('order_id', 'contract', 'timestamp', 'qty', 'remaining_qty', 'limit_price', 'reason_code',
+                 'time_in_force', '_properties', 'status', 'pending_mod')
+
+    def __init__(self, *,
+                 order_id: str,
+                 contract: Contract,
+                 timestamp: np.datetime64 = np.datetime64(),
+                 qty: float = 0,
+                 remaining_qty: float = 0,
+                 limit_price: float = math.nan,
+                 reason_code: str = '',
+                 time_in_force: TimeInForce = TimeInForce.FOK,
+                 properties: SimpleNamespace | None = None,
+                 status: OrderStatus = OrderStatus.NEW,
+                 pending_mod: ModRequest | None = None) -> None:
+        '''
+        Args:
+            contract: The contract this order is for
+            timestamp: Time the order was placed
+            qty:  Number of contracts or shares.  Use a negative quantity for sell orders
+            limit_price: Limit price for the order
+            reason_code: The reason this order was created. Default ''
+            properties: Any order specific data we want to store.  Created on first access if not set.  Default None
+            status: Status of the order, "open", "filled", etc. Default "open"
+        '''
+        self.order_id = order_id
+        self.contract = contract
+        self.timestamp = timestamp
+        self.qty = qty
+        self.remaining_qty = qty
+        self.limit_price = limit_price
+        self.reason_code = reason_code
+        self.time_in_force = time_in_force
+        self._properties = properties
+        self.status = status
+        self.pending_mod: ModRequest | None = ModRequest(ModificationType.OPEN, timestamp)
+
+    @property
+    def properties(self) -> SimpleNamespace:
+        if self._properties is None: self._properties = SimpleNamespace()
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties: SimpleNamespace) -> None:
+        self._properties = properties
         
     def request_modification(self, mod_request: ModRequest) -> None:
         self.pending_mod = mod_request
         
-    def fill(self, fill_qty: int = 0) -> None:
+    def fill(self, fill_qty: float = 0) -> None:
         assert_(self.status in [OrderStatus.OPEN, OrderStatus.PARTIALLY_FILLED], 
                 f'cannot fill an order in status: {self.status}')
         if fill_qty == 0: fill_qty = self.remaining_qty
@@ -176,16 +304,18 @@ class Order:
                f' status: {self.status.name} tif: {self.time_in_force.name}')
         if self.pending_mod is not None:
             msg += f' pending_mod: {self.pending_mod.modification_type.name}'
-        if len(self.properties.__dict__):
-            msg += f' props: {self.properties}'
+        if self._properties is not None and len(self._properties.__dict__):
+            msg += f' props: {self._properties}'
         return msg
             
 
 class Trade:
+    __slots__ = ('contract', 'order', 'timestamp', 'qty', 'price', 'fee', 'commission', '_properties')
+
     def __init__(self, contract: Contract,
                  order: Order,
                  timestamp: np.datetime64, 
-                 qty: int, 
+                 qty: float, 
                  price: float, 
                  fee: float = 0., 
                  commission: float = 0., 
@@ -200,15 +330,12 @@ class Trade:
             fee: Fees paid to brokers or others. Default 0
             commision: Commission paid to brokers or others. Default 0
             properties: Any data you want to store with this contract.
-                For example, you may want to store bid / ask prices at time of trade.  Default None
+                For example, you may want to store bid / ask prices at time of trade.  Created on first access if not set.
+                Default None
         '''
-        # assert(isinstance(contract, Contract))
-        # assert(isinstance(order, Order))
-        assert_(np.isfinite(qty))
-        assert_(np.isfinite(price))
-        assert_(np.isfinite(fee))
-        assert_(np.isfinite(commission))
-        # assert(isinstance(timestamp, np.datetime64))
+        if not _fast_validation:
+            assert_(math.isfinite(qty) and math.isfinite(price) and math.isfinite(fee) and math.isfinite(commission),
+                    f'invalid trade qty: {qty} price: {price} fee: {fee} commission: {commission}')
         
         self.contract = contract
         self.order = order
@@ -217,10 +344,16 @@ class Trade:
         self.price = price
         self.fee = fee
         self.commission = commission
-        
-        if properties is None:
-            properties = types.SimpleNamespace()
-        self.properties = properties
+        self._properties = properties
+
+    @property
+    def properties(self) -> SimpleNamespace:
+        if self._properties is None: self._properties = SimpleNamespace()
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties: SimpleNamespace) -> None:
+        self._properties = properties
         
     def __repr__(self) -> str:
         '''
@@ -234,7 +367,7 @@ class Trade:
         fee = f'fee: {self.fee:.6g}' if self.fee else ''
         commission = f'commission: {self.commission:.6g}' if self.commission else ''
         return (f'{self.contract.symbol} {_format(self.contract.properties)} {timestamp:%Y-%m-%d %H:%M:%S}'
-                f' qty: {self.qty} prc: {self.price:.6g} {fee} {commission} order: {self.order} {_format(self.properties)}')
+                f' qty: {self.qty} prc: {self.price:.6g} {fee} {commission} order: {self.order} {_format(self._properties)}')
     
 
 @dataclass
@@ -244,7 +377,7 @@ class RoundTripTrade:
     exit_order: Order | None
     entry_timestamp: np.datetime64
     exit_timestamp: np.datetime64
-    qty: int
+    qty: float
     entry_price: float
     exit_price: float
     entry_reason: str | None
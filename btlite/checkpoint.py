@@ -0,0 +1,179 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import copy
+import os
+import pickle
+from typing import Any, BinaryIO
+from btlite.bt_types import Contract, ContractRegistry, Order
+from btlite.bt_utils import assert_, get_child_logger
+from btlite.roundtrips import RoundTripTracker
+from btlite.trade_log import TradeLog
+
+_logger = get_child_logger(__name__)
+
+STATE_FILENAME = 'state.pkl'
+HISTORY_FILENAME = 'history.bin'
+_EMPTY_HEADER = {'num_trades': 0, 'num_trade_orders': 0, 'num_filled': 0, 'num_cancelled': 0, 'history_size': 0,
+                 'default_registry': True}
+_REGISTRY_PID = ('registry',)
+_ORDER_PID = 'order'
+
+
+class _Pickler(pickle.Pickler):
+    '''
+    Store contracts by symbol so they are not repeated in every chunk, and the strategy's registry as a reference.
+    Orders already written to the history, i.e. with an index in the trade log below num_orders, are stored as their
+    index and current state, so the order that is loaded stays the same object as the trade log's copy
+    '''
+    def __init__(self, f: BinaryIO, registry: ContractRegistry, trade_log: TradeLog | None = None, num_orders: int = 0) -> None:
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.registry = registry
+        self.trade_log = trade_log
+        self.num_orders = num_orders
+
+    def persistent_id(self, obj: Any) -> Any:
+        if isinstance(obj, Contract): return obj.symbol
+        if obj is self.registry: return _REGISTRY_PID
+        if isinstance(obj, Order) and self.trade_log is not None:
+            order_idx = self.trade_log.order_index(obj)
+            if order_idx != -1 and order_idx < self.num_orders:
+                return (_ORDER_PID, order_idx, tuple(getattr(obj, name) for name in Order.__slots__))
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, f: BinaryIO, registry: ContractRegistry, orders: list[Order | None]) -> None:
+        '''
+        Args:
+            orders: orders of the trade log loaded so far.  Orders stored by index are updated to their saved state
+        '''
+        super().__init__(f)
+        self.registry = registry
+        self.orders = orders
+
+    def persistent_load(self, pid: Any) -> Any:
+        if pid == _REGISTRY_PID: return self.registry
+        if isinstance(pid, tuple) and pid[0] == _ORDER_PID:
+            _, order_idx, state = pid
+            order = self.orders[order_idx]
+            assert order is not None
+            for name, value in zip(Order.__slots__, state): setattr(order, name, value)
+            return order
+        contract = self.registry.get(pid)
+        assert_(contract is not None, f'unknown contract: {pid} in checkpoint')
+        return contract
+
+
+def _dump(obj: Any, f: BinaryIO, registry: ContractRegistry, trade_log: TradeLog | None = None, num_orders: int = 0) -> None:
+    _Pickler(f, registry, trade_log, num_orders).dump(obj)
+
+
+def _read_header(state_path: str) -> dict[str, int]:
+    if not os.path.exists(state_path): return dict(_EMPTY_HEADER)
+    with open(state_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_checkpoint(strategy: Any, dirname: str) -> None:
+    '''
+    Save the state of a strategy so a run can be resumed with load_checkpoint.
+
+    Trades, as arrays of trade log columns, and filled / cancelled orders are appended to a history file, 
+    only writing the ones added since the last checkpoint.
+    Everything else, i.e. account, live orders, rules, market sims, callbacks and the current bar is written to a state
+    file that is replaced atomically, so a crash while saving leaves the previous checkpoint usable.
+    Tracked roundtrips are not saved, they are rebuilt from the trades when loading.
+    Rules, market sims and callbacks must be picklable, i.e. not lambdas or local functions.
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    state_path = os.path.join(dirname, STATE_FILENAME)
+    history_path = os.path.join(dirname, HISTORY_FILENAME)
+    prev = _read_header(state_path)
+    book = strategy.order_book
+    trade_log = strategy.trade_history
+    registry = getattr(strategy, 'registry', Contract.registry)
+    assert_(prev['num_trades'] <= len(trade_log) and prev['num_filled'] <= len(book.filled_orders)
+            and prev['num_cancelled'] <= len(book.cancelled_orders), f'{dirname} contains a checkpoint from a different run')
+
+    mode = 'r+b' if os.path.exists(history_path) else 'wb'
+    with open(history_path, mode) as f:
+        # discard anything written after the last complete checkpoint
+        f.truncate(prev['history_size'])
+        f.seek(prev['history_size'])
+        _dump((trade_log.get_chunk(prev['num_trades'], prev['num_trade_orders']),
+               book.filled_orders[prev['num_filled']:],
+               book.cancelled_orders[prev['num_cancelled']:]), f, registry, trade_log, prev['num_trade_orders'])  # type: ignore
+        f.flush()
+        os.fsync(f.fileno())
+        history_size = f.tell()
+
+    header = {'num_trades': len(trade_log),
+              'num_trade_orders': len(trade_log.orders),
+              'num_filled': len(book.filled_orders),
+              'num_cancelled': len(book.cancelled_orders),
+              'history_size': history_size,
+              'default_registry': registry is Contract.registry}
+    book_state = copy.copy(book)
+    book_state.filled_orders = []
+    book_state.cancelled_orders = []
+    state = dict(strategy.__dict__)
+    state['trade_history'] = TradeLog()
+    state['order_book'] = book_state
+    if 'roundtrips' in state: state['roundtrips'] = RoundTripTracker()
+
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(list(registry), f, protocol=pickle.HIGHEST_PROTOCOL)
+        _dump(state, f, registry, trade_log, len(trade_log.orders))  # type: ignore
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, state_path)
+    _logger.info(f'saved checkpoint to {dirname} trades: {header["num_trades"]}')
+
+
+def load_checkpoint(dirname: str) -> dict[str, Any]:
+    '''
+    Load state saved by save_checkpoint.  If the strategy used the default contract registry, contracts that don't exist in
+    this process are added to it, otherwise the strategy gets a new registry with the saved contracts.
+    Return:
+        The attributes of the saved strategy
+    '''
+    state_path = os.path.join(dirname, STATE_FILENAME)
+    assert_(os.path.exists(state_path), f'no checkpoint found in {dirname}')
+    with open(state_path, 'rb') as f:
+        header = pickle.load(f)
+        contracts: list[Contract] = pickle.load(f)
+        if header.get('default_registry', True):
+            registry = Contract.registry
+            for contract in contracts:
+                if not registry.exists(contract.symbol): registry.add(contract)
+        else:
+            registry = ContractRegistry(contracts)
+        # load the history first so live orders that have trades are linked to the trade log's copies
+        trade_history = TradeLog()
+        filled_orders: list[Order] = []
+        cancelled_orders: list[Order] = []
+        with open(os.path.join(dirname, HISTORY_FILENAME), 'rb') as history_file:
+            while history_file.tell() < header['history_size']:
+                trades_chunk, chunk_filled, chunk_cancelled = _Unpickler(history_file, registry, trade_history.orders).load()
+                trade_history.append_chunk(trades_chunk)
+                filled_orders += chunk_filled
+                cancelled_orders += chunk_cancelled
+        state: dict[str, Any] = _Unpickler(f, registry, trade_history.orders).load()
+
+    book = state['order_book']
+    book.filled_orders = filled_orders
+    book.cancelled_orders = cancelled_orders
+    state['trade_history'] = trade_history
+    assert_(len(trade_history) == header['num_trades'], f'corrupt checkpoint history in {dirname}')
+    if 'roundtrips' in state: state['roundtrips'].update(trade_history)
+    return state
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
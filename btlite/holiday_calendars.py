@@ -8,7 +8,6 @@ from collections.abc import Iterable
 import datetime
 import calendar as cal
 import dateutil.relativedelta as rd
-import pandas_market_calendars as mcal
 from typing import Union
 from btlite.bt_utils import assert_
 
@@ -99,11 +98,17 @@ class Calendar:
             calendar_name (str): name of calendar as defined in the pandas_market_calendars package
         '''
         if calendar_name not in Calendar._bus_day_calendars:
+            import pandas_market_calendars as mcal  # slow to import, so only load when a new calendar is needed
             cal = mcal.get_calendar(calendar_name)
             holidays = cal.holidays()
             _holidays = np.array([hol for hol in holidays.holidays])
             Calendar._bus_day_calendars[calendar_name] = np.busdaycalendar(holidays=_holidays)
+        self.calendar_name = calendar_name
         self.bus_day_cal = Calendar._bus_day_calendars[calendar_name]
+
+    def __reduce__(self) -> tuple:
+        # numpy busdaycalendar objects can't be pickled so recreate from the name
+        return (Calendar, (self.calendar_name,))
         
     def is_trading_day(self, dates: DateTimeType) -> bool | np.ndarray:
         '''
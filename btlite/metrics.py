@@ -1,17 +1,18 @@
 # $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
 # $$_code
 # $$_ %%checkall
-import statsmodels.api as smapi
+from __future__ import annotations
 import math
+import os
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 import pandas as pd
-from typing import Any
+from typing import Any, TYPE_CHECKING
 import numpy as np
 import btlite as bt
-from IPython.display import display  # noqa
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 import datetime
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
 
 
 import warnings
@@ -39,6 +40,8 @@ class Metrics:
     mdd_dates_3yr: tuple[np.datetime64, np.datetime64]
     calmar: float
     annual_rets: pd.DataFrame
+    drawdowns: pd.DataFrame | None = None  # every drawdown episode, see drawdown_episodes
+    session_rets: pd.DataFrame | None = None  # per session returns of intraday metrics, see session_returns
 
     def to_df(self) -> pd.DataFrame:
         '''
@@ -74,22 +77,124 @@ def compute_k_ratio(equity: np.ndarray, periods_per_year: int) -> float:
     >>> equity = (1 + ret).cumprod()
     >>> assert(math.isclose(compute_k_ratio(equity, 252), 3.888, abs_tol=0.001))
     '''
-    equity = np.log(equity)
-    fit = smapi.OLS(endog=equity, exog=np.arange(len(equity)), hasconst=False).fit()
-    k_ratio = fit.params[0] * math.sqrt(periods_per_year) / (fit.bse[0] * len(equity))
-    return k_ratio
+    return float(compute_k_ratios(equity.reshape(1, -1), periods_per_year)[0])
+
+
+def compute_k_ratios(equity: np.ndarray, periods_per_year: int) -> np.ndarray:
+    '''
+    k-ratio of each row of a 2d equity array.  Uses the closed form of the regression of log equity on time without a constant,
+    i.e. slope = sum(t * y) / sum(t^2) and its standard error sqrt(sum(residual^2) / (n - 1) / sum(t^2))
+    '''
+    log_equity = np.log(equity)
+    num_periods = log_equity.shape[1]
+    t = np.arange(num_periods, dtype=np.float64)
+    sum_t2 = np.dot(t, t)
+    slope = log_equity @ t / sum_t2
+    residuals = log_equity - slope[:, np.newaxis] * t
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std_err = np.sqrt((residuals * residuals).sum(axis=1) / (num_periods - 1) / sum_t2)
+        return slope * math.sqrt(periods_per_year) / (std_err * num_periods)
 
 
 def compute_rolling_dd(equity: np.ndarray) -> np.ndarray:
     '''
-    Compute numpy array of rolling drawdown percentage
+    Compute numpy array of rolling drawdown percentage.  For a 2d array, drawdowns are computed along each row
     '''
-    s = pd.Series(equity)
-    rolling_max = s.expanding(min_periods=1).max()
-    dd = np.where(s >= rolling_max, 0.0, -(s - rolling_max) / rolling_max)
+    rolling_max = np.maximum.accumulate(equity, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dd = np.where(equity >= rolling_max, 0.0, -(equity - rolling_max) / rolling_max)
     return dd
 
 
+def _drawdown_episode_arrays(equity: np.ndarray) -> dict[str, np.ndarray]:
+    '''
+    Index arrays for drawdown episodes in one pass over equity.  An episode starts at a peak, i.e. a point at the running max,
+    and ends at the next point at or above that peak (recovery_idx), or -1 if equity has not recovered
+    '''
+    running_max = np.maximum.accumulate(equity)
+    at_peak = equity >= running_max
+    peak_idx = np.flatnonzero(at_peak)
+    if not len(peak_idx):
+        return {'peak_idx': peak_idx, 'trough_idx': peak_idx, 'recovery_idx': peak_idx, 'depth': np.empty(0)}
+    episode = np.cumsum(at_peak) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dd = (running_max - equity) / running_max
+    depth = np.maximum.reduceat(dd, peak_idx)
+    # first point of each episode where its max drawdown is reached
+    trough_points = np.flatnonzero((dd == depth[episode]) & (dd > 0))
+    trough_episodes, first = np.unique(episode[trough_points], return_index=True)
+    trough_idx = np.full(len(peak_idx), -1)
+    trough_idx[trough_episodes] = trough_points[first]
+    recovery_idx = np.append(peak_idx[1:], -1)
+    has_dd = depth > 0
+    return {'peak_idx': peak_idx[has_dd], 'trough_idx': trough_idx[has_dd], 'recovery_idx': recovery_idx[has_dd], 'depth': depth[has_dd]}
+
+
+def _drawdown_episodes_df(dates: np.ndarray, arrays: dict[str, np.ndarray]) -> pd.DataFrame:
+    recovered = arrays['recovery_idx'] >= 0
+    recovery_date = np.where(recovered, dates[arrays['recovery_idx']], np.datetime64('NaT'))
+    df = pd.DataFrame(arrays)
+    df['peak_date'] = dates[arrays['peak_idx']]
+    df['trough_date'] = dates[arrays['trough_idx']]
+    df['recovery_date'] = recovery_date
+    df['duration'] = df.recovery_date - df.peak_date
+    df['time_to_trough'] = df.trough_date - df.peak_date
+    df['time_to_recover'] = df.recovery_date - df.trough_date
+    return df
+
+
+def drawdown_episodes(dates: np.ndarray, equity: np.ndarray) -> pd.DataFrame:
+    '''
+    Every drawdown episode of an equity curve, computed in one O(n) pass.
+    Return:
+        dataframe with one row per episode in time order: peak_idx, trough_idx, recovery_idx (-1 if not recovered),
+        depth as a fraction of the peak, and the peak, trough and recovery dates, duration from peak to recovery,
+        time_to_trough and time_to_recover.  Recovery date and durations that depend on it are NaT if not recovered
+
+    >>> dates = np.arange(np.datetime64('2024-01-01'), np.datetime64('2024-01-09'))
+    >>> equity = np.array([1., 1.1, 0.99, 1.2, 1.2, 0.9, 1.08, 1.1])
+    >>> df = drawdown_episodes(dates, equity)
+    >>> df[['peak_date', 'trough_date', 'recovery_date', 'depth']]
+       peak_date trough_date recovery_date  depth
+    0 2024-01-02  2024-01-03    2024-01-04   0.10
+    1 2024-01-05  2024-01-06           NaT   0.25
+    >>> assert list(df.duration.dt.days.fillna(-1)) == [2, -1]
+    '''
+    bt.assert_(len(dates) == len(equity))
+    return _drawdown_episodes_df(dates, _drawdown_episode_arrays(equity))
+
+
+def window_drawdown_episodes(episodes: pd.DataFrame, dates: np.ndarray, equity: np.ndarray, start_idx: int) -> pd.DataFrame:
+    '''
+    Drawdown episodes of equity[start_idx:], i.e. with peaks measured from start_idx, from the episodes of the full curve.
+    Episodes that start in the window are reused as is, so only the episode in progress at start_idx is recomputed.
+    Indices are relative to the full curve
+
+    >>> dates = np.arange(np.datetime64('2024-01-01'), np.datetime64('2024-01-09'))
+    >>> equity = np.array([1., 1.1, 0.99, 1.2, 1.2, 0.9, 1.08, 1.1])
+    >>> episodes = drawdown_episodes(dates, equity)
+    >>> for start_idx in range(len(equity)):
+    ...     expected = drawdown_episodes(dates[start_idx:], equity[start_idx:])
+    ...     df = window_drawdown_episodes(episodes, dates, equity, start_idx)
+    ...     pd.testing.assert_frame_equal(df.drop(columns=['peak_idx', 'trough_idx', 'recovery_idx']),
+    ...                                   expected.drop(columns=['peak_idx', 'trough_idx', 'recovery_idx']))
+    '''
+    in_window = episodes.peak_idx.values >= start_idx
+    ongoing = ~in_window & ((episodes.recovery_idx.values > start_idx) | (episodes.recovery_idx.values == -1))
+    dfs = []
+    if ongoing.any():
+        recovery_idx = episodes.recovery_idx.values[ongoing][0]
+        end_idx = len(equity) if recovery_idx == -1 else recovery_idx + 1
+        # recovery_idx is at or above every earlier point in the window, so the segment's episodes all end by then
+        arrays = _drawdown_episode_arrays(equity[start_idx:end_idx])
+        for key in ['peak_idx', 'trough_idx']:
+            arrays[key] = arrays[key] + start_idx
+        arrays['recovery_idx'] = np.where(arrays['recovery_idx'] >= 0, arrays['recovery_idx'] + start_idx, -1)
+        dfs.append(_drawdown_episodes_df(dates, arrays))
+    dfs.append(episodes[in_window])
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0].reset_index(drop=True)
+
+
 def compute_gmean(rets: np.ndarray, periods_per_year: int) -> float:
     gmean_daily = (1 + rets).prod() ** (1 / len(rets)) - 1
     gmean_annual = (1 + gmean_daily) ** periods_per_year - 1
@@ -121,34 +226,35 @@ def compute_return_metrics(_dates: np.ndarray,
     _dates = _dates.astype('M8[D]')
     prev_date = calendar.add_trading_days(_dates[0], -1, 'allow')
     dates = np.concatenate([[prev_date], _dates])
-    amean = np.mean(rets) * TRADING_DAYS_PER_YEAR
-    std = np.std(rets) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    return _compute_metrics(dates, rets, TRADING_DAYS_PER_YEAR)
+
+
+def _compute_metrics(dates: np.ndarray, rets: np.ndarray, periods_per_year: int) -> Metrics:
+    '''
+    Metrics from returns at any frequency.  dates has one more element than rets, the time the first return starts from
+    '''
+    amean = np.mean(rets) * periods_per_year
+    std = np.std(rets) * np.sqrt(periods_per_year)
     up_days = len(rets[rets > 0])
     down_days = len(rets[rets < 0])
     up_pct = up_days / len(rets)
-    gmean = compute_gmean(rets, TRADING_DAYS_PER_YEAR)
+    gmean = compute_gmean(rets, periods_per_year)
     sharpe = np.nan if std == 0 else amean / std
     normalized_rets = np.where(rets > 0.0, 0.0, rets)
-    sortino_denom = np.std(normalized_rets) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    sortino_denom = np.std(normalized_rets) * np.sqrt(periods_per_year)
     sortino = np.nan if sortino_denom == 0 else amean / sortino_denom
     equity = np.concatenate([[1.], np.cumprod(1 + rets)])
-    k_ratio = compute_k_ratio(equity, TRADING_DAYS_PER_YEAR)
-    rolling_dd = compute_rolling_dd(equity)
-    mdd_pct = np.max(rolling_dd)
-    mdd_date = dates[np.argmax(rolling_dd)]
-    mdd_start = dates[(rolling_dd <= 0) & (dates <= mdd_date)][-1]
+    k_ratio = compute_k_ratio(equity, periods_per_year)
+    drawdowns = drawdown_episodes(dates, equity)
+    mdd_pct, mdd_start, mdd_date = _max_drawdown(drawdowns, dates[0])
     mar = math.nan if mdd_pct == 0 else amean / mdd_pct
-    start_3yr = dates[-1] - np.timedelta64(365 * 3, 'D')
-    dates_3yr = dates[dates >= start_3yr]
-    equity_3yr = equity[dates >= start_3yr]
-    rolling_dd_3yr = compute_rolling_dd(equity_3yr)
-    mdd_pct_3yr = np.max(rolling_dd_3yr)
-    mdd_date_3yr = dates_3yr[np.argmax(rolling_dd_3yr)]
-    mdd_start_3yr = dates_3yr[(rolling_dd_3yr <= 0) & (dates_3yr <= mdd_date_3yr)][-1]
+    start_3yr_idx = np.searchsorted(dates, dates[-1] - np.timedelta64(365 * 3, 'D'))
+    drawdowns_3yr = window_drawdown_episodes(drawdowns, dates, equity, start_3yr_idx)
+    mdd_pct_3yr, mdd_start_3yr, mdd_date_3yr = _max_drawdown(drawdowns_3yr, dates[start_3yr_idx])
     calmar = math.nan if mdd_pct_3yr == 0 else amean / mdd_pct_3yr
-    ret_df = pd.DataFrame({'date': _dates, 'ret': rets})
+    ret_df = pd.DataFrame({'date': dates[1:], 'ret': rets})
     ret_df['year'] = ret_df.date.dt.year
-    annual_rets = ret_df[['year', 'ret']].groupby('year', as_index=False).agg(lambda x: compute_gmean(x, TRADING_DAYS_PER_YEAR))
+    annual_rets = ret_df[['year', 'ret']].groupby('year', as_index=False).agg(lambda x: compute_gmean(x, periods_per_year))
     metrics = Metrics( 
         dates=dates,
         returns=rets,
@@ -168,14 +274,403 @@ def compute_return_metrics(_dates: np.ndarray,
         mdd_pct_3yr=mdd_pct_3yr,
         mdd_dates_3yr=(mdd_start_3yr, mdd_date_3yr),
         calmar=calmar,
-        annual_rets=annual_rets)
+        annual_rets=annual_rets,
+        drawdowns=drawdowns)
+    return metrics
+
+
+def _max_drawdown(drawdowns: pd.DataFrame, start_date: np.datetime64) -> tuple[float, np.datetime64, np.datetime64]:
+    '''Depth, peak and trough dates of the deepest episode, the first if several are equally deep'''
+    if not len(drawdowns): return 0., start_date, start_date
+    row = drawdowns.iloc[np.argmax(drawdowns.depth.values)]
+    return row.depth, row.peak_date.to_datetime64().astype(start_date.dtype), row.trough_date.to_datetime64().astype(start_date.dtype)
+
+
+def _bar_interval(timestamps: np.ndarray) -> np.timedelta64:
+    '''Median time between consecutive bars of the same day'''
+    diffs = np.diff(timestamps)
+    same_day = timestamps[1:].astype('M8[D]') == timestamps[:-1].astype('M8[D]')
+    bt.assert_(same_day.any(), 'need at least two bars on the same day to infer the bar frequency')
+    return np.median(diffs[same_day].astype(np.int64)).astype(np.int64).astype(diffs.dtype)
+
+
+def infer_periods_per_year(timestamps: np.ndarray, calendar: bt.Calendar, freq: str | None = None) -> int:
+    '''
+    Bars per year for annualizing intraday returns: trading days per year of the calendar, over the calendar years spanned
+    by timestamps, times bars per session.
+    Args:
+        freq: bar frequency, e.g. '5m' or '1h'.  Bars per session is then the median session length divided by freq,
+            otherwise the median number of bars per day
+
+    >>> timestamps = np.arange(np.datetime64('2024-01-02 09:30'), np.datetime64('2024-01-02 16:00'), np.timedelta64(5, 'm'))
+    >>> timestamps = np.concatenate([timestamps, timestamps + np.timedelta64(1, 'D')])
+    >>> infer_periods_per_year(timestamps, bt.Calendar('NYSE'))
+    19656
+    >>> infer_periods_per_year(timestamps[::2], bt.Calendar('NYSE'), '10m')
+    9828
+    '''
+    days, bars_per_day = np.unique(timestamps.astype('M8[D]'), return_counts=True)
+    if freq is None:
+        bars_per_session = np.median(bars_per_day)
+    else:
+        day_idx = np.concatenate([[0], np.cumsum(bars_per_day)])
+        session_length = timestamps[day_idx[1:] - 1] - timestamps[day_idx[:-1]]
+        bars_per_session = np.median(session_length / bt.parse_freq(freq)) + 1
+    first_year, last_year = days[[0, -1]].astype('M8[Y]')
+    trading_days = calendar.num_trading_days(first_year.astype('M8[D]'), (last_year + 1).astype('M8[D]'), include_first=True,
+                                             include_last=False)
+    num_years = (last_year - first_year).astype(int) + 1
+    return int(round(trading_days / num_years * bars_per_session))
+
+
+def session_returns(timestamps: np.ndarray, rets: np.ndarray, session_offset: np.timedelta64 = np.timedelta64(0, 'm')) -> pd.DataFrame:
+    '''
+    Aggregate bar returns by trading session
+    Args:
+        session_offset: added to timestamps before taking the date, e.g. np.timedelta64(6, 'h') for sessions that open
+            at 18:00 the previous day
+    Return:
+        dataframe with one row per session: date, ret (compounded), num_bars, up_bars, down_bars and std of bar returns
+
+    >>> timestamps = np.array(['2024-01-02 09:30', '2024-01-02 09:35', '2024-01-02 18:00', '2024-01-03 09:30'], dtype='M8[m]')
+    >>> rets = np.array([0.1, -0.1, 0.02, 0.03])
+    >>> session_returns(timestamps, rets).round({'ret': 4, 'std': 4})
+            date     ret  num_bars  up_bars  down_bars     std
+    0 2024-01-02  0.0098         3        2          1  0.0822
+    1 2024-01-03  0.0300         1        1          0  0.0000
+    >>> list(session_returns(timestamps, rets, np.timedelta64(6, 'h')).num_bars)
+    [2, 2]
+    '''
+    bt.assert_(len(timestamps) == len(rets))
+    dates = (timestamps + session_offset).astype('M8[D]')
+    starts = np.flatnonzero(np.concatenate([[True], dates[1:] != dates[:-1]]))
+    num_bars = np.diff(np.append(starts, len(rets)))
+    mean = np.add.reduceat(rets, starts) / num_bars
+    deviations = rets - np.repeat(mean, num_bars)
+    return pd.DataFrame({'date': dates[starts],
+                         'ret': np.exp(np.add.reduceat(np.log1p(rets), starts)) - 1,
+                         'num_bars': num_bars,
+                         'up_bars': np.add.reduceat((rets > 0).astype(np.int64), starts),
+                         'down_bars': np.add.reduceat((rets < 0).astype(np.int64), starts),
+                         'std': np.sqrt(np.add.reduceat(deviations * deviations, starts) / num_bars)})
+
+
+def time_of_day_returns(timestamps: np.ndarray, rets: np.ndarray) -> pd.DataFrame:
+    '''
+    Mean, std and count of bar returns by time of day across sessions, e.g. to see which part of the session drives returns
+
+    >>> timestamps = np.array(['2024-01-02 09:30', '2024-01-02 09:35', '2024-01-03 09:30', '2024-01-03 09:35'], dtype='M8[m]')
+    >>> time_of_day_returns(timestamps, np.array([0.01, 0.02, 0.03, -0.02]))
+          time_of_day  mean   std  count
+    0 0 days 09:30:00  0.02  0.01      2
+    1 0 days 09:35:00  0.00  0.02      2
+    '''
+    bt.assert_(len(timestamps) == len(rets))
+    time_of_day = timestamps - timestamps.astype('M8[D]')
+    times, idx, count = np.unique(time_of_day, return_inverse=True, return_counts=True)
+    mean = np.bincount(idx, weights=rets) / count
+    deviations = rets - mean[idx]
+    return pd.DataFrame({'time_of_day': pd.to_timedelta(times),
+                         'mean': mean,
+                         'std': np.sqrt(np.bincount(idx, weights=deviations * deviations) / count),
+                         'count': count})
+
+
+def compute_intraday_metrics(timestamps: np.ndarray,
+                             rets: np.ndarray,
+                             calendar: bt.Calendar,
+                             freq: str | None = None,
+                             periods_per_year: int | None = None,
+                             session_offset: np.timedelta64 = np.timedelta64(0, 'm')) -> Metrics:
+    '''
+    Metrics of compute_return_metrics computed on bar returns at their native frequency, e.g. 5 minute or hourly,
+    instead of daily returns.  Statistics are annualized with periods_per_year and drawdowns are measured bar by bar.
+    up_days and down_days count sessions, and session_rets holds the per session aggregation, see session_returns
+    Args:
+        freq: bar frequency, e.g. '5m'.  Inferred from timestamps if not set
+        periods_per_year: bars per year.  If not set, computed from the calendar and session length with infer_periods_per_year
+
+    >>> timestamps = np.arange(np.datetime64('2024-01-02 09:30'), np.datetime64('2024-01-02 16:00'), np.timedelta64(30, 'm'))
+    >>> timestamps = np.concatenate([timestamps + np.timedelta64(i, 'D') for i in range(3)])
+    >>> rets = np.tile([0.001, -0.0005], len(timestamps) // 2 + 1)[:len(timestamps)]
+    >>> metrics = compute_intraday_metrics(timestamps, rets, bt.Calendar('NYSE'), '30m')
+    >>> assert math.isclose(metrics.amean, rets.mean() * 252 * 13, rel_tol=1e-9)
+    >>> assert metrics.dates[0] == np.datetime64('2024-01-02 09:00') and (metrics.up_days, metrics.down_days) == (3, 0)
+    >>> assert math.isclose(metrics.mdd_pct, 0.0005)
+    '''
+    bt.assert_(len(timestamps) == len(rets))
+    bt.assert_(bool(np.all(np.diff(timestamps) > np.timedelta64(0))), 'timestamps must be monotonically increasing')
+    bt.assert_(np.all(rets > -1), f'found returns < -1: {rets[rets <= -1]}')  # type: ignore
+    if periods_per_year is None: periods_per_year = infer_periods_per_year(timestamps, calendar, freq)
+    interval = _bar_interval(timestamps) if freq is None else bt.parse_freq(freq)
+    dates = np.concatenate([[timestamps[0] - interval], timestamps])
+    metrics = _compute_metrics(dates, rets, periods_per_year)
+    sessions = session_returns(timestamps, rets, session_offset)
+    metrics.up_days = int((sessions.ret > 0).sum())
+    metrics.down_days = int((sessions.ret < 0).sum())
+    metrics.up_pct = metrics.up_days / len(sessions)
+    metrics.session_rets = sessions
     return metrics
 
 
-def plot_metrics(metrics: Metrics, starting_equity=1e6) -> go.Figure:
+def _mdd(dates: np.ndarray, equity: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Max drawdown, its start and its end date for each row of equity'''
+    rolling_dd = compute_rolling_dd(equity)
+    mdd_idx = np.argmax(rolling_dd, axis=1)
+    idx = np.arange(equity.shape[1])
+    start_idx = np.where((rolling_dd <= 0) & (idx <= mdd_idx[:, np.newaxis]), idx, -1).max(axis=1)
+    return rolling_dd.max(axis=1), dates[start_idx], dates[mdd_idx]
+
+
+def compute_return_metrics_batch(_dates: np.ndarray,
+                                 rets: np.ndarray,
+                                 calendar: bt.Calendar) -> pd.DataFrame:
+    '''
+    Compute the metrics of compute_return_metrics for many return series with the same dates at once, e.g. the runs
+    of a parameter sweep, using numpy along each row instead of one call per series.
+
+    Args:
+        _dates: dates of the returns
+        rets: series x dates array of daily returns
+    Returns:
+        A dataframe with one row per series.  Columns are the scalar fields of Metrics with mdd_dates and mdd_dates_3yr split
+        into start and end columns, followed by one column of annualized geometric mean return per calendar year
+
+    >>> dates = np.array(['2023-12-28', '2023-12-29', '2024-01-02', '2024-01-03', '2024-01-04'], dtype='M8[D]')
+    >>> rets = np.array([[0.01, -0.02, 0.03, -0.01, 0.02], [0.0, 0.01, -0.03, 0.02, 0.01]])
+    >>> calendar = bt.Calendar('NYSE')
+    >>> df = compute_return_metrics_batch(dates, rets, calendar)
+    >>> for i in range(2):
+    ...     metrics = compute_return_metrics(dates, rets[i], calendar)
+    ...     for col in ['gmean', 'amean', 'std', 'sharpe', 'sortino', 'k_ratio', 'mdd_pct', 'mar', 'calmar', 2023, 2024]:
+    ...         expected = metrics.annual_rets.set_index('year').ret[col] if isinstance(col, int) else getattr(metrics, col)
+    ...         assert math.isclose(df[col].iloc[i], expected, rel_tol=1e-9), col
+    ...     assert (df.mdd_start.iloc[i], df.mdd_end.iloc[i]) == metrics.mdd_dates
+    '''
+    TRADING_DAYS_PER_YEAR = 252
+    rets = np.atleast_2d(rets)
+    bt.assert_(len(_dates) == rets.shape[1])
+    bt.assert_(bool(np.all(np.diff(_dates) > np.timedelta64(0))), 'timestamps must be monotonically increasing')
+    bt.assert_(np.all(rets > -1), f'found returns < -1: {rets[rets <= -1]}')  # type: ignore
+    _dates = _dates.astype('M8[D]')
+    prev_date = calendar.add_trading_days(_dates[0], -1, 'allow')
+    dates = np.concatenate([[prev_date], _dates])
+    num_days = rets.shape[1]
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        amean = rets.mean(axis=1) * TRADING_DAYS_PER_YEAR
+        std = rets.std(axis=1) * np.sqrt(TRADING_DAYS_PER_YEAR)
+        up_days = (rets > 0).sum(axis=1)
+        down_days = (rets < 0).sum(axis=1)
+        gmean = np.prod(1 + rets, axis=1) ** (TRADING_DAYS_PER_YEAR / num_days) - 1
+        sharpe = np.where(std == 0, np.nan, amean / std)
+        sortino_denom = np.where(rets > 0.0, 0.0, rets).std(axis=1) * np.sqrt(TRADING_DAYS_PER_YEAR)
+        sortino = np.where(sortino_denom == 0, np.nan, amean / sortino_denom)
+        equity = np.concatenate([np.ones((rets.shape[0], 1)), np.cumprod(1 + rets, axis=1)], axis=1)
+        mdd_pct, mdd_start, mdd_end = _mdd(dates, equity)
+        in_3yr = dates >= dates[-1] - np.timedelta64(365 * 3, 'D')
+        mdd_pct_3yr, mdd_start_3yr, mdd_end_3yr = _mdd(dates[in_3yr], equity[:, in_3yr])
+        df = pd.DataFrame({'gmean': gmean,
+                           'amean': amean,
+                           'std': std,
+                           'sharpe': sharpe,
+                           'sortino': sortino,
+                           'k_ratio': compute_k_ratios(equity, TRADING_DAYS_PER_YEAR),
+                           'calmar': np.where(mdd_pct_3yr == 0, np.nan, amean / mdd_pct_3yr),
+                           'mar': np.where(mdd_pct == 0, np.nan, amean / mdd_pct),
+                           'up_days': up_days,
+                           'down_days': down_days,
+                           'up_pct': up_days / num_days,
+                           'mdd_pct': mdd_pct,
+                           'mdd_start': mdd_start,
+                           'mdd_end': mdd_end,
+                           'mdd_pct_3yr': mdd_pct_3yr,
+                           'mdd_start_3yr': mdd_start_3yr,
+                           'mdd_end_3yr': mdd_end_3yr})
+        years = _dates.astype('M8[Y]').astype(int) + 1970
+        for year in np.unique(years):
+            year_rets = rets[:, years == year]
+            df[int(year)] = np.prod(1 + year_rets, axis=1) ** (TRADING_DAYS_PER_YEAR / year_rets.shape[1]) - 1
+    return df
+
+
+BOOTSTRAP_METRICS = ['gmean', 'sharpe', 'sortino', 'mdd_pct', 'calmar']
+
+# Set in each worker process by _init_bootstrap_worker
+_worker_rets: np.ndarray | None = None
+
+
+def _bootstrap_path_metrics(rets: np.ndarray, periods_per_year: int) -> np.ndarray:
+    '''
+    BOOTSTRAP_METRICS for each row of a 2d array of returns, as a rows x metrics array.  Resampled paths have no dates, so
+    the 3 year drawdown for calmar is taken over the last 3 * periods_per_year returns
+    '''
+    num_periods = rets.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        amean = rets.mean(axis=1) * periods_per_year
+        std = rets.std(axis=1) * np.sqrt(periods_per_year)
+        sortino_denom = np.minimum(rets, 0.).std(axis=1) * np.sqrt(periods_per_year)
+        log_equity = np.cumsum(np.log1p(rets), axis=1)
+        gmean = np.exp(log_equity[:, -1] * periods_per_year / num_periods) - 1
+        equity = np.concatenate([np.ones((rets.shape[0], 1)), np.exp(log_equity)], axis=1)
+        rolling_dd = compute_rolling_dd(equity)
+        mdd_pct = rolling_dd.max(axis=1)
+        mdd_pct_3yr = compute_rolling_dd(equity[:, -(3 * periods_per_year + 1):]).max(axis=1)
+        return np.column_stack([gmean,
+                                np.where(std == 0, np.nan, amean / std),
+                                np.where(sortino_denom == 0, np.nan, amean / sortino_denom),
+                                mdd_pct,
+                                np.where(mdd_pct_3yr == 0, np.nan, amean / mdd_pct_3yr)])
+
+
+def _block_bootstrap_indices(rng: np.random.Generator, num_resamples: int, num_periods: int, block_size: int) -> np.ndarray:
+    '''Resamples x periods index matrix built from blocks of consecutive periods, wrapping around at the end'''
+    num_blocks = -(-num_periods // block_size)
+    starts = rng.integers(0, num_periods, size=(num_resamples, num_blocks))
+    indices = (starts[:, :, np.newaxis] + np.arange(block_size)) % num_periods
+    return indices.reshape(num_resamples, -1)[:, :num_periods]
+
+
+def _init_bootstrap_worker(rets: np.ndarray) -> None:
+    global _worker_rets
+    _worker_rets = rets
+
+
+def _bootstrap_chunk(rets: np.ndarray | None,
+                     seed: np.random.SeedSequence,
+                     num_resamples: int,
+                     block_size: int,
+                     periods_per_year: int) -> np.ndarray:
+    if rets is None: rets = _worker_rets
+    assert rets is not None
+    indices = _block_bootstrap_indices(np.random.default_rng(seed), num_resamples, len(rets), block_size)
+    return _bootstrap_path_metrics(rets[indices], periods_per_year)
+
+
+def bootstrap_samples(rets: np.ndarray,
+                      num_resamples: int = 10_000,
+                      block_size: int | None = None,
+                      periods_per_year: int = 252,
+                      seed: int | None = None,
+                      chunk_size: int = 1000,
+                      max_workers: int | None = 1) -> pd.DataFrame:
+    '''
+    Resample returns with a circular moving block bootstrap and compute BOOTSTRAP_METRICS for each resampled path.
+    Resamples are processed in chunks of chunk_size, so memory use is about chunk_size * len(rets) * 8 bytes per worker,
+    and each chunk has its own seed derived from seed so results don't depend on max_workers.
+
+    Args:
+        rets: returns per period
+        block_size: number of consecutive returns in each block, to keep autocorrelation and volatility clustering.
+            Default len(rets) ** (1/3).  1 gives a plain iid bootstrap
+        max_workers: number of worker processes.  If 1 we run in this process.  None for one per cpu
+    Return:
+        dataframe with one row per resample and one column per metric
+
+    >>> rets = np.random.default_rng(0).normal(0.001, 0.01, 500)
+    >>> samples = bootstrap_samples(rets, num_resamples=300, seed=1, chunk_size=100)
+    >>> assert samples.shape == (300, 5) and list(samples.columns) == BOOTSTRAP_METRICS
+    >>> assert samples.equals(bootstrap_samples(rets, num_resamples=300, seed=1, chunk_size=100, max_workers=2))
+    '''
+    bt.assert_(rets.ndim == 1 and len(rets) > 1, 'rets must be a 1d array with more than one return')
+    bt.assert_(np.all(rets > -1), f'found returns < -1: {rets[rets <= -1]}')  # type: ignore
+    if block_size is None: block_size = max(int(round(len(rets) ** (1 / 3))), 1)
+    rets = np.ascontiguousarray(rets, dtype=np.float64)
+    chunk_sizes = [min(chunk_size, num_resamples - start) for start in range(0, num_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    if max_workers is None: max_workers = os.cpu_count()
+    if max_workers == 1 or len(chunk_sizes) <= 1:
+        results = [_bootstrap_chunk(rets, _seed, size, block_size, periods_per_year) for _seed, size in zip(seeds, chunk_sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_bootstrap_worker, initargs=(rets,)) as executor:
+            futures = [executor.submit(_bootstrap_chunk, None, _seed, size, block_size, periods_per_year)
+                       for _seed, size in zip(seeds, chunk_sizes)]
+            results = [future.result() for future in futures]
+    samples = np.concatenate(results) if len(results) else np.empty((0, len(BOOTSTRAP_METRICS)))
+    return pd.DataFrame(samples, columns=BOOTSTRAP_METRICS)
+
+
+def bootstrap_return_metrics(rets: np.ndarray,
+                             num_resamples: int = 10_000,
+                             block_size: int | None = None,
+                             confidence: float = 0.95,
+                             periods_per_year: int = 252,
+                             seed: int | None = None,
+                             chunk_size: int = 1000,
+                             max_workers: int | None = 1) -> pd.DataFrame:
+    '''
+    Confidence intervals for BOOTSTRAP_METRICS from a block bootstrap of the returns.  See bootstrap_samples for arguments
+    Return:
+        dataframe indexed by metric with the value on the original returns and the mean, std, lower and upper percentile
+        bounds of the resampled values.  NaNs, e.g. sharpe of a resample with no variance, are ignored
+
+    >>> rets = np.random.default_rng(0).normal(0.001, 0.01, 500)
+    >>> df = bootstrap_return_metrics(rets, num_resamples=1000, seed=1)
+    >>> assert list(df.index) == BOOTSTRAP_METRICS and list(df.columns) == ['value', 'mean', 'std', 'lower', 'upper']
+    >>> assert (df.lower < df.value).all() and (df.value < df.upper).all()
+    '''
+    samples = bootstrap_samples(rets, num_resamples, block_size, periods_per_year, seed, chunk_size, max_workers).values
+    alpha = (1 - confidence) / 2
+    return pd.DataFrame({'value': _bootstrap_path_metrics(rets.reshape(1, -1), periods_per_year)[0],
+                         'mean': np.nanmean(samples, axis=0),
+                         'std': np.nanstd(samples, axis=0),
+                         'lower': np.nanquantile(samples, alpha, axis=0),
+                         'upper': np.nanquantile(samples, 1 - alpha, axis=0)},
+                        index=BOOTSTRAP_METRICS)
+
+
+def downsample_min_max(y: np.ndarray, max_points: int) -> np.ndarray:
+    '''
+    Indices of points to plot so a line of y keeps its shape with at most about max_points points.
+    Splits y into max_points / 2 buckets and keeps the min and max of each, plus the first and last point, so spikes and
+    drawdowns are never dropped.
+
+    >>> y = np.array([0., 5., 1., 2., -3., 1., 0., 4., 2.])
+    >>> downsample_min_max(y, 4)
+    array([0, 1, 4, 6, 7, 8])
+    >>> assert len(downsample_min_max(np.arange(10.), 100)) == 10
+    '''
+    num_points = len(y)
+    if num_points <= max_points: return np.arange(num_points)
+    bucket_size = -(-num_points // max(max_points // 2, 1))
+    num_buckets = -(-num_points // bucket_size)
+    padded = np.full(num_buckets * bucket_size, np.nan)
+    padded[:num_points] = y
+    buckets = padded.reshape(num_buckets, bucket_size)
+    starts = np.arange(num_buckets) * bucket_size
+    min_idx = starts + np.nanargmin(buckets, axis=1)
+    max_idx = starts + np.nanargmax(buckets, axis=1)
+    return np.unique(np.concatenate([[0, num_points - 1], min_idx, max_idx]))
+
+
+def _box_stats(values: np.ndarray) -> dict[str, list[float]]:
+    '''Precomputed plotly box statistics with Tukey fences, so the raw values don't have to be sent to the browser'''
+    q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    lower_fence = values[values >= q1 - 1.5 * iqr].min()
+    upper_fence = values[values <= q3 + 1.5 * iqr].max()
+    return {'q1': [q1], 'median': [median], 'q3': [q3], 'lowerfence': [lower_fence], 'upperfence': [upper_fence],
+            'mean': [values.mean()], 'sd': [values.std()]}
+
+
+def plot_metrics(metrics: Metrics, starting_equity=1e6, max_points: int | None = None) -> go.Figure:
+    '''
+    Plot equity, drawdowns and the distribution of returns by year.
+    Args:
+        max_points: if set, equity and drawdown lines are downsampled to about this many points with downsample_min_max and
+            drawn with WebGL, and return distributions are sent as precomputed box statistics instead of all the returns.
+            Use for long or intraday histories where the figure would otherwise be too large to render
+    '''
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
     fig = make_subplots(rows=3, cols=1)
+    scatter = go.Scatter if max_points is None else go.Scattergl
+
+    def _line(y: np.ndarray) -> go.Scatter | go.Scattergl:
+        idx = np.arange(len(y)) if max_points is None else downsample_min_max(y, max_points)
+        return scatter(x=metrics.dates[idx], y=y[idx], mode='lines')
 
-    equity_trc = go.Scatter(x=metrics.dates, y=metrics.equity * starting_equity, mode='lines')
+    equity_trc = _line(metrics.equity * starting_equity)
     fig.add_trace(equity_trc, row=1, col=1)
 
     fig.add_vrect(x0=metrics.mdd_dates[0], 
@@ -192,7 +687,7 @@ def plot_metrics(metrics: Metrics, starting_equity=1e6) -> go.Figure:
 
     rolling_dd = compute_rolling_dd(metrics.equity * starting_equity)
 
-    dd_trc = go.Scatter(x=metrics.dates, y=rolling_dd, mode='lines')
+    dd_trc = _line(rolling_dd)
     fig.add_trace(dd_trc, row=2, col=1)
 
     fig.add_vrect(x0=metrics.mdd_dates[0], x1=metrics.mdd_dates[1], fillcolor="red", opacity=0.25, line_width=0, row=2, col=1)
@@ -207,13 +702,18 @@ def plot_metrics(metrics: Metrics, starting_equity=1e6) -> go.Figure:
                         row=row, 
                         col=1)
             
+    def _box(rets: np.ndarray, name: int | str, color: str) -> go.Box:
+        if max_points is None: return go.Box(x=rets, boxmean=True, marker_color=color, line_color=color, name=name)
+        return go.Box(y=[name], orientation='h', boxmean=True, boxpoints=False, marker_color=color, line_color=color, name=name,
+                      **_box_stats(rets))
+
     returns = metrics.returns
     years = metrics.dates.astype('M8[Y]')[1:]
     for year in np.unique(years):
         rets = returns[years == year]
         _year = year.astype(datetime.date).year
-        fig.add_trace(go.Box(x=rets, boxmean=True, marker_color='gray', line_color='gray', name=_year), row=3, col=1)
-    fig.add_trace(go.Box(x=returns, boxmean=True, marker_color='blue', line_color='blue', name='All'), row=3, col=1)
+        fig.add_trace(_box(rets, _year, 'gray'), row=3, col=1)
+    fig.add_trace(_box(returns, 'All', 'blue'), row=3, col=1)
     fig.update_yaxes(title_text="Equity", type="log", row=1, col=1)
     fig.update_yaxes(title_text="Drawdown", row=2, col=1)
     fig.update_yaxes(title_text="Return", row=3, col=1)
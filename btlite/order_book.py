@@ -0,0 +1,238 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import heapq
+import itertools
+from typing import Any
+import numpy as np
+from btlite.bt_types import Order, OrderStatus, ModificationType, ModRequest, TimeInForce
+from btlite.bt_utils import assert_
+
+_READY_STATUSES = (OrderStatus.OPEN, OrderStatus.PARTIALLY_FILLED)
+
+
+def get_new_order_status(mod_type: ModificationType) -> OrderStatus:
+    if mod_type == ModificationType.OPEN: return OrderStatus.OPEN
+    if mod_type == ModificationType.CANCEL: return OrderStatus.CANCELLED
+    assert_(False, f'invalid mod_type: {mod_type}')
+    return OrderStatus.CANCELLED  # keep mypy happy
+
+
+class OrderBook:
+    '''
+    Live orders indexed by symbol and status, with heaps for pending modifications and order expiry,
+    so the per bar cost is proportional to the orders that are ready to trade or actually change.
+
+    Orders are moved to filled_orders or cancelled_orders by update_order_lists once their status changes.
+    Status changes made outside the book are picked up for orders that are ready to trade (these are the ones
+    market sims fill).  To modify or cancel an order use request_modification so the book can schedule it.
+
+    >>> from btlite.bt_types import Contract
+    >>> Contract.clear_cache()
+    >>> book = OrderBook(np.timedelta64(1, 'm'))
+    >>> order = Order(order_id='1', contract=Contract.create('IBM'), timestamp=np.datetime64('2024-01-02 09:30'), qty=10)
+    >>> book.add(order)
+    >>> assert order in book and book.has_live('IBM') and not book.has_live('AAPL') and not len(book.ready_orders())
+    >>> book.apply_mod_requests(np.datetime64('2024-01-02 09:31'))
+    >>> assert book.ready_orders() == [order] and order.status == OrderStatus.OPEN
+    >>> order.fill()
+    >>> book.update_order_lists()
+    >>> assert not book.has_live() and book.filled_orders == [order]
+    '''
+    def __init__(self, trade_lag: np.timedelta64) -> None:
+        self.trade_lag = trade_lag
+        self.filled_orders: list[Order] = []
+        self.cancelled_orders: list[Order] = []
+        self._live: dict[int, Order] = {}  # keyed by id(order), in the order they were added
+        self._seq: dict[int, int] = {}
+        self._by_symbol: dict[str, dict[int, Order]] = {}
+        self._by_status: dict[OrderStatus, dict[int, Order]] = {status: {} for status in OrderStatus}
+        self._status: dict[int, OrderStatus] = {}  # status each order is currently indexed under
+        self._ready: dict[int, Order] = {}
+        self._ready_max_seq = -1
+        self._ready_sorted = True
+        self._touched: dict[int, Order] = {}  # orders whose status changed since the last update_order_lists
+        self._mod_heap: list[tuple[np.datetime64, int, int, ModRequest]] = []  # (activation time, tiebreak, key, mod)
+        self._queued_mods: dict[int, ModRequest] = {}
+        self._fok_heap: list[tuple[np.datetime64, int, int]] = []  # cancel once timestamp > expiry
+        self._day_heap: list[tuple[np.datetime64, int, int]] = []  # cancel once timestamp >= expiry
+        self._counter = itertools.count()
+
+    def add(self, order: Order) -> None:
+        key = id(order)
+        assert_(key not in self._live, f'order already in book: {order}')
+        self._live[key] = order
+        self._seq[key] = next(self._counter)
+        self._by_symbol.setdefault(order.contract.symbol, {})[key] = order
+        self._reindex(key, order)
+        if order.pending_mod is not None: self._queue_mod(key, order)
+
+    def request_modification(self, order: Order, mod_request: ModRequest) -> None:
+        '''
+        Modify or cancel a live order. The modification becomes active trade_lag after mod_request.request_time
+        '''
+        order.request_modification(mod_request)
+        key = id(order)
+        if key in self._live: self._queue_mod(key, order)
+
+    def orders_for(self, symbol: str) -> list[Order]:
+        orders = self._by_symbol.get(symbol)
+        if orders is None: return []
+        return list(orders.values())
+
+    def has_live(self, symbol: str | None = None) -> bool:
+        '''Whether there are any live orders, or any live orders for the symbol if one is passed in'''
+        if symbol is None: return len(self._live) > 0
+        return symbol in self._by_symbol
+
+    def orders_with_status(self, status: OrderStatus) -> list[Order]:
+        return list(self._by_status[status].values())
+
+    def live_orders(self) -> list[Order]:
+        '''A new list of the live orders, in the order they were added.  Use add or request_modification to change the book'''
+        return list(self._live.values())
+
+    def ready_orders(self) -> list[Order]:
+        '''Orders that are open or partially filled, in the order they were added'''
+        if not self._ready_sorted:
+            self._ready = dict(sorted(self._ready.items(), key=lambda item: self._seq[item[0]]))
+            self._ready_sorted = True
+        return list(self._ready.values())
+
+    def has_ready(self) -> bool:
+        return len(self._ready) > 0
+
+    def next_activation(self) -> np.datetime64 | None:
+        '''
+        Earliest time at which a pending modification may become active, or None if there are no pending modifications
+        '''
+        return self._mod_heap[0][0] if len(self._mod_heap) else None
+
+    def apply_mod_requests(self, timestamp: np.datetime64) -> None:
+        # Pick up modifications set directly on ready orders
+        for key, order in self._ready.items():
+            if order.pending_mod is not None: self._queue_mod(key, order)
+
+        while len(self._mod_heap) and self._mod_heap[0][0] <= timestamp:
+            _, _, key, mod = heapq.heappop(self._mod_heap)
+            live_order = self._live.get(key)
+            if live_order is None: continue
+            if live_order.pending_mod is not mod:  # stale, modification was replaced or filled
+                if self._queued_mods.get(key) is mod: del self._queued_mods[key]
+                if live_order.pending_mod is not None: self._queue_mod(key, live_order)
+                continue
+            del self._queued_mods[key]
+            live_order.status = get_new_order_status(mod.modification_type)
+            if np.isfinite(mod.limit_price): live_order.limit_price = mod.limit_price
+            if mod.qty != 0: live_order.qty = mod.qty
+            live_order.pending_mod = None
+            self._reindex(key, live_order)
+
+    def expire_orders(self, timestamp: np.datetime64) -> None:
+        while len(self._fok_heap) and self._fok_heap[0][0] < timestamp:
+            self._expire(heapq.heappop(self._fok_heap)[2])
+        while len(self._day_heap) and self._day_heap[0][0] <= timestamp:
+            self._expire(heapq.heappop(self._day_heap)[2])
+
+    def update_order_lists(self) -> None:
+        '''Move filled and cancelled orders out of the book'''
+        changed = self._touched
+        changed.update(self._ready)
+        self._touched = {}
+        for key in sorted(changed.keys(), key=lambda key: self._seq[key]):
+            order = changed[key]
+            if order.status == OrderStatus.FILLED:
+                self._remove(key, order)
+                self.filled_orders.append(order)
+            elif order.status == OrderStatus.CANCELLED:
+                self._remove(key, order)
+                self.cancelled_orders.append(order)
+            else:
+                self._reindex(key, order)
+
+    def _expire(self, key: int) -> None:
+        order = self._live.get(key)
+        if order is None or order.status not in _READY_STATUSES: return
+        order.status = OrderStatus.CANCELLED
+        self._reindex(key, order)
+
+    def _queue_mod(self, key: int, order: Order) -> None:
+        mod = order.pending_mod
+        assert mod is not None
+        if self._queued_mods.get(key) is mod: return
+        self._queued_mods[key] = mod
+        heapq.heappush(self._mod_heap, (mod.request_time + self.trade_lag, next(self._counter), key, mod))
+
+    def _reindex(self, key: int, order: Order) -> None:
+        old_status = self._status.get(key)
+        new_status = order.status
+        if old_status == new_status: return
+        if old_status is not None: del self._by_status[old_status][key]
+        self._by_status[new_status][key] = order
+        self._status[key] = new_status
+        self._touched[key] = order
+        was_ready = old_status in _READY_STATUSES
+        is_ready = new_status in _READY_STATUSES
+        if was_ready and not is_ready:
+            del self._ready[key]
+        elif is_ready and not was_ready:
+            seq = self._seq[key]
+            if seq < self._ready_max_seq: self._ready_sorted = False
+            self._ready_max_seq = max(seq, self._ready_max_seq)
+            self._ready[key] = order
+            if order.time_in_force == TimeInForce.FOK:
+                heapq.heappush(self._fok_heap, (order.timestamp + self.trade_lag, next(self._counter), key))
+            elif order.time_in_force == TimeInForce.DAY:
+                expiry = order.timestamp.astype('M8[D]') + np.timedelta64(1, 'D')
+                heapq.heappush(self._day_heap, (expiry, next(self._counter), key))
+
+    def _remove(self, key: int, order: Order) -> None:
+        del self._live[key]
+        del self._seq[key]
+        symbol_orders = self._by_symbol[order.contract.symbol]
+        del symbol_orders[key]
+        if not len(symbol_orders): del self._by_symbol[order.contract.symbol]
+        del self._by_status[self._status.pop(key)][key]
+        self._ready.pop(key, None)
+        self._queued_mods.pop(key, None)
+        self._touched.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def __contains__(self, order: Order) -> bool:
+        '''Whether an order is live in the book'''
+        return id(order) in self._live
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        '''
+        Indices are keyed by id(order), which changes when the orders are unpickled, e.g. from a checkpoint, so rekey them.
+        Heap entries for orders no longer in the book are dropped since their old ids may now belong to other orders.
+        '''
+        self.__dict__.update(state)
+        new_keys = {key: id(order) for key, order in self._live.items()}
+
+        def rekey(orders: dict[int, Any]) -> dict[int, Any]:
+            return {new_keys[key]: value for key, value in orders.items() if key in new_keys}
+
+        self._live = rekey(self._live)
+        self._seq = rekey(self._seq)
+        self._by_symbol = {symbol: rekey(orders) for symbol, orders in self._by_symbol.items()}
+        self._by_status = {status: rekey(orders) for status, orders in self._by_status.items()}
+        self._status = rekey(self._status)
+        self._ready = rekey(self._ready)
+        self._touched = rekey(self._touched)
+        self._queued_mods = rekey(self._queued_mods)
+        self._mod_heap = [(time, tiebreak, new_keys[key], mod) for time, tiebreak, key, mod in self._mod_heap if key in new_keys]
+        self._fok_heap = [(time, tiebreak, new_keys[key]) for time, tiebreak, key in self._fok_heap if key in new_keys]
+        self._day_heap = [(time, tiebreak, new_keys[key]) for time, tiebreak, key in self._day_heap if key in new_keys]
+        heapq.heapify(self._mod_heap)
+        heapq.heapify(self._fok_heap)
+        heapq.heapify(self._day_heap)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
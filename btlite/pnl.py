@@ -0,0 +1,267 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import re
+import numpy as np
+from typing import Any
+from btlite.bt_utils import assert_, get_child_logger
+from btlite.price_store import PriceStore
+
+_logger = get_child_logger(__name__)
+
+
+def _gather_prices(symbols: np.ndarray, timestamp_idx: np.ndarray, timestamps: np.ndarray, prices: Any) -> np.ndarray:
+    '''
+    Price of symbols[i] at timestamps[timestamp_idx[i]] for each i, NaN if not found
+    '''
+    unique_symbols, symbol_code = np.unique(symbols.astype(str), return_inverse=True)
+    if isinstance(prices, PriceStore):
+        symbol_ids = np.array([prices.symbol_id(symbol) for symbol in unique_symbols], dtype=np.int64)[symbol_code]
+        price_idx = prices.timestamp_indices(timestamps)[timestamp_idx]
+        found = (symbol_ids != -1) & (price_idx != -1)
+        marks = np.full(len(symbols), np.nan)
+        marks[found] = prices.prices[symbol_ids[found], price_idx[found]]
+        found &= ~np.isnan(marks)  # missing prices are stored as NaN
+    else:
+        # look up each distinct (symbol, timestamp) once
+        keys, inverse = np.unique(symbol_code * len(timestamps) + timestamp_idx, return_inverse=True)
+        unique_marks = np.empty(len(keys))
+        found_keys = np.empty(len(keys), dtype=bool)
+        for i, key in enumerate(keys.tolist()):
+            price = prices.get((unique_symbols[key // len(timestamps)], timestamps[key % len(timestamps)]))
+            found_keys[i] = price is not None
+            unique_marks[i] = price if price is not None else np.nan
+        marks = unique_marks[inverse]
+        found = found_keys[inverse]
+    if not found.all():
+        missing = np.flatnonzero(~found)
+        _logger.warning(f'could not find price for: {len(missing)} rows, first: {symbols[missing[0]]} {timestamps[timestamp_idx[missing[0]]]}')
+    return marks
+
+
+def trade_pnl_arrays(symbols: np.ndarray,
+                     entry_timestamp: np.ndarray,
+                     exit_timestamp: np.ndarray,
+                     qty: np.ndarray,
+                     entry_price: np.ndarray,
+                     exit_price: np.ndarray,
+                     multiplier: np.ndarray,
+                     entry_commission: np.ndarray,
+                     exit_commission: np.ndarray,
+                     timestamps: np.ndarray,
+                     prices: Any) -> dict[str, np.ndarray]:
+    '''
+    Compute pnl of roundtrip trades at each of the timestamps from the entry up to and including the first timestamp
+    at or after the exit.  Same output as calling strategy.get_trade_pnl for each trade, but as arrays and without looping
+    over timestamps before the entry.
+
+    Each trade spans a contiguous range of timestamps located with searchsorted, rows for all trades are laid out one
+    after the other and marks are gathered in a single lookup.  Unrealized pnl is the change in market value since the
+    previous row, reversed on the exit row where realized pnl is booked.  Commission is cumulative, i.e. the entry commission
+    on each row plus the exit commission on the exit row.
+
+    Args:
+        symbols, entry_timestamp ... exit_commission: one entry per roundtrip, exit_timestamp NaT for open trades
+        timestamps: sorted timestamps to compute pnl at
+        prices: a PriceStore or a dict keyed by (symbol, timestamp)
+    Return:
+        A dict of arrays with one entry per row: trade_idx, the index of the roundtrip, timestamp, unrealized, realized
+        and commission.  Rows are sorted by trade_idx, then timestamp
+
+    >>> timestamps = np.array(['2023-01-01', '2023-01-02', '2023-01-03', '2023-01-31'], dtype='M8[D]')
+    >>> prices = {('AAPL', timestamp): price for timestamp, price in zip(timestamps, [100., 101., 102., 103.])}
+    >>> pnl = trade_pnl_arrays(np.array(['AAPL']), np.array(['2023-01-02'], dtype='M8[D]'), np.array(['2023-01-04'], dtype='M8[D]'),
+    ...                        np.array([10.]), np.array([99.]), np.array([105.]), np.array([1.]), np.array([10.]), np.array([15.]),
+    ...                        timestamps, prices)
+    >>> assert list(pnl['unrealized']) == [20., 10., -30.] and list(pnl['realized']) == [0., 0., 60.]
+    >>> assert list(pnl['commission']) == [10., 10., 25.]
+    '''
+    num_timestamps = len(timestamps)
+    entry_timestamp = np.asarray(entry_timestamp)
+    exit_timestamp = np.asarray(exit_timestamp)
+    dtype = np.promote_types(np.promote_types(timestamps.dtype, entry_timestamp.dtype), exit_timestamp.dtype)
+    _timestamps = timestamps.astype(dtype)
+    start = np.searchsorted(_timestamps, entry_timestamp.astype(dtype))
+    is_open = np.isnat(exit_timestamp)
+    exit_pos = np.where(is_open, num_timestamps, np.maximum(np.searchsorted(_timestamps, exit_timestamp.astype(dtype)), start))
+    has_exit = exit_pos < num_timestamps
+    end = np.where(has_exit, exit_pos + 1, num_timestamps)
+    num_rows = end - start
+
+    # expand each trade into its range of timestamps
+    trade_idx = np.repeat(np.arange(len(start)), num_rows)
+    row_offsets = np.cumsum(num_rows) - num_rows
+    timestamp_idx = start[trade_idx] + np.arange(len(trade_idx)) - row_offsets[trade_idx]
+    is_exit = has_exit[trade_idx] & (timestamp_idx == exit_pos[trade_idx])
+    is_first = np.zeros(len(trade_idx), dtype=bool)
+    is_first[row_offsets[num_rows > 0]] = True
+
+    value_multiplier = (multiplier * qty)[trade_idx]
+    market_value = np.zeros(len(trade_idx))
+    is_mark = ~is_exit
+    marks = _gather_prices(symbols[trade_idx[is_mark]], timestamp_idx[is_mark], timestamps, prices)
+    market_value[is_mark] = (marks - entry_price[trade_idx[is_mark]]) * value_multiplier[is_mark]
+    prev_market_value = np.concatenate([[0.], market_value[:-1]])
+    prev_market_value[is_first] = 0.
+    unrealized = market_value - prev_market_value
+
+    realized = np.where(is_exit, (exit_price - entry_price)[trade_idx] * value_multiplier, 0.)
+    commission = entry_commission[trade_idx] + np.where(is_exit, exit_commission[trade_idx], 0.)
+    return {'trade_idx': trade_idx,
+            'timestamp': timestamps[timestamp_idx],
+            'unrealized': unrealized,
+            'realized': realized,
+            'commission': commission}
+
+
+def roundtrip_pnl_arrays(trades: list[Any], timestamps: np.ndarray, prices: Any) -> dict[str, np.ndarray]:
+    '''trade_pnl_arrays for a list of RoundTripTrade objects'''
+    return trade_pnl_arrays(np.array([trade.contract.symbol for trade in trades], dtype=object),
+                            np.array([trade.entry_timestamp for trade in trades], dtype='M8'),
+                            np.array([trade.exit_timestamp for trade in trades], dtype='M8'),
+                            np.array([trade.qty for trade in trades], dtype=np.float64),
+                            np.array([trade.entry_price for trade in trades], dtype=np.float64),
+                            np.array([trade.exit_price for trade in trades], dtype=np.float64),
+                            np.array([trade.contract.multiplier for trade in trades], dtype=np.float64),
+                            np.array([trade.entry_commission for trade in trades], dtype=np.float64),
+                            np.array([trade.exit_commission for trade in trades], dtype=np.float64),
+                            timestamps, prices)
+
+
+_FREQ_UNITS: dict[str, np.timedelta64] = {
+    'ns': np.timedelta64(1, 'ns'),
+    'us': np.timedelta64(1, 'us'),
+    'ms': np.timedelta64(1, 'ms'),
+    's': np.timedelta64(1, 's'), 'S': np.timedelta64(1, 's'), 'sec': np.timedelta64(1, 's'),
+    'm': np.timedelta64(1, 'm'), 'min': np.timedelta64(1, 'm'), 'T': np.timedelta64(1, 'm'),
+    'h': np.timedelta64(1, 'h'), 'H': np.timedelta64(1, 'h'), 'hr': np.timedelta64(1, 'h'),
+    'd': np.timedelta64(1, 'D'), 'D': np.timedelta64(1, 'D'),
+    'w': np.timedelta64(1, 'W'), 'W': np.timedelta64(1, 'W')}
+
+
+def parse_freq(freq: str) -> np.timedelta64:
+    '''
+    Interval for a bar frequency: an optional count followed by a unit, e.g. '1m', '30min', '15T', 'h', '1H', '1d' or '1D'.
+    m is minutes, months are not supported since they are not a fixed length
+
+    >>> assert parse_freq('30min') == parse_freq('30m') == np.timedelta64(30, 'm') and parse_freq('h') == np.timedelta64(1, 'h')
+    >>> assert parse_freq('1d') == parse_freq('1D') == np.timedelta64(1, 'D')
+    '''
+    match = re.fullmatch(r'\s*(\d*)\s*([a-zA-Z]+)\s*', freq)
+    unit = _FREQ_UNITS.get(match.group(2)) if match is not None else None
+    assert_(unit is not None, f'invalid frequency: {freq}, expected an optional count followed by one of: {list(_FREQ_UNITS.keys())}')
+    assert match is not None and unit is not None  # keep mypy happy
+    count = int(match.group(1)) if len(match.group(1)) else 1
+    assert_(count > 0, f'invalid frequency: {freq}')
+    return unit * count
+
+
+def resample_timestamps(timestamps: np.ndarray, freq: str) -> np.ndarray:
+    '''
+    Last timestamp in each interval of length freq, e.g. '1m', '15m', '1h' or '1D', see parse_freq.  Intervals are aligned to midnight
+
+    >>> timestamps = np.array(['2024-01-02 15:58', '2024-01-02 15:59', '2024-01-03 09:30', '2024-01-03 09:44', '2024-01-03 09:45'], dtype='M8[m]')
+    >>> assert list(resample_timestamps(timestamps, '1D').astype(str)) == ['2024-01-02T15:59', '2024-01-03T09:45']
+    >>> assert list(resample_timestamps(timestamps, '15m').astype(str)) == ['2024-01-02T15:59', '2024-01-03T09:44', '2024-01-03T09:45']
+    '''
+    interval = parse_freq(freq)
+    bucket = (timestamps - timestamps.astype('M8[D]').astype(timestamps.dtype)) // interval
+    day = timestamps.astype('M8[D]')
+    is_last = np.ones(len(timestamps), dtype=bool)
+    is_last[:-1] = (bucket[1:] != bucket[:-1]) | (day[1:] != day[:-1])
+    return timestamps[is_last]
+
+
+def price_matrix(symbols: list[str], timestamps: np.ndarray, prices: Any, ffill: bool = True) -> np.ndarray:
+    '''
+    symbols x timestamps matrix of prices from a PriceStore or a dict keyed by (symbol, timestamp)
+    Args:
+        ffill: if set, missing prices are replaced by the last price before them, otherwise they are NaN
+    '''
+    # a dict is converted with one pass over its keys rather than a lookup per symbol and timestamp
+    store = prices if isinstance(prices, PriceStore) else PriceStore.from_dict(prices)
+    matrix = np.full((len(symbols), len(timestamps)), np.nan)
+    symbol_ids = np.array([store.symbol_id(symbol) for symbol in symbols], dtype=np.int64)
+    price_idx = store.timestamp_indices(timestamps)
+    rows = np.flatnonzero(symbol_ids != -1)
+    cols = np.flatnonzero(price_idx != -1)
+    matrix[np.ix_(rows, cols)] = store.prices[np.ix_(symbol_ids[rows], price_idx[cols])]
+    if ffill:
+        idx = np.where(np.isnan(matrix), 0, np.arange(len(timestamps)))
+        np.maximum.accumulate(idx, axis=1, out=idx)
+        matrix = np.take_along_axis(matrix, idx, axis=1)
+    return matrix
+
+
+def equity_curve(trade_log: Any,
+                 timestamps: np.ndarray,
+                 prices: Any,
+                 initial_cash: float,
+                 ffill: bool = True) -> dict[str, np.ndarray]:
+    '''
+    Mark to market the portfolio at each of the timestamps.  A trade is included in the position from the first
+    timestamp at or after it.  Positions are cumulative sums of a symbols x timestamps matrix of trade quantities and are
+    valued against a price matrix, so the whole curve is computed without looping over bars or trades.
+
+    Unlike Account.cash, cash here is net of fees and commissions.
+    Args:
+        trade_log: TradeLog of the trades
+        timestamps: sorted timestamps to compute equity at, e.g. every bar or the output of resample_timestamps
+        prices: a PriceStore or a dict keyed by (symbol, timestamp)
+        ffill: see price_matrix
+    Return:
+        A dict of arrays, one entry per timestamp: timestamp, cash, long_exposure, short_exposure (negative), net_exposure,
+        gross_exposure and equity.  Exposures and equity are NaN if a symbol with a position has no price
+
+    >>> from btlite.bt_types import Contract, Order, Trade
+    >>> from btlite.trade_log import TradeLog
+    >>> Contract.clear_cache()
+    >>> contract = Contract.create('ES', multiplier=50)
+    >>> timestamps = np.arange(np.datetime64('2024-01-02 09:30'), np.datetime64('2024-01-02 09:34'))
+    >>> prices = {('ES', timestamp): price for timestamp, price in zip(timestamps, [100., 101., 103., 102.])}
+    >>> trade_log = TradeLog()
+    >>> order = Order(order_id='1', contract=contract, timestamp=timestamps[0], qty=2)
+    >>> trade_log.append(Trade(contract, order, timestamps[1], 2, 101., 0., 10.))
+    >>> curve = equity_curve(trade_log, timestamps, prices, 1e5)
+    >>> assert list(curve['net_exposure']) == [0., 10100., 10300., 10200.]
+    >>> assert list(curve['equity']) == [1e5, 1e5 - 10., 1e5 + 190., 1e5 + 90.]
+    '''
+    num_timestamps = len(timestamps)
+    trade_timestamp = trade_log.timestamp
+    dtype = np.promote_types(timestamps.dtype, trade_timestamp.dtype)
+    bar_idx = np.searchsorted(timestamps.astype(dtype), trade_timestamp.astype(dtype))
+    in_range = bar_idx < num_timestamps
+    bar_idx = bar_idx[in_range]
+    symbol_id = trade_log.symbol_id[in_range]
+    qty = trade_log.qty[in_range]
+    trade_multiplier = trade_log.multiplier()[in_range]
+
+    position_change = np.zeros((len(trade_log.contracts), num_timestamps))
+    np.add.at(position_change, (symbol_id, bar_idx), qty)
+    positions = np.cumsum(position_change, axis=1)
+    cash_flow = -qty * trade_log.price[in_range] * trade_multiplier - trade_log.fee[in_range] - trade_log.commission[in_range]
+    cash = initial_cash + np.cumsum(np.bincount(bar_idx, weights=cash_flow, minlength=num_timestamps))
+
+    multiplier = np.array([contract.multiplier for contract in trade_log.contracts], dtype=np.float64)
+    marks = price_matrix(trade_log.symbols, timestamps, prices, ffill)
+    values = np.where(positions != 0, positions * marks * multiplier[:, np.newaxis], 0.)
+    long_exposure = np.where(values > 0, values, 0.).sum(axis=0)
+    short_exposure = np.where(values < 0, values, 0.).sum(axis=0)
+    is_missing = np.isnan(values).any(axis=0)
+    long_exposure[is_missing] = np.nan
+    short_exposure[is_missing] = np.nan
+    net_exposure = long_exposure + short_exposure
+    return {'timestamp': timestamps,
+            'cash': cash,
+            'long_exposure': long_exposure,
+            'short_exposure': short_exposure,
+            'net_exposure': net_exposure,
+            'gross_exposure': long_exposure - short_exposure,
+            'equity': cash + net_exposure}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -0,0 +1,175 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import numpy as np
+import pandas as pd
+from typing import Any, Union
+from btlite.bt_utils import assert_, get_child_logger
+
+_logger = get_child_logger(__name__)
+
+
+class PriceStore:
+    '''
+    Columnar store of prices, one row per symbol and one column per timestamp.
+
+    Supports the same get((symbol, timestamp)) lookup as a dict keyed by (symbol, timestamp) so it can be passed
+    anywhere a price dict was used before, plus O(1) lookups by integer symbol id and timestamp index and vectorized slicing.
+    Missing prices are stored as NaN and behave like missing dict keys, i.e. get returns the default and len only counts prices present.
+
+    >>> timestamps = np.arange(np.datetime64('2024-01-02 09:30'), np.datetime64('2024-01-02 09:34'))
+    >>> store = PriceStore(['AAPL', 'IBM'], timestamps, np.array([[1., 2., 3., 4.], [10., 11., 12., 13.]]))
+    >>> assert store.get(('IBM', np.datetime64('2024-01-02 09:31'))) == 11.
+    >>> assert store.get(('IBM', np.datetime64('2024-01-02 10:31'))) is None
+    >>> assert store.get_at(0, 3) == 4.
+    >>> assert np.array_equal(store.symbol_prices('AAPL', np.datetime64('2024-01-02 09:31'), np.datetime64('2024-01-02 09:33')), [2., 3.])
+    >>> store2 = PriceStore.from_dict({(key[0], key[1]): store[key] for key in store.keys()})
+    >>> assert np.array_equal(store2.prices, store.prices) and list(store2.symbols) == ['AAPL', 'IBM']
+    >>> store3 = PriceStore.from_dict({('AAPL', timestamps[0]): 1., ('IBM', timestamps[1]): 11.})
+    >>> assert store3.get(('AAPL', timestamps[1])) is None and ('AAPL', timestamps[1]) not in store3 and ('IBM', timestamps[1]) in store3
+    >>> assert len(store3) == 2 and store3.keys() == [('AAPL', timestamps[0]), ('IBM', timestamps[1])]
+    '''
+    def __init__(self, symbols: list[str] | np.ndarray, timestamps: np.ndarray, prices: np.ndarray) -> None:
+        '''
+        Args:
+            symbols: One symbol per row of prices
+            timestamps: Sorted, unique timestamps, one per column of prices
+            prices: 2d float array of shape (len(symbols), len(timestamps))
+        '''
+        prices = np.asarray(prices, dtype=np.float64)
+        assert_(prices.ndim == 2 and prices.shape == (len(symbols), len(timestamps)),
+                f'prices shape: {prices.shape} does not match symbols: {len(symbols)} and timestamps: {len(timestamps)}')
+        assert_(len(timestamps) < 2 or bool(np.all(timestamps[1:] > timestamps[:-1])), 'timestamps must be sorted and unique')
+        self.symbols = np.asarray(symbols, dtype=str)
+        self.timestamps = timestamps
+        self.prices = prices
+        self._symbol_ids: dict[str, int] = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self._last_timestamp: np.datetime64 | None = None
+        self._last_index = -1
+
+    @staticmethod
+    def from_dict(prices: dict[tuple[str, np.datetime64], float]) -> PriceStore:
+        '''
+        Build a store from a dict keyed by (symbol, timestamp)
+        '''
+        if not len(prices): return PriceStore([], np.array([], dtype='M8[m]'), np.empty((0, 0)))
+        keys = list(prices.keys())
+        symbols = np.array([key[0] for key in keys])
+        timestamps = np.array([key[1] for key in keys])
+        values = np.fromiter(prices.values(), dtype=np.float64, count=len(prices))
+        return PriceStore._from_arrays(symbols, timestamps, values)
+
+    @staticmethod
+    def from_df(df: pd.DataFrame, symbol_col: str = 'symbol', timestamp_col: str = 'timestamp', price_col: str = 'c') -> PriceStore:
+        '''
+        Build a store from a long format dataframe with one row per symbol and timestamp
+        '''
+        return PriceStore._from_arrays(df[symbol_col].values, df[timestamp_col].values, df[price_col].values.astype(np.float64))
+
+    @staticmethod
+    def _from_arrays(symbols: np.ndarray, timestamps: np.ndarray, values: np.ndarray) -> PriceStore:
+        unique_symbols, symbol_idx = np.unique(symbols.astype(str), return_inverse=True)
+        unique_timestamps, timestamp_idx = np.unique(timestamps, return_inverse=True)
+        matrix = np.full((len(unique_symbols), len(unique_timestamps)), np.nan)
+        matrix[symbol_idx, timestamp_idx] = values
+        return PriceStore(unique_symbols, unique_timestamps, matrix)
+
+    def symbol_id(self, symbol: str) -> int:
+        '''Returns the row index for a symbol, or -1 if we don't have prices for it'''
+        return self._symbol_ids.get(symbol, -1)
+
+    def timestamp_index(self, timestamp: np.datetime64) -> int:
+        '''Returns the column index for a timestamp, or -1 if it is not in the store'''
+        if timestamp == self._last_timestamp: return self._last_index
+        idx = int(np.searchsorted(self.timestamps, timestamp))
+        if idx == len(self.timestamps) or self.timestamps[idx] != timestamp: idx = -1
+        self._last_timestamp, self._last_index = timestamp, idx
+        return idx
+
+    def timestamp_indices(self, timestamps: np.ndarray) -> np.ndarray:
+        '''Vectorized version of timestamp_index'''
+        idx = np.searchsorted(self.timestamps, timestamps)
+        found = idx < len(self.timestamps)
+        found[found] = self.timestamps[idx[found]] == timestamps[found]
+        return np.where(found, idx, -1)
+
+    def get_at(self, symbol_id: int, timestamp_idx: int) -> float:
+        return self.prices[symbol_id, timestamp_idx]
+
+    def get(self, key: tuple[str, np.datetime64], default: float | None = None) -> float | None:
+        '''Same semantics as dict.get so a store can be used in place of a dict keyed by (symbol, timestamp)'''
+        symbol_id = self._symbol_ids.get(key[0], -1)
+        if symbol_id == -1: return default
+        timestamp_idx = self.timestamp_index(key[1])
+        if timestamp_idx == -1: return default
+        price = self.prices[symbol_id, timestamp_idx]
+        if np.isnan(price): return default
+        return price
+
+    def __getitem__(self, key: tuple[str, np.datetime64]) -> float:
+        price = self.get(key)
+        if price is None: raise KeyError(key)
+        return price
+
+    def __contains__(self, key: tuple[str, np.datetime64]) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        '''Number of prices present, i.e. not NaN'''
+        return int(np.count_nonzero(~np.isnan(self.prices)))
+
+    def keys(self) -> list[tuple[str, np.datetime64]]:
+        '''(symbol, timestamp) of each price present, in symbol then timestamp order'''
+        symbol_idx, timestamp_idx = np.nonzero(~np.isnan(self.prices))
+        return [(self.symbols[i], self.timestamps[j]) for i, j in zip(symbol_idx.tolist(), timestamp_idx.tolist())]
+
+    def symbol_prices(self, symbol: str, start: np.datetime64 | None = None, end: np.datetime64 | None = None) -> np.ndarray:
+        '''
+        Returns a view of prices for a symbol, optionally restricted to start <= timestamp < end
+        '''
+        symbol_id = self._symbol_ids.get(symbol, -1)
+        assert_(symbol_id != -1, f'no prices for: {symbol}')
+        start_idx = 0 if start is None else np.searchsorted(self.timestamps, start)
+        end_idx = len(self.timestamps) if end is None else np.searchsorted(self.timestamps, end)
+        return self.prices[symbol_id, start_idx:end_idx]
+
+    def slice(self, start: np.datetime64 | None = None, end: np.datetime64 | None = None) -> PriceStore:
+        '''
+        Returns a store sharing memory with this one, restricted to start <= timestamp < end
+        '''
+        start_idx = 0 if start is None else np.searchsorted(self.timestamps, start)
+        end_idx = len(self.timestamps) if end is None else np.searchsorted(self.timestamps, end)
+        return PriceStore(self.symbols, self.timestamps[start_idx:end_idx], self.prices[:, start_idx:end_idx])
+
+    def align(self, symbols: list[str]) -> PriceStore:
+        '''
+        Returns a store whose rows are in the order of symbols, e.g. registry.symbols so prices can be indexed by contract id.
+        Rows for symbols without prices are NaN
+
+        >>> timestamps = np.arange(np.datetime64('2024-01-02 09:30'), np.datetime64('2024-01-02 09:32'))
+        >>> store = PriceStore(['AAPL', 'IBM'], timestamps, np.array([[1., 2.], [10., 11.]])).align(['IBM', 'MSFT', 'AAPL'])
+        >>> assert store.get_at(0, 1) == 11. and np.isnan(store.get_at(1, 0)) and store.get_at(2, 0) == 1.
+        '''
+        symbol_ids = np.array([self._symbol_ids.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        prices = np.full((len(symbols), len(self.timestamps)), np.nan)
+        found = symbol_ids != -1
+        prices[found] = self.prices[symbol_ids[found]]
+        return PriceStore(list(symbols), self.timestamps, prices)
+
+
+PriceSourceType = Union[PriceStore, dict[tuple[str, np.datetime64], float]]
+
+
+def to_price_store(prices: Any) -> PriceStore:
+    '''
+    Convert a price dict keyed by (symbol, timestamp) to a PriceStore.  PriceStores are returned as is
+    '''
+    if isinstance(prices, PriceStore): return prices
+    return PriceStore.from_dict(prices)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -0,0 +1,58 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import time
+import pandas as pd
+from typing import Any, Callable
+
+
+def callable_name(func: Any) -> str:
+    '''Name of a function, or the class name for a callable object'''
+    name = getattr(func, '__name__', None)
+    return name if name is not None else type(func).__name__
+
+
+class Profiler:
+    '''
+    Records call counts and wall time per (kind, name)
+
+    >>> profiler = Profiler()
+    >>> assert profiler.call('rule', 'entry', lambda x: x + 1, 1) == 2
+    >>> df = profiler.to_df()
+    >>> assert list(df.columns) == ['kind', 'name', 'calls', 'total_sec', 'mean_sec', 'max_sec']
+    >>> assert df.iloc[0].calls == 1
+    '''
+    def __init__(self) -> None:
+        self._stats: dict[tuple[str, str], list[float]] = {}  # (kind, name) -> [calls, total time, max time]
+
+    def call(self, kind: str, name: str, func: Callable[..., Any], *args: Any) -> Any:
+        start = time.perf_counter()
+        result = func(*args)
+        self.record(kind, name, time.perf_counter() - start)
+        return result
+
+    def record(self, kind: str, name: str, elapsed: float) -> None:
+        stats = self._stats.get((kind, name))
+        if stats is None:
+            self._stats[(kind, name)] = [1, elapsed, elapsed]
+            return
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]: stats[2] = elapsed
+
+    def reset(self) -> None:
+        self._stats = {}
+
+    def to_df(self) -> pd.DataFrame:
+        '''One row per (kind, name) sorted by total time, descending'''
+        df = pd.DataFrame.from_records([(kind, name, int(stats[0]), stats[1], stats[1] / stats[0], stats[2])
+                                        for (kind, name), stats in self._stats.items()],
+                                       columns=['kind', 'name', 'calls', 'total_sec', 'mean_sec', 'max_sec'])
+        return df.sort_values(by='total_sec', ascending=False, ignore_index=True)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
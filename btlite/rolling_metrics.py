@@ -0,0 +1,208 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import math
+from collections import deque
+import numpy as np
+from btlite.bt_utils import assert_
+
+
+class _MeanVar:
+    '''Welford mean and sum of squared deviations, with removal so it can be used over a sliding window'''
+    __slots__ = ['count', 'mean', 'm2']
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def replace(self, old: float, x: float) -> None:
+        '''Remove old and add x, keeping count the same'''
+        prev_mean = self.mean
+        self.mean += (x - old) / self.count
+        self.m2 = max(self.m2 + (x - old) * (x - self.mean + old - prev_mean), 0.)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / self.count) if self.count else math.nan
+
+
+class OnlineMetrics:
+    '''
+    Return statistics updated in O(1) per return, for monitoring a running strategy or a stream of returns.
+    If window is set, statistics are over the last window returns, kept in ring buffers, otherwise over all returns so far.
+
+    Definitions follow compute_return_metrics: std is the population std, sortino uses the std of returns with positive
+    returns set to 0, and drawdowns are relative to the peak of equity compounded from the returns starting at 1.
+    To update it during Strategy.run, call update_equity from a rule enabled on the bars you want to sample, e.g.
+    metrics.update_equity(strategy.get_current_equity(timestamp, prices))
+
+    >>> rets = np.array([0.01, -0.02, 0.015, -0.005, 0.03, -0.04, 0.01])
+    >>> online = OnlineMetrics(window=3)
+    >>> for ret in rets: online.update(ret)
+    >>> offline = rolling_return_metrics(rets, window=3)
+    >>> for name in ['mean', 'std', 'vol', 'sharpe', 'sortino', 'drawdown', 'max_drawdown']:
+    ...     assert math.isclose(getattr(online, name), offline[name][-1], rel_tol=1e-9, abs_tol=1e-12), name
+    >>> print(f'{online.drawdown:.4f} {online.max_drawdown:.4f}')
+    0.0304 0.0400
+    '''
+    def __init__(self, window: int | None = None, periods_per_year: int = 252) -> None:
+        assert_(window is None or window > 0, f'invalid window: {window}')
+        self.window = window
+        self.periods_per_year = periods_per_year
+        self.num_updates = 0
+        self.equity = 1.
+        self._rets = _MeanVar()
+        self._down_rets = _MeanVar()
+        self._peak = 1.
+        self._max_drawdown = 0.
+        self._last_equity = math.nan
+        if window is not None:
+            self._ret_buffer = np.zeros(window)
+            self._equity_buffer = np.ones(window + 1)
+            # indices and values of decreasing equity, the front is the peak of the window
+            self._peaks: deque[tuple[int, float]] = deque([(0, 1.)])
+
+    def update(self, ret: float) -> None:
+        '''Add the return of the next period'''
+        assert_(ret > -1, f'invalid return: {ret}')
+        down_ret = min(ret, 0.)
+        self.num_updates += 1
+        self.equity *= 1 + ret
+        if self.window is None:
+            self._rets.add(ret)
+            self._down_rets.add(down_ret)
+            self._peak = max(self._peak, self.equity)
+            self._max_drawdown = max(self._max_drawdown, (self._peak - self.equity) / self._peak)
+            return
+        pos = (self.num_updates - 1) % self.window
+        if self.num_updates > self.window:
+            old = self._ret_buffer[pos]
+            self._rets.replace(old, ret)
+            self._down_rets.replace(min(old, 0.), down_ret)
+        else:
+            self._rets.add(ret)
+            self._down_rets.add(down_ret)
+        self._ret_buffer[pos] = ret
+        self._equity_buffer[self.num_updates % (self.window + 1)] = self.equity
+        while len(self._peaks) and self._peaks[-1][1] <= self.equity: self._peaks.pop()
+        self._peaks.append((self.num_updates, self.equity))
+        while self._peaks[0][0] < self.num_updates - self.window: self._peaks.popleft()
+
+    def update_equity(self, equity: float) -> None:
+        '''Add the return since the equity passed in to the previous call.  The first call only records equity'''
+        if not math.isnan(self._last_equity): self.update(equity / self._last_equity - 1)
+        self._last_equity = equity
+
+    @property
+    def count(self) -> int:
+        '''Number of returns the statistics are computed over'''
+        return self._rets.count
+
+    @property
+    def mean(self) -> float:
+        '''Mean return per period'''
+        return self._rets.mean if self.count else math.nan
+
+    @property
+    def std(self) -> float:
+        '''Standard deviation of returns per period'''
+        return self._rets.std
+
+    @property
+    def vol(self) -> float:
+        '''Annualized standard deviation'''
+        return self.std * math.sqrt(self.periods_per_year)
+
+    @property
+    def sharpe(self) -> float:
+        std = self.std
+        return self.mean * math.sqrt(self.periods_per_year) / std if std > 0 else math.nan
+
+    @property
+    def sortino(self) -> float:
+        std = self._down_rets.std
+        return self.mean * math.sqrt(self.periods_per_year) / std if std > 0 else math.nan
+
+    @property
+    def drawdown(self) -> float:
+        '''Current drawdown as a fraction of the peak equity'''
+        peak = self._peak if self.window is None else self._peaks[0][1]
+        return (peak - self.equity) / peak
+
+    @property
+    def max_drawdown(self) -> float:
+        '''Largest drawdown as a fraction of the peak equity.  O(window) when windowed since it's only needed on demand'''
+        if self.window is None: return self._max_drawdown
+        num_equities = min(self.num_updates, self.window) + 1
+        equity = np.roll(self._equity_buffer, -(self.num_updates + 1))[-num_equities:]
+        peaks = np.maximum.accumulate(equity)
+        return float(((peaks - equity) / peaks).max())
+
+
+def rolling_return_metrics(rets: np.ndarray, window: int, periods_per_year: int = 252, chunk_size: int = 1_000_000) -> dict[str, np.ndarray]:
+    '''
+    Vectorized statistics over a sliding window of returns, the offline equivalent of OnlineMetrics.
+    The first window - 1 values are over the returns available so far.
+    Args:
+        rets: returns per period
+        window: number of returns in each window
+        chunk_size: max number of window elements held in memory at once
+    Return:
+        dict of arrays with one value per return: mean, std, vol, sharpe, sortino, drawdown, max_drawdown
+
+    >>> rets = np.array([0.1, -0.1, 0.1, 0.2])
+    >>> metrics = rolling_return_metrics(rets, window=2)
+    >>> assert np.allclose(metrics['mean'], [0.1, 0., 0., 0.15])
+    >>> assert np.allclose(metrics['std'], [0., 0.1, 0.1, 0.05])
+    >>> assert np.allclose(metrics['max_drawdown'], [0., 0.1, 0.1, 0.])
+    >>> assert len(rolling_return_metrics(np.array([]), window=2)['std']) == 0
+    '''
+    assert_(window > 0, f'invalid window: {window}')
+    assert_(bool(np.all(rets > -1)), f'found returns < -1: {rets[rets <= -1]}')
+    num_rets = len(rets)
+    count = np.minimum(np.arange(1, num_rets + 1), window)
+    mean, std, down_std, drawdown, max_drawdown = [np.empty(num_rets) for _ in range(5)]
+
+    def _mean_std(windows: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # two passes over each window, which is stable unlike differences of prefix sums of squares
+        mean = windows.sum(axis=1) / counts
+        deviations = windows - mean[:, None]
+        if counts[0] < window: deviations[np.arange(window) < (window - counts)[:, None]] = 0.  # padding
+        return mean, np.sqrt(np.einsum('ij,ij->i', deviations, deviations) / counts)
+
+    if num_rets:
+        # pad so the first window - 1 windows only hold the returns available so far.  Padding equity with the starting
+        # equity leaves drawdowns of short windows unchanged
+        ret_windows = np.lib.stride_tricks.sliding_window_view(np.concatenate([np.zeros(window - 1), rets]), window)
+        equity = np.concatenate([np.ones(window), np.cumprod(1 + rets)])
+        equity_windows = np.lib.stride_tricks.sliding_window_view(equity, window + 1)
+        rows_per_chunk = max(chunk_size // (window + 1), 1)
+        for start in range(0, num_rets, rows_per_chunk):
+            rows = slice(start, start + rows_per_chunk)
+            chunk = ret_windows[rows]
+            mean[rows], std[rows] = _mean_std(chunk, count[rows])
+            _, down_std[rows] = _mean_std(np.minimum(chunk, 0.), count[rows])
+            chunk = equity_windows[rows]
+            peaks = np.maximum.accumulate(chunk, axis=1)
+            drawdown[rows] = (peaks[:, -1] - chunk[:, -1]) / peaks[:, -1]
+            max_drawdown[rows] = ((peaks - chunk) / peaks).max(axis=1)
+    sqrt_periods = math.sqrt(periods_per_year)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(std > 0, mean * sqrt_periods / std, np.nan)
+        sortino = np.where(down_std > 0, mean * sqrt_periods / down_std, np.nan)
+    return {'mean': mean, 'std': std, 'vol': std * sqrt_periods, 'sharpe': sharpe, 'sortino': sortino,
+            'drawdown': drawdown, 'max_drawdown': max_drawdown}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -0,0 +1,271 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import numpy as np
+import pandas as pd
+from collections import deque
+from typing import Any
+from btlite.bt_utils import assert_
+
+_TRACKER_COLUMNS = {'entry_idx': np.int64,
+                    'exit_idx': np.int64,
+                    'qty': np.float64,
+                    'entry_price': np.float64,
+                    'exit_price': np.float64,
+                    'entry_commission': np.float64,
+                    'exit_commission': np.float64,
+                    'net_pnl': np.float64}
+
+_QTY_TOL = 1e-9  # quantities that differ by less than this fraction of a symbol's largest trade are considered equal
+
+
+def _group_cumsum(values: np.ndarray, group_starts: np.ndarray, group_sizes: np.ndarray) -> np.ndarray:
+    '''Cumulative sum of values restarting at each group, for values sorted by group'''
+    cumsum = np.cumsum(values)
+    offsets = np.concatenate([[0.], cumsum[group_starts[1:] - 1]])
+    return cumsum - np.repeat(offsets, group_sizes)
+
+
+def fifo_match(symbol_id: np.ndarray,
+               qty: np.ndarray,
+               price: np.ndarray,
+               commission: np.ndarray,
+               multiplier: np.ndarray) -> dict[str, np.ndarray]:
+    '''
+    Match trades into roundtrips using FIFO, treating each symbol independently.
+
+    Each trade is split into a closing part, up to the size of the position before the trade, and an opening part.
+    In cumulative absolute quantity, opening parts of a symbol form consecutive intervals (lots) and so do closing parts.
+    Each non-empty intersection of a lot with a closing interval is a roundtrip, and whatever is left of the lots
+    after the last closing interval is still open.  Commissions are allocated in proportion to the quantity matched.
+
+    Args:
+        symbol_id, qty, price, commission, multiplier: one entry per trade, in the order the trades were done
+    Return:
+        A dict of arrays with one entry per roundtrip, sorted by entry trade, then exit trade with open lots last:
+        entry_idx, exit_idx: index of the entry and exit trade, exit_idx is -1 for open lots
+        qty: signed quantity, positive for long roundtrips
+        entry_price, exit_price, entry_commission, exit_commission, net_pnl: exit fields are NaN and net_pnl 0 for open lots
+
+    >>> qty = np.array([100., -50., 20., -120., 10.])
+    >>> price = np.array([9., 10., 8., 11., 12.])
+    >>> rts = fifo_match(np.zeros(5, dtype=int), qty, price, np.zeros(5), np.ones(5))
+    >>> assert list(rts['entry_idx']) == [0, 0, 2, 3, 3] and list(rts['exit_idx']) == [1, 3, 3, 4, -1]
+    >>> assert list(rts['qty']) == [50., 50., 20., -10., -40.] and list(rts['net_pnl']) == [50., 100., 60., -10., 0.]
+    '''
+    num_trades = len(qty)
+    assert_(len(symbol_id) == num_trades and len(price) == num_trades and len(commission) == num_trades
+            and len(multiplier) == num_trades, 'trade arrays must have the same length')
+    qty = np.asarray(qty, dtype=np.float64)
+    if num_trades == 0: return {name: np.empty(0, dtype=dtype) for name, dtype in _TRACKER_COLUMNS.items()}
+    order = np.argsort(symbol_id, kind='stable')
+    sorted_ids = np.asarray(symbol_id)[order]
+    sorted_qty = qty[order]
+    group_starts = np.flatnonzero(np.concatenate([[True], sorted_ids[1:] != sorted_ids[:-1]]))
+    group_sizes = np.diff(np.append(group_starts, num_trades))
+    # quantities within tol of each other are treated as equal, so float rounding can't create or drop a roundtrip
+    tol = np.repeat(_QTY_TOL * np.maximum.reduceat(np.abs(sorted_qty), group_starts), group_sizes)
+
+    # split each trade into the part that closes the existing position and the part that opens a new one
+    prev_position = _group_cumsum(sorted_qty, group_starts, group_sizes) - sorted_qty
+    prev_position[np.abs(prev_position) <= tol] = 0.
+    closing = np.where(np.sign(sorted_qty) * np.sign(prev_position) < 0,
+                       np.minimum(np.abs(sorted_qty), np.abs(prev_position)), 0.)
+    opening = np.abs(sorted_qty) - closing
+    closing[closing <= tol] = 0.
+    opening[opening <= tol] = 0.
+
+    # each symbol has its own cumulative quantity axis starting at 0, where its lots and its closing parts are intervals
+    lots = np.flatnonzero(opening > 0)
+    closes = np.flatnonzero(closing > 0)
+    if not len(lots): return {name: np.empty(0, dtype=dtype) for name, dtype in _TRACKER_COLUMNS.items()}
+    trade_group = np.repeat(np.arange(len(group_starts)), group_sizes)
+    ends = np.concatenate([_group_cumsum(opening, group_starts, group_sizes)[lots],
+                           _group_cumsum(closing, group_starts, group_sizes)[closes]])
+    groups = np.concatenate([trade_group[lots], trade_group[closes]])
+    is_lot = np.concatenate([np.ones(len(lots), dtype=bool), np.zeros(len(closes), dtype=bool)])
+    end_tol = np.concatenate([tol[lots], tol[closes]])
+    by_end = np.lexsort((ends, groups))
+    ends, groups, is_lot, end_tol = ends[by_end], groups[by_end], is_lot[by_end], end_tol[by_end]
+
+    # merge lot and closing interval ends within tol into segment boundaries.  Each segment lies in exactly one lot,
+    # and in at most one closing interval.  Lots and closes are sorted by symbol and end, so counting the ends before
+    # a segment gives the lot and closing interval it is in
+    new_point = np.concatenate([[True], (groups[1:] != groups[:-1]) | (ends[1:] - ends[:-1] > end_tol[1:])])
+    point_starts = np.flatnonzero(new_point)
+    seg_end = np.maximum.reduceat(ends, point_starts)
+    seg_group = groups[point_starts]
+    seg_has_lot = np.add.reduceat(is_lot, point_starts) > 0
+    seg_has_close = np.add.reduceat(~is_lot, point_starts) > 0
+    first_in_group = np.concatenate([[True], seg_group[1:] != seg_group[:-1]])
+    seg_start = np.where(first_in_group, 0., np.concatenate([[0.], seg_end[:-1]]))
+    lot_pos: np.ndarray = np.cumsum(seg_has_lot) - seg_has_lot
+    close_pos: np.ndarray = np.cumsum(seg_has_close) - seg_has_close
+    matched: np.ndarray = close_pos < len(closes)
+    matched[matched] = trade_group[closes[close_pos[matched]]] == seg_group[matched]
+
+    entry_idx = order[lots[lot_pos]]
+    exit_idx = np.full(len(seg_end), -1)
+    exit_idx[matched] = order[closes[close_pos[matched]]]
+    abs_qty = seg_end - seg_start
+    sort_idx = np.lexsort((np.where(exit_idx == -1, num_trades, exit_idx), entry_idx))
+    entry_idx, exit_idx, abs_qty = entry_idx[sort_idx], exit_idx[sort_idx], abs_qty[sort_idx]
+    is_closed = exit_idx != -1
+    _exit_idx = np.where(is_closed, exit_idx, 0)
+
+    rt_qty = abs_qty * np.sign(qty[entry_idx])
+    entry_price = price[entry_idx]
+    exit_price = np.where(is_closed, price[_exit_idx], np.nan)
+    entry_commission = commission[entry_idx] * abs_qty / np.abs(qty[entry_idx])
+    exit_commission = np.where(is_closed, commission[_exit_idx] * abs_qty / np.abs(qty[_exit_idx]), np.nan)
+    net_pnl = np.where(is_closed, rt_qty * (exit_price - entry_price) * multiplier[entry_idx] - entry_commission - exit_commission, 0.)
+    return {'entry_idx': entry_idx,
+            'exit_idx': exit_idx,
+            'qty': rt_qty,
+            'entry_price': entry_price,
+            'exit_price': exit_price,
+            'entry_commission': entry_commission,
+            'exit_commission': exit_commission,
+            'net_pnl': net_pnl}
+
+
+def fifo_match_df(trades: Any, rts: dict[str, np.ndarray] | None = None) -> pd.DataFrame:
+    '''
+    Roundtrips as a dataframe with the same columns as strategy.df_roundtrip_trades, computed directly from the columns of a
+    TradeLog without creating RoundTripTrade objects.  Rows are sorted by entry timestamp and symbol.
+    Args:
+        rts: output of fifo_match or RoundTripTracker.to_arrays for these trades, computed if not supplied
+    '''
+    if rts is None: rts = fifo_match(trades.symbol_id, trades.qty, trades.price, trades.commission, trades.multiplier())
+    if not len(rts['qty']): return pd.DataFrame()
+    entry_idx, exit_idx = rts['entry_idx'], rts['exit_idx']
+    is_closed = exit_idx != -1
+    _exit_idx = np.where(is_closed, exit_idx, 0)
+    reason_codes = trades.reason_codes()
+    timestamp = trades.timestamp
+    symbol_id = trades.symbol_id[entry_idx]
+    df = pd.DataFrame({'symbol': np.array(trades.symbols, dtype=object)[symbol_id],
+                       'multiplier': trades.multiplier()[entry_idx],
+                       'entry_timestamp': timestamp[entry_idx],
+                       'exit_timestamp': np.where(is_closed, timestamp[_exit_idx], np.datetime64('NaT')),
+                       'qty': rts['qty'],
+                       'entry_price': rts['entry_price'],
+                       'exit_price': rts['exit_price'],
+                       'entry_reason': reason_codes[entry_idx],
+                       'exit_reason': np.where(is_closed, reason_codes[_exit_idx], None),
+                       'entry_commission': rts['entry_commission'],
+                       'exit_commission': rts['exit_commission'],
+                       'net_pnl': rts['net_pnl']})
+    return df.sort_values(by=['entry_timestamp', 'symbol'])
+
+
+class RoundTripTracker:
+    '''
+    Maintains FIFO open lots per symbol and completed roundtrips as trades are added, so open lots and realized pnl can be
+    queried during a run and roundtrips don't have to be recomputed afterwards.  Produces the same output as fifo_match
+
+    >>> tracker = RoundTripTracker()
+    >>> for qty, price in zip([100, -50, 20, -120, 10], [9., 10., 8., 11., 12.]):
+    ...     tracker.add('AAPL', qty, price)
+    >>> assert tracker.open_lots('AAPL') == [(3, -40., 11.)] and tracker.position('AAPL') == -40.
+    >>> assert tracker.realized_pnl('AAPL') == 200. and tracker.realized_pnl() == 200.
+    >>> rts = tracker.to_arrays()
+    >>> assert list(rts['exit_idx']) == [1, 3, 3, 4, -1] and list(rts['net_pnl']) == [50., 100., 60., -10., 0.]
+    '''
+    def __init__(self) -> None:
+        self.num_trades = 0
+        self._lots: dict[str, deque] = {}  # symbol -> deque of [trade index, remaining signed qty, price, commission per unit]
+        self._position: dict[str, float] = {}
+        self._realized: dict[str, float] = {}
+        self._total_realized = 0.
+        # completed roundtrips, in the order they were closed
+        self._columns: dict[str, list] = {name: [] for name in _TRACKER_COLUMNS}
+
+    def add(self, symbol: str, qty: float, price: float, commission: float = 0., multiplier: float = 1.) -> None:
+        '''Add the next trade, matching it against open lots of the symbol'''
+        trade_idx = self.num_trades
+        self.num_trades += 1
+        if qty == 0: return
+        lots = self._lots.get(symbol)
+        if lots is None:
+            lots = self._lots[symbol] = deque()
+            self._position[symbol] = 0.
+            self._realized[symbol] = 0.
+        self._position[symbol] += qty
+        commission_per_unit = commission / abs(qty)
+        tol = _QTY_TOL * abs(qty)
+        columns = self._columns
+        realized = 0.
+        while qty != 0 and len(lots) and (lots[0][1] > 0) != (qty > 0):
+            lot = lots[0]
+            matched = min(abs(lot[1]), abs(qty))
+            if lot[1] < 0: matched = -matched
+            entry_commission = lot[3] * abs(matched)
+            exit_commission = commission_per_unit * abs(matched)
+            net_pnl = matched * (price - lot[2]) * multiplier - entry_commission - exit_commission
+            columns['entry_idx'].append(lot[0])
+            columns['exit_idx'].append(trade_idx)
+            columns['qty'].append(matched)
+            columns['entry_price'].append(lot[2])
+            columns['exit_price'].append(price)
+            columns['entry_commission'].append(entry_commission)
+            columns['exit_commission'].append(exit_commission)
+            columns['net_pnl'].append(net_pnl)
+            realized += net_pnl
+            lot[1] -= matched
+            qty += matched
+            if abs(qty) <= tol: qty = 0.
+            if abs(lot[1]) <= _QTY_TOL * abs(matched): lots.popleft()
+        if qty != 0: lots.append([trade_idx, qty, price, commission_per_unit])
+        self._realized[symbol] += realized
+        self._total_realized += realized
+
+    def update(self, trade_log: Any) -> None:
+        '''Add trades from a TradeLog that were appended since the last call'''
+        start = self.num_trades
+        assert_(start <= len(trade_log), 'trade log has fewer trades than the tracker')
+        if start == len(trade_log): return
+        symbols = trade_log.symbols
+        multipliers = [contract.multiplier for contract in trade_log.contracts]
+        multiplier = [multipliers[symbol_id] for symbol_id in trade_log.symbol_id[start:].tolist()]
+        for i, (symbol_id, qty, price, commission) in enumerate(zip(trade_log.symbol_id[start:].tolist(), 
+                                                                    trade_log.qty[start:].tolist(),
+                                                                    trade_log.price[start:].tolist(), 
+                                                                    trade_log.commission[start:].tolist())):
+            self.add(symbols[symbol_id], qty, price, commission, multiplier[i])
+
+    def open_lots(self, symbol: str) -> list[tuple[int, float, float]]:
+        '''(entry trade index, remaining signed qty, entry price) of each open lot of a symbol, oldest first'''
+        return [(lot[0], lot[1], lot[2]) for lot in self._lots.get(symbol, ())]
+
+    def position(self, symbol: str) -> float:
+        return self._position.get(symbol, 0.)
+
+    def realized_pnl(self, symbol: str | None = None) -> float:
+        '''Net pnl of completed roundtrips for a symbol, or across all symbols if symbol is None'''
+        if symbol is None: return self._total_realized
+        return self._realized.get(symbol, 0.)
+
+    def num_roundtrips(self) -> int:
+        '''Number of completed roundtrips'''
+        return len(self._columns['qty'])
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        '''Completed roundtrips and open lots in the same format and order as fifo_match'''
+        columns = {name: list(values) for name, values in self._columns.items()}
+        for lots in self._lots.values():
+            for trade_idx, qty, price, commission_per_unit in lots:
+                for name, value in zip(_TRACKER_COLUMNS, 
+                                       (trade_idx, -1, qty, price, np.nan, commission_per_unit * abs(qty), np.nan, 0.)):
+                    columns[name].append(value)
+        rts = {name: np.array(values, dtype=_TRACKER_COLUMNS[name]) for name, values in columns.items()}
+        exit_idx = rts['exit_idx']
+        sort_idx = np.lexsort((np.where(exit_idx == -1, self.num_trades, exit_idx), rts['entry_idx']))
+        return {name: values[sort_idx] for name, values in rts.items()}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
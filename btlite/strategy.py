@@ -1,60 +1,43 @@
 # $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
 # $$_code
 # $$_ %%checkall
-from collections import deque
+from __future__ import annotations
 import copy
 from dataclasses import dataclass, field
 import pandas as pd
-import pandas_market_calendars as mcal
 import numpy as np
-from typing import Callable, Any
+from typing import Callable, Any, Iterable, TYPE_CHECKING
 import math
 from types import SimpleNamespace
 from collections import defaultdict
 from btlite.bt_utils import get_child_logger, assert_
-from btlite.bt_types import RoundTripTrade, Trade, Order, Contract, TimeInForce, OrderStatus, ModificationType
+from btlite.checkpoint import save_checkpoint, load_checkpoint
+from btlite.bt_types import RoundTripTrade, Trade, Order, Contract, ContractRegistry, ModRequest
+from btlite.order_book import OrderBook, get_new_order_status  # noqa: F401
 from btlite.holiday_calendars import Calendar
-from btlite.metrics import compute_return_metrics, plot_metrics
-import plotly.graph_objects as go
-from IPython.display import display
+from btlite.price_store import PriceSourceType
+from btlite.trade_log import TradeLog
+from btlite.roundtrips import RoundTripTracker, fifo_match, fifo_match_df
+from btlite.baskets import BasketMatrix
+from btlite.pnl import trade_pnl_arrays, roundtrip_pnl_arrays, equity_curve, resample_timestamps
+from btlite.profiler import Profiler, callable_name
+from btlite.metrics import Metrics, compute_return_metrics, compute_intraday_metrics, plot_metrics
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
 
 
 _logger = get_child_logger(__name__)
 
 
-def _net_trade(stack: deque, trade: Trade) -> RoundTripTrade | None:
-    if not len(stack) or np.sign(trade.qty) == np.sign(stack[0].qty):
-        stack.append(trade)
-        return None
-    
-    entry = stack[0]
-    qty = min(abs(entry.qty), abs(trade.qty)) * np.sign(entry.qty)
-    entry_fraction = abs(qty / entry.qty)
-    exit_fraction = abs(qty / trade.qty)
-    pnl = qty * (trade.price - entry.price) * entry.contract.multiplier - trade.commission * exit_fraction - entry.commission * entry_fraction
-    entry_reason_code = entry.order.reason_code if entry.order else ''
-    exit_reason_code = trade.order.reason_code if trade.order else ''
-    rt = RoundTripTrade(entry.contract, 
-                        entry.order, trade.order, 
-                        entry.timestamp, trade.timestamp,
-                        qty, 
-                        entry.price, trade.price, 
-                        entry_reason_code, exit_reason_code,
-                        entry.commission * entry_fraction, trade.commission * exit_fraction,
-                        copy.deepcopy(entry.properties), copy.deepcopy(trade.properties),
-                        pnl)
-    resid = entry.qty - qty
-    entry.qty -= qty
-    entry.commission *= (1 - entry_fraction)
-    trade.qty += qty
-    trade.commission *= (1 - exit_fraction)
-    if resid == 0:
-        stack.popleft()
-    return rt
-
-
-def roundtrip_trades(trades: list[Trade]) -> list[RoundTripTrade]:
+def roundtrip_trades(trades: list[Trade] | TradeLog, 
+                     deep_copy: bool = False, 
+                     rts: dict[str, np.ndarray] | None = None) -> list[RoundTripTrade]:
     '''
+    Match trades into roundtrips using FIFO.  See roundtrips.fifo_match
+    Args:
+        deep_copy: if set, entry and exit properties of each roundtrip are deep copies of the trade properties instead of
+            shallow copies
+        rts: output of fifo_match or RoundTripTracker.to_arrays for these trades, computed if not supplied
     >>> qtys = [100, -50, 20, -120, 10]
     >>> prices = [9, 10, 8, 11, 12]                    
     >>> trades = []
@@ -67,45 +50,57 @@ def roundtrip_trades(trades: list[Trade]) -> list[RoundTripTrade]:
     >>> assert [(rt.qty, rt.entry_price, rt.exit_price, rt.net_pnl) for rt in rts] == [
     ...    (50, 9, 10, 50.0), (50, 9, 11, 100.0), (20, 8, 11, 60.0), (-10, 11, 12, -10.0), (-40, 11, np.nan, 0.0)]
     '''
+    if isinstance(trades, TradeLog):
+        contracts = [trades.contracts[symbol_id] for symbol_id in trades.symbol_id]
+        orders = [trades.orders[order_idx] for order_idx in trades.order_idx]
+        properties = [trades.properties.get(i) for i in range(len(trades))]
+        if rts is None: rts = fifo_match(trades.symbol_id, trades.qty, trades.price, trades.commission, trades.multiplier())
+        timestamps = trades.timestamp
+    else:
+        contracts = [trade.contract for trade in trades]
+        orders = [trade.order for trade in trades]
+        properties = [trade.properties for trade in trades]
+        if rts is None:
+            symbol_ids: dict[str, int] = {}
+            symbol_id = np.array([symbol_ids.setdefault(contract.symbol, len(symbol_ids)) for contract in contracts], dtype=np.int64)
+            rts = fifo_match(symbol_id,
+                             np.array([trade.qty for trade in trades], dtype=np.float64),
+                             np.array([trade.price for trade in trades], dtype=np.float64),
+                             np.array([trade.commission for trade in trades], dtype=np.float64),
+                             np.array([contract.multiplier for contract in contracts], dtype=np.float64))
+        timestamps = np.array([trade.timestamp for trade in trades])
+    copy_func = copy.deepcopy if deep_copy else copy.copy
+
+    def _copy_properties(i: int) -> SimpleNamespace:
+        _properties = properties[i]
+        return SimpleNamespace() if _properties is None else copy_func(_properties)
+
     rtt: list[RoundTripTrade] = []
-    stacks: dict[str, deque] = defaultdict(deque)
-    _trades = copy.copy(trades)
-    
-    # Keep track of index
-    for i, trade in enumerate(_trades):
-        trade.properties.index = i
-        
-    for _trade in _trades:
-        trade = copy.copy(_trade)  # note this is a shallow copy so don't modify any objects
-        while True:
-            rt = _net_trade(stacks[trade.contract.symbol], trade)
-            if rt is None: break
-            rtt.append(rt)
-            if trade.qty == 0: break
-                
-    open_trades = [trade for trades in stacks.values() for trade in trades]
-        
-    open_rtt = [RoundTripTrade(open_trade.contract,
-                               open_trade.order, 
-                               None,
-                               open_trade.timestamp, 
-                               np.datetime64('NaT'),
-                               open_trade.qty,
-                               open_trade.price, 
-                               np.nan, 
-                               open_trade.order.reason_code, 
-                               None,
-                               open_trade.commission, 
-                               np.nan,
-                               open_trade.properties, 
-                               SimpleNamespace(),
-                               0.) for open_trade in open_trades]
-    rtt = rtt + open_rtt
-    rtt.sort(key=lambda rt: rt.entry_properties.index)
-    for i, rt in enumerate(rtt):
-        rt.entry_properties.entry_index = rt.entry_properties.index
-        rt.entry_properties.index = i
-        
+    for i, (entry_idx, exit_idx) in enumerate(zip(rts['entry_idx'].tolist(), rts['exit_idx'].tolist())):
+        entry_order = orders[entry_idx]
+        entry_properties = _copy_properties(entry_idx)
+        entry_properties.entry_index = entry_idx
+        entry_properties.index = i
+        entry_reason = entry_order.reason_code if entry_order else ''
+        if exit_idx == -1:
+            rtt.append(RoundTripTrade(contracts[entry_idx], entry_order, None,
+                                      timestamps[entry_idx], np.datetime64('NaT'),
+                                      rts['qty'][i], rts['entry_price'][i], np.nan,
+                                      entry_reason, None,
+                                      rts['entry_commission'][i], np.nan,
+                                      entry_properties, SimpleNamespace(),
+                                      0.))
+            continue
+        exit_order = orders[exit_idx]
+        exit_properties = _copy_properties(exit_idx)
+        exit_properties.index = exit_idx
+        rtt.append(RoundTripTrade(contracts[entry_idx], entry_order, exit_order,
+                                  timestamps[entry_idx], timestamps[exit_idx],
+                                  rts['qty'][i], rts['entry_price'][i], rts['exit_price'][i],
+                                  entry_reason, exit_order.reason_code if exit_order else '',
+                                  rts['entry_commission'][i], rts['exit_commission'][i],
+                                  entry_properties, exit_properties,
+                                  rts['net_pnl'][i]))
     return rtt
 
 
@@ -130,7 +125,7 @@ def df_roundtrip_trades(rt_trades: list[RoundTripTrade]) -> pd.DataFrame:
 
 def get_trade_pnl(trade: RoundTripTrade, 
                   timestamps: np.ndarray, 
-                  prices: dict[tuple[str, np.datetime64], float]) -> list[tuple[np.datetime64, float, float, float]]:
+                  prices: PriceSourceType) -> list[tuple[np.datetime64, float, float, float]]:
     '''
     >>> from types import SimpleNamespace
     >>> trade = SimpleNamespace(
@@ -151,62 +146,109 @@ def get_trade_pnl(trade: RoundTripTrade,
     >>> assert len(trade_pnl) == 3 
     >>> assert trade_pnl[-1] == (np.datetime64('2023-01-31'), -30.0, 60.0, 25.0)
     '''
-    entry_commission_applied = False
-    symbol = trade.contract.symbol
- 
-    rows: list = []
-
-    unrealized = 0.
-    realized = 0.
-    commission = 0.
-    unrealized_mv = 0.
-
-    for i, timestamp in enumerate(timestamps):
-        if timestamp < trade.entry_timestamp: continue
-
-        if not entry_commission_applied:
-            commission += trade.entry_commission
-            entry_commission_applied = True
-        
-        if timestamp >= trade.exit_timestamp:
-            commission += trade.exit_commission
-            realized = (trade.exit_price - trade.entry_price) * trade.contract.multiplier * trade.qty
-            unrealized = -unrealized_mv
-            rows.append((timestamp, unrealized, realized, commission))
-            break
-
-        price = prices.get((symbol, timestamp))
-        if price is None:
-            _logger.warning(f'could not find price for: {symbol} {timestamp}')
-            price = np.nan
-
-        _unrealized_mv = (price - trade.entry_price) * trade.contract.multiplier * trade.qty
-        unrealized = _unrealized_mv - unrealized_mv  # current - previous
-        unrealized_mv = _unrealized_mv
-        rows.append((timestamp, unrealized, realized, commission))
-    return rows
+    pnl = roundtrip_pnl_arrays([trade], timestamps, prices)
+    return list(zip(pnl['timestamp'], pnl['unrealized'].tolist(), pnl['realized'].tolist(), pnl['commission'].tolist()))
 
 
 def get_pnl(trades: list[RoundTripTrade], 
             timestamps: np.ndarray, 
-            prices: dict[tuple[str, np.datetime64], float]) -> list[tuple[str, np.datetime64, float, float, float]]:
-    rows: list[tuple[str, np.datetime64, float, float, float]] = []
-    for trade in trades:
-        trade_pnl = get_trade_pnl(trade, timestamps, prices)
-        for row in trade_pnl:
-            rows.append((trade.entry_properties.trade_id, row[0], row[1], row[2], row[3]))
-    return rows
+            prices: PriceSourceType) -> list[tuple[str, np.datetime64, float, float, float]]:
+    pnl = roundtrip_pnl_arrays(trades, timestamps, prices)
+    trade_ids = [trade.entry_properties.trade_id for trade in trades]
+    return [(trade_ids[trade_idx], timestamp, unrealized, realized, commission) 
+            for trade_idx, timestamp, unrealized, realized, commission in zip(pnl['trade_idx'].tolist(), 
+                                                                               pnl['timestamp'],
+                                                                               pnl['unrealized'].tolist(),
+                                                                               pnl['realized'].tolist(),
+                                                                               pnl['commission'].tolist())]
 
 
 def get_pnl_df(pnl: list[tuple[str, np.datetime64, float, float, float]]) -> pd.DataFrame:
     return pd.DataFrame.from_records(pnl, columns=['trade_id', 'timestamp', 'unrealized', 'realized', 'commission'])
 
 
-def get_new_order_status(mod_type: ModificationType) -> OrderStatus:
-    if mod_type == ModificationType.OPEN: return OrderStatus.OPEN
-    if mod_type == ModificationType.CANCEL: return OrderStatus.CANCELLED
-    assert_(False, f'invalid mod_type: {mod_type}')
-    return OrderStatus.CANCELLED  # keep mypy happy
+class RuleSchedule:
+    '''
+    Boolean matrix of rules x bars recording which rules are enabled on which bar of the market timestamps.
+    The timestamps each rule was enabled for are also kept, for bars that are not market timestamps, e.g. from Strategy.step
+
+    >>> timestamps = np.arange(np.datetime64('2024-01-02 09:30'), np.datetime64('2024-01-02 09:40'))
+    >>> schedule = RuleSchedule(timestamps)
+    >>> schedule.enable('entry', timestamps[[2, 5]])
+    >>> schedule.enable('exit', np.array(['2024-01-02 09:35', '2024-01-02 11:00'], dtype='M8[m]'))
+    >>> assert schedule.is_enabled('entry', 2) and not schedule.is_enabled('exit', 2) and schedule.is_enabled('exit', 5)
+    >>> assert schedule.next_enabled(3) == 5 and schedule.next_enabled(6) == 10
+    >>> assert schedule.enabled_rules()[timestamps[5]] == {'entry', 'exit'}
+    >>> assert schedule.is_enabled_at('exit', np.datetime64('2024-01-02 11:00')) and not schedule.is_enabled_at('entry', timestamps[3])
+    '''
+    def __init__(self, timestamps: np.ndarray) -> None:
+        self.timestamps = timestamps
+        self._mask = np.zeros((0, len(timestamps)), dtype=bool)  # rows past the number of rules are spare capacity
+        self._rows: dict[str, int] = {}
+        self._enabled: dict[str, np.ndarray] = {}  # rule name -> sorted timestamps it is enabled for
+        self._enabled_bars: np.ndarray | None = None  # sorted indices of bars with at least one enabled rule
+
+    @property
+    def mask(self) -> np.ndarray:
+        return self._mask[:len(self._rows)]
+
+    def enable(self, name: str, timestamps: np.ndarray) -> None:
+        '''Enable a rule for timestamps.  Timestamps that are not market timestamps are only used by is_enabled_at'''
+        enabled = self._enabled.get(name)
+        self._enabled[name] = np.unique(timestamps) if enabled is None else np.union1d(enabled, timestamps)
+        row = self._rows.get(name)
+        if row is None:
+            row = len(self._rows)
+            self._rows[name] = row
+            if row == len(self._mask):
+                # grow geometrically so adding many rules doesn't copy the matrix each time
+                mask = np.zeros((max(2 * row, 4), len(self.timestamps)), dtype=bool)
+                mask[:row] = self._mask
+                self._mask = mask
+        idx = np.searchsorted(self.timestamps, timestamps)
+        found = idx < len(self.timestamps)
+        found[found] = self.timestamps[idx[found]] == timestamps[found]
+        self._mask[row, idx[found]] = True
+        self._enabled_bars = None
+
+    def is_enabled(self, name: str, bar_idx: int) -> bool:
+        row = self._rows.get(name)
+        if row is None or bar_idx < 0: return False
+        return bool(self._mask[row, bar_idx])
+
+    def is_enabled_at(self, name: str, timestamp: np.datetime64) -> bool:
+        '''Whether a rule is enabled for a timestamp that may not be one of the market timestamps'''
+        enabled = self._enabled.get(name)
+        if enabled is None: return False
+        idx = np.searchsorted(enabled, timestamp)
+        return bool(idx < len(enabled) and enabled[idx] == timestamp)
+
+    def enabled_names(self, bar_idx: int) -> set[str]:
+        if bar_idx < 0: return set()
+        column = self._mask[:, bar_idx]
+        return {name for name, row in self._rows.items() if column[row]}
+
+    def next_enabled(self, bar_idx: int) -> int:
+        '''Index of the first bar at or after bar_idx with an enabled rule, or the number of bars if there is none'''
+        if self._enabled_bars is None: self._enabled_bars = np.flatnonzero(self.mask.any(axis=0))
+        pos = np.searchsorted(self._enabled_bars, bar_idx)
+        if pos == len(self._enabled_bars): return len(self.timestamps)
+        return int(self._enabled_bars[pos])
+
+    def enabled_rules(self) -> defaultdict[np.datetime64, set[str]]:
+        '''Names of the rules enabled for each timestamp that has any'''
+        enabled_rules: defaultdict[np.datetime64, set[str]] = defaultdict(set)
+        for name, timestamps in self._enabled.items():
+            for timestamp in timestamps:
+                enabled_rules[timestamp].add(name)
+        return enabled_rules
+
+    def realign(self, timestamps: np.ndarray) -> 'RuleSchedule':
+        '''Returns a schedule for new market timestamps, keeping the timestamps each rule is enabled for'''
+        schedule = RuleSchedule(timestamps)
+        for name, enabled in self._enabled.items():
+            schedule.enable(name, enabled)
+        return schedule
 
 
 # will define Order in a types module
@@ -220,41 +262,57 @@ class Strategy:
 
     timestamps: np.ndarray
     rules: dict[str, RuleType]
-    enabled_rules: defaultdict[np.datetime64, set[str]]
+    rule_schedule: RuleSchedule
     globally_enabled_rules: set[str]
     market_sims: list[MarketSimType]
+    market_sim_names: list[str]
     trade_callbacks: list[TradeCBType]
-    live_orders: list[Order]
-    cancelled_orders: list[Order]
-    filled_orders: list[Order]
-    trade_history: list[Trade]
-    trade_lag: np.timedelta64
+    order_book: OrderBook
+    trade_history: TradeLog
+    roundtrips: RoundTripTracker
+    registry: ContractRegistry
     log_orders: bool
     log_trades: bool
 
-    def __init__(self, initial_cash: float = 1e6, trade_lag: np.timedelta64 = np.timedelta64(1, 'm')) -> None:
+    def __init__(self, 
+                 initial_cash: float = 1e6, 
+                 trade_lag: np.timedelta64 = np.timedelta64(1, 'm'), 
+                 registry: ContractRegistry | None = None) -> None:
+        '''
+        Args:
+            registry: contracts used by this strategy.  Defaults to the process wide Contract.registry
+        '''
+        self.registry = registry if registry is not None else Contract.registry
         self.timestamps = np.ndarray(0)
         self.rules = {}
-        self.enabled_rules = defaultdict(set)
+        self.rule_schedule = RuleSchedule(self.timestamps)
         self.globally_enabled_rules = set()
         self.market_sims = []
+        self.market_sim_names = []  # one per market sim, used as its name in the profile
         self.trade_callbacks = []
-        self.live_orders = []
-        self.cancelled_orders = []
-        self.filled_orders = []
-        self.trade_history = []
-        self.trade_lag = trade_lag
+        self.order_book = OrderBook(trade_lag)
+        self.trade_history = TradeLog()
+        self.roundtrips = RoundTripTracker()  # open lots and completed roundtrips, updated as trades are done
         self.log_orders = True
         self.log_trades = True
         self.initial_cash = initial_cash
-        self.account = Account(cash=initial_cash, positions=defaultdict(int))
+        self.account = Account(cash=initial_cash, positions=defaultdict(int), registry=self.registry)
         self.calendar: Calendar | None = None
+        self.current_bar: Any = None  # bar data passed to step, if any
+        self.profiler: Profiler | None = None
+        self._last_step_timestamp: np.datetime64 | None = None
+        self.next_bar_idx = 0  # index of the next market timestamp run will process
+        self._step_idx = 0
+        self._stepped_timestamps: np.ndarray | None = None  # bars passed to step that are not market timestamps
+        self._num_stepped = 0
 
     def set_market_timestamps(self, timestamps: np.ndarray) -> None:
         '''
         Use either this or set_market_calendar
         '''
         self.timestamps = timestamps
+        self.rule_schedule = self.rule_schedule.realign(timestamps)
+        self.next_bar_idx = 0
 
     def set_market_calendar(self, 
                             start_date: np.datetime64, 
@@ -265,6 +323,7 @@ class Strategy:
         '''
         Closed on the left, i.e 9:30-15:59, not 9:31-16:00
         '''
+        import pandas_market_calendars as mcal
         cal = mcal.get_calendar(calendar)
         assert_(cal is not None)
         schedule = cal.schedule(start_date, end_date)
@@ -278,6 +337,8 @@ class Strategy:
             assert_(False, 'unknown frequency: {freq}')
         self.calendar = Calendar(calendar)
         self.timestamps = timestamps
+        self.rule_schedule = self.rule_schedule.realign(timestamps)
+        self.next_bar_idx = 0
 
     def add_rule(self, name: str, rule: RuleType) -> None:
         '''Rules are guaranteed to be run in the order in which they are added here'''
@@ -289,68 +350,134 @@ class Strategy:
             self.globally_enabled_rules.add(name)
             return
 
-        assert_(timestamps.dtype == self.timestamps.dtype)
+        assert_(not len(self.timestamps) or timestamps.dtype == self.timestamps.dtype)
+        self.rule_schedule.enable(name, timestamps)
 
-        for timestamp in timestamps:
-            rules_list = self.enabled_rules.get(timestamp)
-            if rules_list is None:
-                self.enabled_rules[timestamp] = {name}
-            else:
-                rules_list.add(name)
+    @property
+    def enabled_rules(self) -> defaultdict[np.datetime64, set[str]]:
+        '''
+        Rules enabled for each market timestamp, not including globally enabled rules.  This is a copy built from
+        rule_schedule, use enable_rule to change it
+        '''
+        return self.rule_schedule.enabled_rules()
 
     def disable_rule(self, name: str) -> None:
         '''Call enable_rule if you want to disable for a few timestamps.'''
         self.globally_enabled_rules.discard(name)
 
-    def add_market_sim(self, market_sim: MarketSimType) -> None:
+    def enable_profiling(self) -> None:
+        '''
+        Record call counts and wall time for each rule, market sim, trade callback and internal phase of run.  See get_profile
+        '''
+        self.profiler = Profiler()
+
+    def disable_profiling(self) -> None:
+        self.profiler = None
+
+    def get_profile(self) -> pd.DataFrame:
+        '''
+        Returns a dataframe with kind, name, calls, total_sec, mean_sec and max_sec columns, sorted by total_sec.
+        kind is one of rule, market_sim, trade_callback or phase
+        '''
+        if self.profiler is None:
+            assert_(False, 'call enable_profiling before running the strategy')
+            return pd.DataFrame()  # keep mypy happy
+        return self.profiler.to_df()
+
+    def add_market_sim(self, market_sim: MarketSimType, name: str | None = None) -> None:
+        '''
+        Args:
+            name: name of the market sim in get_profile.  Defaults to its class or function name,
+                with the index of the market sim appended if another market sim already has that name
+        '''
+        if name is None:
+            name = callable_name(market_sim)
+            if name in self.market_sim_names: name = f'{name}_{len(self.market_sims)}'
+        assert_(name not in self.market_sim_names, f'market sim: {name} already added')
         self.market_sims.append(market_sim)
+        self.market_sim_names.append(name)
 
     def add_trade_callback(self, trade_cb: TradeCBType) -> None:
         self.trade_callbacks.append(trade_cb)
 
-    def get_current_equity(self, timestamp: np.datetime64, prices: dict[tuple[str, np.datetime64], float]) -> float:
-        equity: float = self.account.cash
-        for (name, qty) in self.account.positions.items():
-            if qty == 0: continue
-            price = prices.get((name, timestamp))
-            if price is None:
-                _logger.warning(f'could not find price for: {name} {timestamp}')
-                return math.nan
-            contract = Contract.get(name)
-            assert contract is not None
-            multiplier = contract.multiplier
-            mv = price * qty * multiplier
-            equity += mv
-        return equity
+    def get_current_equity(self, timestamp: np.datetime64, prices: PriceSourceType) -> float:
+        '''
+        Cash plus market value of positions at timestamp, NaN if a price is missing.  Cached, so calling this from several
+        rules on the same bar only marks positions once.  See Account.equity
+        '''
+        return self.account.equity(timestamp, prices)
+
+    @property
+    def trade_lag(self) -> np.timedelta64:
+        return self.order_book.trade_lag
+
+    @trade_lag.setter
+    def trade_lag(self, trade_lag: np.timedelta64) -> None:
+        self.order_book.trade_lag = trade_lag
+
+    @property
+    def live_orders(self) -> tuple[Order, ...]:
+        '''
+        A read only snapshot of the live orders, since they are kept in the order book.
+        Use order_book.orders_for or order_book.has_live in rules instead of scanning this
+        '''
+        return tuple(self.order_book.live_orders())
+
+    @live_orders.setter
+    def live_orders(self, orders: Iterable[Order]) -> None:
+        '''
+        Adds orders that are not already in the book, e.g. strategy.live_orders += (order,).
+        Live orders can't be removed this way, use request_modification to cancel them
+        '''
+        orders = list(orders)
+        keep = set(map(id, orders))
+        assert_(all(id(order) in keep for order in self.order_book.live_orders()),
+                'cannot remove live orders by assignment, use request_modification to cancel them')
+        for order in orders:
+            if order not in self.order_book: self.order_book.add(order)
+
+    @property
+    def cancelled_orders(self) -> list[Order]:
+        return self.order_book.cancelled_orders
+
+    @cancelled_orders.setter
+    def cancelled_orders(self, orders: list[Order]) -> None:
+        self.order_book.cancelled_orders = orders
+
+    @property
+    def filled_orders(self) -> list[Order]:
+        return self.order_book.filled_orders
+
+    @filled_orders.setter
+    def filled_orders(self, orders: list[Order]) -> None:
+        self.order_book.filled_orders = orders
+
+    def request_modification(self, order: Order, mod_request: ModRequest) -> None:
+        '''
+        Modify or cancel a live order.  The modification becomes active trade_lag after mod_request.request_time
+        '''
+        self.order_book.request_modification(order, mod_request)
 
     def _apply_mod_requests(self, timestamp: np.datetime64) -> None:
-        for order in self.live_orders:
-            if order.pending_mod is None: continue
-            pending_mod = order.pending_mod
-            if (timestamp - pending_mod.request_time) < self.trade_lag: continue
-            order.status = get_new_order_status(pending_mod.modification_type)
-            if np.isfinite(pending_mod.limit_price): order.limit_price = pending_mod.limit_price
-            if pending_mod.qty != 0: order.qty = pending_mod.qty
-            order.pending_mod = None
+        self.order_book.apply_mod_requests(timestamp)
             
     def _expire_orders(self, timestamp: np.datetime64) -> None:
-        for order in self.live_orders:
-            if order.status in [OrderStatus.OPEN, OrderStatus.PARTIALLY_FILLED]:
-                if order.time_in_force == TimeInForce.FOK and (timestamp - order.timestamp) > self.trade_lag:
-                    order.status = OrderStatus.CANCELLED
-                    continue
-                if order.time_in_force == TimeInForce.DAY and timestamp.astype('M8[D]') > order.timestamp.astype('M8[D]'):
-                    order.status = OrderStatus.CANCELLED
-                    continue
-
-    def _get_new_orders(self, timestamp: np.datetime64) -> list[Order]:
+        self.order_book.expire_orders(timestamp)
+
+    def _get_new_orders(self, timestamp: np.datetime64, bar_idx: int = -1) -> list[Order]:
         new_orders: list[Order] = []
-        rule_names = self.enabled_rules[timestamp]
+        schedule = self.rule_schedule
+        profiler = self.profiler
         for rule_name, rule in self.rules.items():
-            if rule_name in rule_names or rule_name in self.globally_enabled_rules:
-                _new_orders = rule(self, timestamp)
+            if (rule_name in self.globally_enabled_rules or schedule.is_enabled(rule_name, bar_idx)
+                    or (bar_idx == -1 and schedule.is_enabled_at(rule_name, timestamp))):
+                if profiler is None:
+                    _new_orders = rule(self, timestamp)
+                else:
+                    _new_orders = profiler.call('rule', rule_name, rule, self, timestamp)
                 new_orders += _new_orders
-                self.live_orders += _new_orders
+                for order in _new_orders:
+                    self.order_book.add(order)
 
         if self.log_orders:
             for order in new_orders: 
@@ -359,61 +486,193 @@ class Strategy:
         return new_orders
 
     def _update_order_lists(self) -> None:
-        tmp: list[Order] = []
-        for order in self.live_orders:
-            if order.status == OrderStatus.FILLED:
-                self.filled_orders.append(order)
-                continue
-            if order.status == OrderStatus.CANCELLED:
-                self.cancelled_orders.append(order)
-                continue
-            tmp.append(order)
-        self.live_orders = tmp
-
-    def get_position(self, name: str) -> int:
+        self.order_book.update_order_lists()
+
+    def get_position(self, name: str) -> float:
         val = self.account.positions.get(name)
         if val is None: return 0
         return val
 
-    def get_positions(self) -> dict[str, int]:
+    def get_component_positions(self) -> dict[str, float]:
+        '''
+        Positions with basket contracts replaced by the components they hold, netted against direct positions in the
+        components.  Only non-zero positions are returned
+        '''
+        registry = self.registry
+        positions = np.zeros(len(registry))
+        for symbol, qty in self.account.positions.items():
+            contract_id = registry.id_of(symbol)
+            assert_(contract_id != -1, f'{symbol} is not in the strategy contract registry')
+            positions[contract_id] = qty
+        component_positions = BasketMatrix(registry).explode(positions)
+        return {registry[int(i)].symbol: float(component_positions[i]) for i in np.flatnonzero(component_positions)}
+
+    def get_positions(self) -> dict[str, float]:
         return self.account.positions
 
-    def run(self) -> None:
-        for timestamp in self.timestamps:
+    def _next_active_index(self, idx: int) -> int:
+        '''
+        Returns the index of the first bar at or after idx where something can happen, i.e. a rule is enabled, 
+        an order is ready to trade or a pending modification becomes active. Returns len(self.timestamps) if there is none.
+        '''
+        if idx >= len(self.timestamps): return idx
+        if len(self.globally_enabled_rules): return idx
+        # Market sims and order expiry need to see ready orders on every bar
+        if self.order_book.has_ready(): return idx
+        next_idx = self.rule_schedule.next_enabled(idx)
+        next_activation = self.order_book.next_activation()
+        if next_activation is not None:
+            next_idx = min(next_idx, max(idx, int(np.searchsorted(self.timestamps, next_activation))))
+        return next_idx
+
+    def _process_bar(self, timestamp: np.datetime64, bar_idx: int) -> None:
+        profiler = self.profiler
+        if profiler is None:
             self._apply_mod_requests(timestamp)
             self._expire_orders(timestamp)
             self._update_order_lists()
-            self._get_new_orders(timestamp)
- 
-            ready_orders = [order for order in self.live_orders if order.status in [OrderStatus.OPEN, OrderStatus.PARTIALLY_FILLED]]
-            trades: list[Trade] = []
+        else:
+            profiler.call('phase', '_apply_mod_requests', self._apply_mod_requests, timestamp)
+            profiler.call('phase', '_expire_orders', self._expire_orders, timestamp)
+            profiler.call('phase', '_update_order_lists', self._update_order_lists)
+        self._get_new_orders(timestamp, bar_idx)
 
-            for market_sim in self.market_sims:
-                trades += market_sim(self, timestamp, ready_orders)
+        ready_orders = self.order_book.ready_orders()
+        trades: list[Trade] = []
 
-            if self.log_trades:
-                for trade in trades:
-                    _logger.info(f'TRADE: {trade}')
+        for i, market_sim in enumerate(self.market_sims):
+            if profiler is None:
+                trades += market_sim(self, timestamp, ready_orders)
+            else:
+                trades += profiler.call('market_sim', self.market_sim_names[i], market_sim, self, timestamp, ready_orders)
 
+        if self.log_trades:
             for trade in trades:
-                self.trade_history.append(trade)
+                _logger.info(f'TRADE: {trade}')
 
-            for trade in trades:
-                self.account.update_cash(-trade.qty * trade.contract.multiplier * trade.price)
-                self.account.update_position(trade.contract.symbol, trade.qty)
+        for trade in trades:
+            self.trade_history.append(trade)
+        # catches up on any trades appended to trade_history directly, so tracker trade indices match the log
+        self.roundtrips.update(self.trade_history)
 
-            for trade in trades:
-                for trade_callback in self.trade_callbacks:
+        for trade in trades:
+            self.account.apply_trade(trade)
+
+        for trade in trades:
+            for trade_callback in self.trade_callbacks:
+                if profiler is None:
                     trade_callback(self, timestamp, trade)
+                else:
+                    profiler.call('trade_callback', callable_name(trade_callback), trade_callback, self, timestamp, trade)
+
+    def run(self, skip_idle: bool = False, checkpoint_dir: str | None = None, checkpoint_interval: int = 100_000) -> None:
+        '''
+        Process market timestamps, starting from next_bar_idx so a strategy loaded using resume continues where it left off
+
+        Args:
+            skip_idle: If set, we jump directly to the next bar where a rule is enabled, an order is ready to trade or 
+                a pending order modification becomes active, instead of processing every bar.  Market sims are not called 
+                for the skipped bars, so only use this if your market sims don't need to see every bar.  Default False
+            checkpoint_dir: If set, we save a checkpoint to this directory every checkpoint_interval bars.  See checkpoint
+            checkpoint_interval: Number of bars between checkpoints.  Default 100,000
+        '''
+        timestamps = self.timestamps
+        idx = self.next_bar_idx
+        assert_(idx == 0 or idx < len(timestamps),
+                'all market timestamps have already been run, call set_market_timestamps to run over new timestamps')
+        if skip_idle: idx = self._next_active_index(idx)
+        last_checkpoint_idx = idx
+        while idx < len(timestamps):
+            self._process_bar(timestamps[idx], idx)
+            self.next_bar_idx = idx + 1
+            if checkpoint_dir is not None and self.next_bar_idx - last_checkpoint_idx >= checkpoint_interval:
+                self.checkpoint(checkpoint_dir)
+                last_checkpoint_idx = self.next_bar_idx
+            idx = self._next_active_index(idx + 1) if skip_idle else idx + 1
+        self.next_bar_idx = len(timestamps)
+
+    def checkpoint(self, dirname: str) -> None:
+        '''
+        Save the state of this strategy to a directory so a run can be continued using resume.
+        Trade history is appended to what was saved by previous checkpoints to the same directory.
+        Rules, market sims and callbacks must be picklable
+        '''
+        save_checkpoint(self, dirname)
+
+    @staticmethod
+    def resume(dirname: str) -> 'Strategy':
+        '''
+        Load a strategy from the latest checkpoint in a directory.  Call run to continue processing
+        '''
+        strategy = Strategy.__new__(Strategy)
+        strategy.__dict__.update(load_checkpoint(dirname))
+        return strategy
+
+    def _bar_index(self, timestamp: np.datetime64) -> int:
+        '''Index of timestamp in market timestamps or -1 if it is not one of them'''
+        idx = self._step_idx
+        timestamps = self.timestamps
+        if idx >= len(timestamps) or timestamps[idx] != timestamp:
+            idx = int(np.searchsorted(timestamps, timestamp))
+            if idx == len(timestamps) or timestamps[idx] != timestamp: return -1
+        self._step_idx = idx + 1
+        return idx
+
+    def _record_stepped(self, timestamp: np.datetime64) -> None:
+        stepped = self._stepped_timestamps
+        if stepped is None:
+            stepped = self._stepped_timestamps = np.empty(1024, dtype=np.asarray(timestamp).dtype)
+        elif self._num_stepped == len(stepped):
+            stepped = self._stepped_timestamps = np.concatenate([stepped, np.empty_like(stepped)])
+        stepped[self._num_stepped] = timestamp
+        self._num_stepped += 1
+
+    def bar_timestamps(self) -> np.ndarray:
+        '''
+        Market timestamps plus the timestamps of any bars passed to step that are not market timestamps.
+        Pnl, equity curves and metrics are computed at these
+        '''
+        if self._stepped_timestamps is None: return self.timestamps
+        stepped = self._stepped_timestamps[:self._num_stepped]
+        if not len(self.timestamps): return stepped.copy()
+        return np.union1d(self.timestamps, stepped)
+
+    def step(self, timestamp: np.datetime64, bar: Any = None) -> None:
+        '''
+        Process a single bar.  Use this instead of run when bars come from a feed or a generator rather than the market timestamps.
+        Market timestamps are optional.  Bars that are not market timestamps are recorded, see bar_timestamps, and rules
+        enabled for specific timestamps run on them if they were enabled for that exact timestamp.
+
+        Args:
+            timestamp: Time of the bar.  Must be greater than the timestamp of the previous call
+            bar: Any data for the bar, made available to rules, market sims and callbacks as strategy.current_bar.  Default None
+        '''
+        assert_(bool(self._last_step_timestamp is None or timestamp > self._last_step_timestamp),
+                f'timestamp: {timestamp} must be after previous timestamp: {self._last_step_timestamp}')
+        self.current_bar = bar
+        bar_idx = self._bar_index(timestamp)
+        if bar_idx == -1: self._record_stepped(timestamp)
+        self._process_bar(timestamp, bar_idx)
+        self._last_step_timestamp = timestamp
+
+    def run_stream(self, bars: Iterable[Any]) -> None:
+        '''
+        Process bars one at a time from an iterable such as a generator reading a tick file.
+        Each item is either a timestamp or a (timestamp, bar) tuple.  See step
+        '''
+        for item in bars:
+            if isinstance(item, tuple):
+                self.step(item[0], item[1])
+            else:
+                self.step(item)
 
     def get_daily_pnl(self, 
-                      prices: dict[tuple[str, np.datetime64], float], 
+                      prices: PriceSourceType, 
                       pnl_time: int = 15 * 60 + 59,
                       fixed_equity: bool = False) -> pd.DataFrame:
-        timestamps = np.unique(self.timestamps.astype('M8[D]')) + np.timedelta64(pnl_time, 'm')
-        trades = roundtrip_trades(self.trade_history)
-        pnl = get_pnl(trades, timestamps, prices)
-        df = pd.DataFrame.from_records(pnl, columns=['trade_id', 'timestamp', 'unrealized', 'realized', 'commission'])
+        timestamps = np.unique(self.bar_timestamps().astype('M8[D]')) + np.timedelta64(pnl_time, 'm')
+        pnl = self.get_pnl_arrays(timestamps, prices)
+        df = pd.DataFrame({name: pnl[name] for name in ['timestamp', 'unrealized', 'realized', 'commission']})
         df['pnl'] = df.unrealized + df.realized + df.commission
         df = df[['timestamp', 'pnl', 'unrealized', 'realized', 'commission']].groupby('timestamp', as_index=False).sum()
         df['equity'] = self.initial_cash + df.pnl.cumsum()
@@ -423,24 +682,83 @@ class Strategy:
             df['ret'] = df.equity.pct_change()
         return df
 
+    def get_pnl_arrays(self, timestamps: np.ndarray, prices: PriceSourceType) -> dict[str, np.ndarray]:
+        '''
+        Pnl of each roundtrip at timestamps computed from the tracked roundtrips and trade history columns, without
+        creating RoundTripTrade objects.  trade_idx in the output is the index of the roundtrip in roundtrip_trades().
+        See pnl.trade_pnl_arrays
+        '''
+        rts = self._roundtrip_arrays()
+        trade_log = self.trade_history
+        entry_idx, exit_idx = rts['entry_idx'], rts['exit_idx']
+        is_closed = exit_idx != -1
+        exit_timestamp = np.where(is_closed, trade_log.timestamp[np.where(is_closed, exit_idx, 0)], np.datetime64('NaT'))
+        symbols = np.array(trade_log.symbols, dtype=object)[trade_log.symbol_id[entry_idx]]
+        return trade_pnl_arrays(symbols, trade_log.timestamp[entry_idx], exit_timestamp, 
+                                rts['qty'], rts['entry_price'], rts['exit_price'], trade_log.multiplier()[entry_idx], 
+                                rts['entry_commission'], rts['exit_commission'], timestamps, prices)
+
+    def get_equity_curve(self, 
+                         prices: PriceSourceType, 
+                         freq: str | None = None, 
+                         timestamps: np.ndarray | None = None,
+                         ffill: bool = True) -> pd.DataFrame:
+        '''
+        Mark to market equity, cash and long, short, net and gross exposure from the trade history.  See pnl.equity_curve
+        Args:
+            freq: if set, e.g. '5m' or '1D', use the last bar timestamp in each interval instead of every bar timestamp
+            timestamps: timestamps to use instead of bar_timestamps()
+        '''
+        if timestamps is None: timestamps = self.bar_timestamps()
+        if freq is not None: timestamps = resample_timestamps(timestamps, freq)
+        return pd.DataFrame(equity_curve(self.trade_history, timestamps, prices, self.initial_cash, ffill))
+
+    def _roundtrip_arrays(self) -> dict[str, np.ndarray]:
+        # catch up with any trades added to the trade history directly rather than through run
+        self.roundtrips.update(self.trade_history)
+        return self.roundtrips.to_arrays()
+
+    def roundtrip_trades(self, deep_copy: bool = False) -> list[RoundTripTrade]:
+        '''Roundtrips from the trades done so far, using the roundtrips tracked during the run'''
+        return roundtrip_trades(self.trade_history, deep_copy, self._roundtrip_arrays())
+
     def df_roundtrip_trades(self) -> pd.DataFrame:
-        trades = roundtrip_trades(self.trade_history)
-        rt_trades = df_roundtrip_trades(trades)
-        return rt_trades
+        return fifo_match_df(self.trade_history, self._roundtrip_arrays())
 
     def evaluate(self, 
-                 close_prices: dict[tuple[str, np.datetime64], float], 
+                 close_prices: PriceSourceType, 
                  fixed_equity: bool = False, 
-                 show: bool = True) -> tuple[pd.DataFrame, go.Figure]:
+                 show: bool = True,
+                 freq: str | None = None,
+                 max_points: int | None = None) -> tuple[pd.DataFrame, go.Figure]:
         '''
         Args:
             fixed_equity: if set, we assume sizing of trades was done according to initial cash, not the current equity
             built up at the time the trade was done. For example, if starting cash is $1e6 and we size each trade to 10% of equity
             then each trade size would be $1e5
+            freq: if set, e.g. '5m' or '1h', compute metrics on returns at this frequency instead of daily returns
+            max_points: if set, downsample the plots to about this many points.  See metrics.plot_metrics
+        '''
+        metrics = self.compute_metrics(close_prices, fixed_equity, freq)
+        df = metrics.to_df()
+        fig = plot_metrics(metrics, max_points=max_points)
+        if show:
+            from IPython.display import display
+            display(df)
+            fig.show()
+
+        return (df, fig)
+
+    def compute_metrics(self, close_prices: PriceSourceType, fixed_equity: bool = False, freq: str | None = None) -> Metrics:
+        '''
+        Compute return metrics from daily pnl, or from the mark to market equity curve sampled at freq if set.
+        See evaluate for arguments
         '''
+        if freq is not None: return self._compute_intraday_metrics(close_prices, fixed_equity, freq)
         pnl = self.get_daily_pnl(close_prices, fixed_equity=fixed_equity)
-        start_date = self.timestamps[0].astype('M8[D]')
-        end_date = self.timestamps[-1].astype('M8[D]')
+        bar_timestamps = self.bar_timestamps()
+        start_date = bar_timestamps[0].astype('M8[D]')
+        end_date = bar_timestamps[-1].astype('M8[D]')
         assert self.calendar is not None
         trading_days = self.calendar.get_trading_days(start_date, end_date, include_first=True, include_last=True)
         ret_df = pd.DataFrame({'timestamp': pnl.timestamp.values, 'ret': pnl.ret.values})
@@ -448,20 +766,111 @@ class Strategy:
         ret_df['date'] = ret_df.timestamp.values.astype('M8[D]')
         ret_df = ret_df.drop_duplicates(subset=['date'], keep='last')
         ret_df = ret_df[['date', 'ret']].set_index('date').reindex(trading_days, fill_value=0.).reset_index()
-        metrics = compute_return_metrics(ret_df.date.values.astype('M8[D]'), ret_df.ret.values, self.calendar)
-        df = metrics.to_df()
-        fig = plot_metrics(metrics)
-        if show:
-            display(df)
-            fig.show()
+        return compute_return_metrics(ret_df.date.values.astype('M8[D]'), ret_df.ret.values, self.calendar)
 
-        return (df, fig)
+    def _compute_intraday_metrics(self, close_prices: PriceSourceType, fixed_equity: bool, freq: str) -> Metrics:
+        assert self.calendar is not None
+        curve = self.get_equity_curve(close_prices, freq)
+        equity = np.concatenate([[self.initial_cash], curve.equity.values])
+        if fixed_equity:
+            rets = np.diff(equity) / self.initial_cash
+        else:
+            rets = equity[1:] / equity[:-1] - 1
+        rets = np.where(np.isnan(rets), 0., rets)
+        return compute_intraday_metrics(curve.timestamp.values, rets, self.calendar, freq)
 
 
 @dataclass
 class Account:
+    '''
+    Cash and positions, plus a cache of the market value of open positions as of the last timestamp they were marked at.
+    Trades applied with apply_trade keep the cache valid, so equity is O(1) for repeated calls on the same bar and a new bar
+    only looks up prices for open positions, recomputing market value for the ones whose price changed.
+
+    >>> Contract.clear_cache()
+    >>> contract = Contract.create('ES', multiplier=50)
+    >>> timestamp = np.datetime64('2024-01-02 09:30')
+    >>> prices = {('ES', timestamp): 100., ('ES', timestamp + np.timedelta64(1, 'm')): 101.}
+    >>> account = Account(cash=1e5)
+    >>> account.apply_trade(Trade(contract, None, timestamp, 2, 99.))
+    >>> assert account.equity(timestamp, prices) == 1e5 + 100. and account.open_symbols == {'ES'}
+    >>> account.apply_trade(Trade(contract, None, timestamp, 1, 100.))
+    >>> assert account.equity(timestamp, prices) == 1e5 + 100.
+    >>> assert account.equity(timestamp + np.timedelta64(1, 'm'), prices) == 1e5 + 250.
+    '''
     cash: float
-    positions: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+    positions: defaultdict[str, float] = field(default_factory=lambda: defaultdict(int))
+    multipliers: dict[str, float] = field(default_factory=dict)  # symbol -> contract multiplier
+    open_symbols: set[str] = field(default_factory=set)  # symbols with a non-zero position
+    marks: dict[str, float] = field(default_factory=dict)  # symbol -> price open positions were last marked at
+    market_values: dict[str, float] = field(default_factory=dict)  # symbol -> market value of open positions at marks
+    mark_timestamp: np.datetime64 | None = None  # timestamp of marks, None if the cache is invalid
+    registry: ContractRegistry | None = field(default=None, repr=False)  # used to look up multipliers, default Contract.registry
+    _prices: Any = field(default=None, repr=False, compare=False)  # price source used for marks, compared by identity
+    _market_value: float = field(default=0., repr=False)  # sum of market_values
+
+    def apply_trade(self, trade: Trade) -> None:
+        '''Update cash and position for a trade, keeping cached market value in sync at the current mark'''
+        symbol = trade.contract.symbol
+        multiplier = trade.contract.multiplier
+        self.multipliers[symbol] = multiplier
+        self.update_cash(-trade.qty * multiplier * trade.price)
+        position = self.positions[symbol] + trade.qty
+        self.positions[symbol] = position
+        if position == 0:
+            self.open_symbols.discard(symbol)
+        else:
+            self.open_symbols.add(symbol)
+        if self.mark_timestamp is None: return
+        mark = self.marks.get(symbol)
+        if mark is None:
+            # newly opened, price is looked up on the next call to equity
+            self.mark_timestamp = None
+            return
+        market_value = position * mark * multiplier
+        self._market_value += market_value - self.market_values.get(symbol, 0.)
+        if position == 0:
+            self.market_values.pop(symbol, None)
+            self.marks.pop(symbol, None)
+        else:
+            self.market_values[symbol] = market_value
+
+    def equity(self, timestamp: np.datetime64, prices: PriceSourceType) -> float:
+        '''
+        Cash plus market value of open positions at timestamp, NaN if a price is missing.
+        Marks are cached for the last timestamp and price source, call invalidate_marks after changing their prices in place
+        '''
+        if self.mark_timestamp is None or self.mark_timestamp != timestamp or self._prices is not prices:
+            self._mark(timestamp, prices)
+        return self.cash + self._market_value
+
+    def invalidate_marks(self) -> None:
+        '''Look up prices again on the next call to equity'''
+        self.mark_timestamp = None
+        self._prices = None
+
+    def _mark(self, timestamp: np.datetime64, prices: PriceSourceType) -> None:
+        market_value = 0.
+        for symbol in self.open_symbols:
+            price = prices.get((symbol, timestamp))
+            if price is None:
+                _logger.warning(f'could not find price for: {symbol} {timestamp}')
+                price = math.nan
+            if price != self.marks.get(symbol) or symbol not in self.market_values:
+                multiplier = self.multipliers.get(symbol)
+                if multiplier is None:
+                    contract = (self.registry if self.registry is not None else Contract.registry).get(symbol)
+                    assert contract is not None
+                    multiplier = self.multipliers[symbol] = contract.multiplier
+                self.marks[symbol] = price
+                self.market_values[symbol] = self.positions[symbol] * price * multiplier
+            market_value += self.market_values[symbol]
+        for symbol in [symbol for symbol in self.market_values if symbol not in self.open_symbols]:
+            del self.market_values[symbol]
+            self.marks.pop(symbol, None)
+        self._market_value = market_value
+        self.mark_timestamp = timestamp
+        self._prices = prices
 
     def update_cash(self, add_amount: float) -> None:
         cash = self.cash
@@ -470,8 +879,22 @@ class Account:
         self.cash += add_amount
         _logger.debug(f'removed cash: {add_amount} new cash: {self.cash}')
 
-    def update_position(self, name: str, add_amount: int) -> None:
+    def update_position(self, name: str, add_amount: float) -> None:
+        '''Prefer apply_trade, this invalidates cached market values'''
         self.positions[name] += add_amount
+        if self.positions[name] == 0:
+            self.open_symbols.discard(name)
+        else:
+            self.open_symbols.add(name)
+        self.market_values.pop(name, None)
+        self.mark_timestamp = None
+
+    def __getstate__(self) -> dict[str, Any]:
+        # don't save the price source with the account, e.g. in checkpoints
+        state = dict(self.__dict__)
+        state['_prices'] = None
+        state['mark_timestamp'] = None
+        return state
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import pandas as pd
+from typing import Any, Callable
+from btlite.bt_utils import assert_, get_child_logger
+from btlite.holiday_calendars import Calendar
+from btlite.price_store import PriceStore, PriceSourceType, to_price_store
+from btlite.strategy import Strategy
+
+_logger = get_child_logger(__name__)
+
+StrategyFactoryType = Callable[[dict[str, Any], PriceStore], Strategy]
+
+# Set in each worker process by _init_worker
+_worker_prices: PriceStore | None = None
+_worker_shms: list[SharedMemory] = []
+
+
+def expand_param_grid(param_grid: dict[str, list[Any]] | list[dict[str, Any]]) -> list[dict[str, Any]]:
+    '''
+    Returns one dict of parameters per run.  A dict of lists is expanded to the cartesian product of its values,
+    a list of dicts is returned as is
+
+    >>> assert expand_param_grid({'a': [1, 2], 'b': ['x']}) == [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'x'}]
+    '''
+    if isinstance(param_grid, list): return param_grid
+    names = list(param_grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+
+
+def _to_shared_memory(array: np.ndarray) -> SharedMemory:
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def _attach_shared_memory(name: str, shape: tuple[int, ...], dtype: str) -> np.ndarray:
+    shm = SharedMemory(name=name)
+    _worker_shms.append(shm)  # keep a reference so the buffer stays mapped for the life of the worker
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_worker(symbols: list[str],
+                 timestamps_shm: tuple[str, tuple[int, ...], str],
+                 prices_shm: tuple[str, tuple[int, ...], str]) -> None:
+    global _worker_prices
+    timestamps = _attach_shared_memory(*timestamps_shm)
+    prices = _attach_shared_memory(*prices_shm)
+    prices.flags.writeable = False
+    _worker_prices = PriceStore(symbols, timestamps, prices)
+
+
+def _run_one(strategy_factory: StrategyFactoryType,
+             params: dict[str, Any],
+             run_id: int,
+             prices: PriceStore | None,
+             fixed_equity: bool,
+             include_trades: bool,
+             calendar: str) -> tuple[int, pd.DataFrame, pd.DataFrame | None]:
+    if prices is None: prices = _worker_prices
+    assert prices is not None
+    strategy = strategy_factory(params, prices)
+    strategy.run()
+    if strategy.calendar is None: strategy.calendar = Calendar(calendar)
+    metrics_df = strategy.compute_metrics(prices, fixed_equity).to_df()
+    metrics_df.insert(0, 'run_id', run_id)
+    for i, (name, value) in enumerate(params.items()):
+        metrics_df.insert(i + 1, name, [value])
+    trades_df = None
+    if include_trades:
+        trades_df = strategy.df_roundtrip_trades()
+        trades_df.insert(0, 'run_id', run_id)
+    return run_id, metrics_df, trades_df
+
+
+def run_sweep(strategy_factory: StrategyFactoryType,
+              param_grid: dict[str, list[Any]] | list[dict[str, Any]],
+              prices: PriceSourceType,
+              fixed_equity: bool = False,
+              include_trades: bool = False,
+              max_workers: int | None = None,
+              calendar: str = 'NYSE') -> tuple[pd.DataFrame, dict[int, pd.DataFrame]]:
+    '''
+    Run a strategy once per parameter combination across a process pool and collect return metrics
+
+    Args:
+        strategy_factory: A picklable (i.e. module level) function that takes a dict of parameters and the prices
+            and returns a Strategy ready to run.  The same prices are used to compute metrics after the run
+        param_grid: Either a dict of parameter name -> list of values, expanded to all combinations, or a list of dicts
+        prices: Read only prices shared by all runs.  These are copied once into shared memory and not pickled per run
+        fixed_equity: See Strategy.evaluate
+        include_trades: If set, we also return the roundtrip trades for each run
+        max_workers: Number of worker processes.  If 1 we run in this process which is useful for debugging.
+            Default None, i.e. one per cpu
+        calendar: Calendar used to compute metrics for strategies that don't have one set.  Default NYSE
+    Return:
+        A dataframe with one row per run containing the run_id, parameters and Metrics.to_df() columns,
+        and a dict of run_id -> roundtrip trades dataframe if include_trades is set
+    '''
+    price_store = to_price_store(prices)
+    all_params = expand_param_grid(param_grid)
+    results: list[tuple[int, pd.DataFrame, pd.DataFrame | None]] = []
+
+    if max_workers is None: max_workers = os.cpu_count()
+    if max_workers == 1:
+        for run_id, params in enumerate(all_params):
+            results.append(_run_one(strategy_factory, params, run_id, price_store, fixed_equity, include_trades, calendar))
+    else:
+        timestamps = np.ascontiguousarray(price_store.timestamps)
+        matrix = np.ascontiguousarray(price_store.prices)
+        shms = [_to_shared_memory(timestamps), _to_shared_memory(matrix)]
+        try:
+            initargs = (list(price_store.symbols),
+                        (shms[0].name, timestamps.shape, timestamps.dtype.str),
+                        (shms[1].name, matrix.shape, matrix.dtype.str))
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=initargs) as executor:
+                futures = [executor.submit(_run_one, strategy_factory, params, run_id, None, fixed_equity, include_trades, calendar)
+                           for run_id, params in enumerate(all_params)]
+                for future in futures:
+                    results.append(future.result())
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    assert_(len(results) == len(all_params))
+    metrics_df = pd.concat([result[1] for result in results], ignore_index=True) if len(results) else pd.DataFrame()
+    trades = {result[0]: result[2] for result in results if result[2] is not None}
+    return metrics_df, trades
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -4,11 +4,22 @@
 from dataclasses import dataclass, field
 import pandas as pd
 import numpy as np
-from typing import cast
+from typing import Callable, cast
 import math
+import pickle
+import tempfile
 from types import SimpleNamespace
-from btlite.bt_types import Trade, Order, Contract, TimeInForce
-from btlite.strategy import Strategy, roundtrip_trades, get_pnl, get_pnl_df
+from btlite.bt_types import Trade, Order, Contract, ContractRegistry, TimeInForce, OrderStatus, ModRequest, ModificationType
+from btlite.strategy import Strategy, Account, roundtrip_trades, df_roundtrip_trades, get_pnl, get_pnl_df
+from btlite.roundtrips import RoundTripTracker, fifo_match, fifo_match_df
+from btlite.trade_log import TradeLog
+from btlite.price_store import PriceStore
+from btlite.baskets import BasketMatrix
+from btlite.rolling_metrics import OnlineMetrics, rolling_return_metrics
+from btlite.metrics import Metrics, compute_return_metrics, compute_return_metrics_batch, compute_intraday_metrics, bootstrap_return_metrics, plot_metrics
+from btlite.holiday_calendars import Calendar
+from btlite.sweep import run_sweep
+from btlite.bt_utils import PQException
 
 
 class EntryRule:
@@ -104,6 +115,12 @@ class MarketSim:
         return trades
 
 
+class NullMarketSim:
+    '''Does not fill anything'''
+    def __call__(self, strategy: Strategy, timestamp: np.datetime64, orders: list[Order]) -> list[Trade]:
+        return []
+
+
 def get_prices(df: pd.DataFrame) -> dict[np.datetime64, float]:
     timestamps = df.timestamp.values.astype('M8[m]')
     c = df.c.values
@@ -111,22 +128,54 @@ def get_prices(df: pd.DataFrame) -> dict[np.datetime64, float]:
     return prices
 
 
-def test_simple_strat() -> None:
+def _simple_prices() -> tuple[np.ndarray, dict[np.datetime64, float]]:
+    '''6 minute bars used by test_simple_strat and tests that check analytics on its trades'''
     timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:06'))
-    df = pd.DataFrame({'timestamp': timestamps})
-    df['ret'] = [0.01, -0.01, 0.02, -0.005, 0.01, 0.03]
-    df['c'] = (1 + df.ret).cumprod() * 10.
-    df['date'] = df.timestamp.values.astype('M8[D]')
-    df['eod'] = [False, False, False, True, True, True]
+    close = (1 + np.array([0.01, -0.01, 0.02, -0.005, 0.01, 0.03])).cumprod() * 10.
+    return timestamps, dict(zip(timestamps, close))
+
+
+def _sine_prices() -> tuple[np.ndarray, dict[np.datetime64, float]]:
+    '''An hour of minute bars with prices oscillating around 10'''
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 10:00'))
+    close = 10. + np.sin(np.arange(len(timestamps)) / 5.)
+    return timestamps, dict(zip(timestamps, close))
+
+
+def _make_strategy(timestamps: np.ndarray,
+                   prices: dict[np.datetime64, float],
+                   entry_threshold: float,
+                   market_sim: Callable[[dict[np.datetime64, float]], MarketSim] = MarketSim,
+                   exit_timestamps: np.ndarray | None = None,
+                   market_timestamps: bool = True) -> Strategy:
+    '''
+    Buy AAPL with EntryRule on bars where the price is above entry_threshold and exit with ExitRule at exit_timestamps,
+    by default every 20th bar.  If market_timestamps is False we don't call set_market_timestamps, e.g. for run_stream
+    '''
+    close = np.array([prices[timestamp] for timestamp in timestamps])
+    if exit_timestamps is None: exit_timestamps = timestamps[np.arange(len(timestamps)) % 20 == 19]
     strategy = Strategy()
-    strategy.set_market_timestamps(timestamps)
-    prices = get_prices(df)
+    if market_timestamps: strategy.set_market_timestamps(timestamps)
     strategy.add_rule('entry', EntryRule(prices))
     strategy.add_rule('exit', ExitRule())
-    strategy.enable_rule('entry', df[df.c > 10.15].timestamp.values.astype('M8[m]'))
-    strategy.enable_rule('exit', df[df.eod].timestamp.values.astype('M8[m]'))
-    strategy.add_market_sim(MarketSim(prices))
+    strategy.enable_rule('entry', timestamps[close > entry_threshold])
+    strategy.enable_rule('exit', exit_timestamps)
+    strategy.add_market_sim(market_sim(prices))
+    return strategy
+
+
+def test_simple_strat() -> None:
+    timestamps, prices = _simple_prices()
+    strategy = _make_strategy(timestamps, prices, 10.15, exit_timestamps=timestamps[3:])
     strategy.run()
+    assert strategy.enabled_rules[timestamps[4]] == {'entry', 'exit'} and strategy.enabled_rules[timestamps[0]] == set()
+    num_trades = len(strategy.trade_history)
+    try:
+        strategy.run()
+        assert False, 'expected running a finished strategy to fail'
+    except PQException as e:
+        assert 'already been run' in str(e)
+    assert len(strategy.trade_history) == num_trades
 
 
 def test_stop_strat() -> None:
@@ -163,7 +212,604 @@ def test_stop_strat() -> None:
     assert math.isclose(row.pnl, 18798.347856)
 
 
+def test_profiling() -> None:
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:06'))
+    df = pd.DataFrame({'timestamp': timestamps})
+    df['ret'] = [0.01, 0.02, 0, 0.2, -0.01, 0.03]
+    df['c'] = (1 + df.ret).cumprod() * 10.
+    df['eod'] = [False, False, False, False, True, True]
+    strategy = Strategy()
+    strategy.enable_profiling()
+    strategy.set_market_timestamps(timestamps)
+    prices = get_prices(df)
+    strategy.add_rule('exit', ExitRule())
+    strategy.add_rule('stop', StopRule())
+    strategy.add_rule('entry', EntryRule(prices))
+    strategy.add_trade_callback(TradeCallback(prices))
+    strategy.enable_rule('entry', df[df.c > 10.15].timestamp.values.astype('M8[m]'))
+    strategy.enable_rule('exit', df[df.eod].timestamp.values.astype('M8[m]'))
+    strategy.add_market_sim(MarketSim(prices))
+    strategy.add_market_sim(NullMarketSim())
+    strategy.add_market_sim(NullMarketSim())
+    strategy.add_market_sim(NullMarketSim(), name='null')
+    strategy.run()
+    profile = strategy.get_profile().set_index(['kind', 'name'])
+    assert profile.loc[('phase', '_apply_mod_requests')].calls == len(timestamps)
+    # market sims of the same class get their own rows
+    for name in ['MarketSim', 'NullMarketSim', 'NullMarketSim_2', 'null']:
+        assert profile.loc[('market_sim', name)].calls == len(timestamps)
+    assert profile.loc[('rule', 'entry')].calls == (df.c > 10.15).sum()
+    assert profile.loc[('trade_callback', 'TradeCallback')].calls == len(strategy.trade_history)
+
+
+def _fifo_reference(trades: list[Trade]) -> list[tuple[int, int, float, float]]:
+    '''Scalar FIFO matching returning (entry index, exit index, qty, net pnl) with exit index -1 for open lots'''
+    lots: dict[str, list[list]] = {}
+    rts = []
+    for i, trade in enumerate(trades):
+        stack = lots.setdefault(trade.contract.symbol, [])
+        qty = trade.qty
+        while qty != 0 and len(stack) and np.sign(stack[0][1]) != np.sign(qty):
+            entry_idx, entry_qty = stack[0]
+            matched = min(abs(entry_qty), abs(qty)) * np.sign(entry_qty)
+            entry = trades[entry_idx]
+            commission = entry.commission * abs(matched / entry.qty) + trade.commission * abs(matched / trade.qty)
+            rts.append((entry_idx, i, matched, matched * (trade.price - entry.price) * trade.contract.multiplier - commission))
+            stack[0][1] -= matched
+            qty += matched
+            if stack[0][1] == 0: stack.pop(0)
+        if qty != 0: stack.append([i, qty])
+    rts += [(entry_idx, -1, qty, 0.) for stack in lots.values() for entry_idx, qty in stack]
+    return sorted(rts, key=lambda rt: (rt[0], rt[1] if rt[1] != -1 else len(trades)))
+
+
+def test_roundtrip_trades() -> None:
+    Contract.clear_cache()
+    contracts = [Contract.create('AAPL'), Contract.create('ES', multiplier=50)]
+    rng = np.random.default_rng(0)
+    trade_log = TradeLog()
+    trades = []
+    for i in range(200):
+        contract = contracts[rng.integers(2)]
+        qty = float(rng.choice([-3, -2, -1, 1, 2, 3]))
+        order = Order(order_id=str(i), contract=contract, timestamp=np.datetime64('2024-01-02 09:00'), qty=qty, reason_code='X')
+        trade = Trade(contract, order, np.datetime64('2024-01-02 09:00') + np.timedelta64(i, 'm'), qty,
+                      float(rng.uniform(90, 110)), 0., float(rng.uniform(0, 1)))
+        trades.append(trade)
+        trade_log.append(trade)
+    expected = _fifo_reference(trades)
+    tracker = RoundTripTracker()
+    tracker.update(trade_log)
+    tracked = roundtrip_trades(trade_log, rts=tracker.to_arrays())
+    assert math.isclose(tracker.realized_pnl(), sum(rt.net_pnl for rt in tracked))
+    assert tracker.open_lots('ES') == [(rt.entry_properties.entry_index, rt.qty, rt.entry_price) 
+                                       for rt in tracked if rt.exit_order is None and rt.contract.symbol == 'ES']
+    for rts in [roundtrip_trades(trades), roundtrip_trades(trade_log), tracked]:
+        assert len(rts) == len(expected)
+        for rt, (entry_idx, exit_idx, qty, net_pnl) in zip(rts, expected):
+            assert rt.entry_properties.entry_index == entry_idx and rt.qty == qty and math.isclose(rt.net_pnl, net_pnl, abs_tol=1e-9)
+            assert rt.exit_order is (trades[exit_idx].order if exit_idx != -1 else None)
+    dfs = [fifo_match_df(trade_log), df_roundtrip_trades(roundtrip_trades(trades))]
+    for i, df in enumerate(dfs):
+        dfs[i] = df.astype({'entry_timestamp': 'M8[ns]', 'exit_timestamp': 'M8[ns]'}).reset_index(drop=True)
+    pd.testing.assert_frame_equal(dfs[0], dfs[1])
+
+
+def test_fifo_fractional() -> None:
+    # fractional quantities don't sum exactly, so matching must not depend on exact float equality or mix up symbols
+    rng = np.random.default_rng(1)
+    for _ in range(100):
+        num_trades = int(rng.integers(1, 40))
+        symbol_id = rng.integers(0, 3, num_trades)
+        qty = np.round(rng.choice([-1., 1.], num_trades) * rng.uniform(0.1, 1., num_trades), 1)
+        price, commission = rng.uniform(90, 110, num_trades), rng.uniform(0, 1, num_trades)
+        rts = fifo_match(symbol_id, qty, price, commission, np.ones(num_trades))
+        tracker = RoundTripTracker()
+        for i in range(num_trades):
+            tracker.add(str(symbol_id[i]), qty[i], price[i], commission[i])
+        expected = tracker.to_arrays()
+        assert np.array_equal(rts['entry_idx'], expected['entry_idx']) and np.array_equal(rts['exit_idx'], expected['exit_idx'])
+        for name in ['qty', 'net_pnl', 'entry_commission', 'exit_commission']:
+            assert np.allclose(rts[name], expected[name], equal_nan=True), name
+        closed = rts['exit_idx'] != -1
+        assert np.all(symbol_id[rts['entry_idx'][closed]] == symbol_id[rts['exit_idx'][closed]])
+        assert np.all(rts['exit_idx'][closed] > rts['entry_idx'][closed])
+    rts = fifo_match(np.array([0, 0, 1, 1]), np.array([0.1, 0.2, 0.3, -0.3]), np.array([1., 1., 1., 2.]), np.zeros(4), np.ones(4))
+    assert list(rts['exit_idx']) == [-1, -1, 3] and math.isclose(rts['net_pnl'][2], 0.3)
+
+
+def test_direct_trade_append() -> None:
+    # trades appended to trade_history outside of run are picked up by the roundtrip tracker before the next trade
+    Contract.clear_cache()
+    contract = Contract.create('AAPL')
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:03'))
+    prices = {timestamp: 10. + i for i, timestamp in enumerate(timestamps)}
+    strategy = Strategy()
+    strategy.set_market_timestamps(timestamps)
+    order = Order(order_id='direct', contract=contract, timestamp=timestamps[0], qty=10)
+    strategy.trade_history.append(Trade(contract, order, timestamps[0], 10, 10.))
+    strategy.add_rule('exit', lambda strategy, timestamp: [Order(order_id='exit', contract=contract, timestamp=timestamp, qty=-5)])
+    strategy.enable_rule('exit', timestamps[:1])
+    strategy.add_market_sim(MarketSim(prices))
+    strategy.run()
+    df = strategy.df_roundtrip_trades().reset_index(drop=True)
+    pd.testing.assert_frame_equal(df, fifo_match_df(strategy.trade_history).reset_index(drop=True))
+    assert list(df.qty) == [5., 5.] and list(df.net_pnl) == [5., 0.]
+
+
+def test_pnl_arrays() -> None:
+    Contract.clear_cache()
+    contract = Contract.create('AAPL', multiplier=2)
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:10'))
+    prices = PriceStore(['AAPL'], timestamps, (10. + np.arange(len(timestamps), dtype=float)).reshape(1, -1))
+    strategy = Strategy()
+    strategy.set_market_timestamps(timestamps)
+    for i, (qty, idx) in enumerate([(10, 1), (-4, 3), (-10, 6)]):
+        order = Order(order_id=str(i), contract=contract, timestamp=timestamps[idx], qty=qty)
+        strategy.trade_history.append(Trade(contract, order, timestamps[idx], qty, prices.get_at(0, idx), 0., 1., 
+                                            properties=SimpleNamespace(trade_id=str(i))))
+    rts = strategy.roundtrip_trades()
+    assert [rt.exit_order is None for rt in rts] == [False, False, True]
+    pnl = strategy.get_pnl_arrays(timestamps[::2], prices)
+    price_dict = {('AAPL', timestamp): prices.get_at(0, i) for i, timestamp in enumerate(timestamps)}
+    expected = get_pnl_df(get_pnl(rts, timestamps[::2], price_dict))
+    assert list(pnl['timestamp']) == list(expected.timestamp)
+    for name in ['unrealized', 'realized', 'commission']:
+        assert np.allclose(pnl[name], expected[name].values)
+    # realized 4 * (13 - 11) and 6 * (16 - 11) plus the open short of 4 from 16 marked at 18 on the last timestamp
+    assert math.isclose(pnl['unrealized'].sum() + pnl['realized'].sum(), (8. + 30. - 8.) * 2)
+
+
+def test_equity_curve() -> None:
+    Contract.clear_cache()  # other tests create AAPL with a different multiplier
+    timestamps, prices = _sine_prices()
+    strategy = _make_strategy(timestamps, prices, 10.9)
+    strategy.run()
+    assert len(strategy.trade_history) > 2
+    price_dict = {('AAPL', timestamp): price for timestamp, price in prices.items()}
+    curve = strategy.get_equity_curve(price_dict)
+    cash, position = strategy.initial_cash, 0.
+    trades = list(strategy.trade_history)
+    for i, timestamp in enumerate(timestamps):
+        while len(trades) and trades[0].timestamp <= timestamp:
+            trade = trades.pop(0)
+            cash -= trade.qty * trade.price + trade.commission + trade.fee
+            position += trade.qty
+        assert math.isclose(curve.equity.iloc[i], cash + position * prices[timestamp])
+        assert math.isclose(curve.gross_exposure.iloc[i], abs(position) * prices[timestamp])
+    daily = strategy.get_equity_curve(PriceStore.from_dict(price_dict), freq='1D')
+    assert len(daily) == 1 and math.isclose(daily.equity.iloc[0], curve.equity.iloc[-1])
+
+
+def test_account_equity() -> None:
+    Contract.clear_cache()
+    contracts = [Contract.create('AAPL'), Contract.create('ES', multiplier=50)]
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:30'))
+    rng = np.random.default_rng(1)
+    prices = PriceStore(['AAPL', 'ES'], timestamps, np.round(100. + rng.normal(size=(2, len(timestamps))).cumsum(axis=1), 1))
+    account = Account(cash=1e7)
+    for i, timestamp in enumerate(timestamps):
+        for _ in range(rng.integers(3)):
+            contract = contracts[rng.integers(2)]
+            account.apply_trade(Trade(contract, cast(Order, None), timestamp, float(rng.integers(-2, 3)), prices[(contract.symbol, timestamp)]))
+            if rng.random() < 0.5: account.equity(timestamp, prices)
+        expected = account.cash + sum(qty * prices[(symbol, timestamp)] * cast(Contract, Contract.get(symbol)).multiplier
+                                      for symbol, qty in account.positions.items())
+        assert math.isclose(account.equity(timestamp, prices), expected)
+        assert account.open_symbols == {symbol for symbol, qty in account.positions.items() if qty != 0}
+    # marks are cached per price source, so changing prices in place needs an explicit invalidation
+    timestamp = timestamps[-1]
+    price_dict = {(symbol, timestamp): prices[(symbol, timestamp)] for symbol in ['AAPL', 'ES']}
+    equity = account.equity(timestamp, price_dict)
+    price_dict[('ES', timestamp)] += 1.
+    account.invalidate_marks()
+    assert math.isclose(account.equity(timestamp, price_dict), equity + 50. * account.positions['ES'])
+    assert math.isclose(account.equity(timestamp, {**price_dict, ('ES', timestamp): price_dict[('ES', timestamp)] - 1.}), equity)
+
+
+def test_contract_registry() -> None:
+    Contract.clear_cache()
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:10'))
+    strategies = [Strategy(registry=ContractRegistry()) for _ in range(2)]
+    for multiplier, strategy in zip([1., 50.], strategies):
+        strategy.set_market_timestamps(timestamps)
+        contract = strategy.registry.create('ES', multiplier=multiplier)
+        order = Order(order_id='1', contract=contract, timestamp=timestamps[0], qty=1)
+        strategy.account.apply_trade(Trade(contract, order, timestamps[1], 1, 100.))
+        strategy.trade_history.append(Trade(contract, order, timestamps[1], 1, 100.))
+    assert not Contract.exists('ES')
+    prices = {('ES', timestamps[2]): 101.}
+    assert [strategy.get_current_equity(timestamps[2], prices) - strategy.initial_cash for strategy in strategies] == [1., 50.]
+    with tempfile.TemporaryDirectory() as dirname:
+        strategies[1].checkpoint(dirname)
+        resumed = Strategy.resume(dirname)
+    assert not Contract.exists('ES') and resumed.registry is not strategies[1].registry
+    assert resumed.trade_history[0].contract is resumed.registry.get('ES') and resumed.account.registry is resumed.registry
+    assert resumed.get_current_equity(timestamps[2], prices) - resumed.initial_cash == 50.
+    assert list(resumed.trade_history.contract_ids(resumed.registry)) == [0]
+
+
+def test_baskets() -> None:
+    registry = ContractRegistry()
+    aapl, ibm = registry.create('AAPL'), registry.create('IBM')
+    spread = registry.create('SPREAD', components=[(aapl, 1.), (ibm, -0.5)])
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:05'))
+    component_prices = PriceStore(['IBM', 'AAPL'], timestamps, np.array([[100., 101., 103., 102., 104.], [50., 52., 51., 51., 53.]]))
+    baskets = BasketMatrix(registry)
+    prices = baskets.price_store(component_prices)
+    assert np.allclose(prices.symbol_prices('SPREAD'), [0., 1.5, -0.5, 0., 1.])
+    strategy = Strategy(registry=registry)
+    strategy.set_market_timestamps(timestamps)
+    no_order = cast(Order, None)
+    strategy.account.apply_trade(Trade(spread, no_order, timestamps[0], 10, 0.))
+    strategy.account.apply_trade(Trade(ibm, no_order, timestamps[0], 2, 100.))
+    assert strategy.get_component_positions() == {'AAPL': 10., 'IBM': -3.}
+    equity = [strategy.get_current_equity(timestamp, prices) for timestamp in timestamps]
+    positions = np.array([[0.] * 5, [2.] * 5, [10.] * 5])  # contracts x bars in registry id order
+    components = baskets.explode(positions)
+    assert np.array_equal(components[:, 0], [10., -3., 0.])
+    component_values = np.nansum(components * component_prices.align(registry.symbols).prices, axis=0)
+    assert np.allclose(equity, strategy.initial_cash - 200. + component_values)
+    pnl = baskets.basket_pnl(positions[baskets.basket_ids], prices.prices)
+    assert np.allclose(pnl.cumsum(axis=1)[0], 10 * prices.symbol_prices('SPREAD'))
+
+
+def _business_days(start: str, num_days: int) -> np.ndarray:
+    return np.busday_offset(np.datetime64(start, 'D'), np.arange(num_days), roll='forward')
+
+
+def _random_return_metrics(seed: int, num_days: int, mean: float, start: str) -> tuple[np.ndarray, np.ndarray, Metrics]:
+    '''Normally distributed daily returns on business days from start, their dates and compute_return_metrics for them'''
+    rets = np.random.default_rng(seed).normal(mean, 0.01, num_days)
+    dates = _business_days(start, num_days)
+    return rets, dates, compute_return_metrics(dates, rets, Calendar('NYSE'))
+
+
+def test_rolling_metrics() -> None:
+    rets, dates, metrics = _random_return_metrics(1, 300, 0.001, '2020-01-01')
+    expanding = OnlineMetrics()
+    windowed = OnlineMetrics(window=50)
+    for ret in rets:
+        expanding.update(ret)
+        windowed.update(ret)
+    for name, value in [('sharpe', metrics.sharpe), ('sortino', metrics.sortino), ('max_drawdown', metrics.mdd_pct)]:
+        assert math.isclose(getattr(expanding, name), value, rel_tol=1e-9), name
+    rolling = rolling_return_metrics(rets, window=len(rets))
+    assert math.isclose(rolling['sharpe'][-1], metrics.sharpe, rel_tol=1e-9)
+    assert math.isclose(rolling['max_drawdown'][-1], metrics.mdd_pct, rel_tol=1e-9)
+    rolling = rolling_return_metrics(rets, window=50, chunk_size=100)
+    for name in ['mean', 'std', 'sharpe', 'sortino', 'drawdown', 'max_drawdown']:
+        assert math.isclose(getattr(windowed, name), rolling[name][-1], rel_tol=1e-9), name
+    # feeding equity instead of returns gives the same statistics
+    from_equity = OnlineMetrics(window=50)
+    for equity in np.concatenate([[1e6], 1e6 * np.cumprod(1 + rets)]):
+        from_equity.update_equity(equity)
+    assert math.isclose(from_equity.sharpe, windowed.sharpe, rel_tol=1e-6)
+
+
+def test_return_metrics_batch() -> None:
+    rets = np.random.default_rng(3).normal(0.0003, 0.01, (40, 1100))
+    rets[0] = 0.  # no drawdown, so mar and calmar are NaN
+    dates = _business_days('2016-01-01', rets.shape[1])
+    calendar = Calendar('NYSE')
+    df = compute_return_metrics_batch(dates, rets, calendar)
+    assert len(df) == len(rets)
+    for i in range(len(rets)):
+        metrics = compute_return_metrics(dates, rets[i], calendar)
+        for name in ['gmean', 'amean', 'std', 'sharpe', 'sortino', 'k_ratio', 'calmar', 'mar', 'up_days', 'down_days', 'up_pct',
+                     'mdd_pct', 'mdd_pct_3yr']:
+            assert math.isclose(df[name].iloc[i], getattr(metrics, name), rel_tol=1e-9) or (
+                math.isnan(df[name].iloc[i]) and math.isnan(getattr(metrics, name))), (i, name)
+        assert (df.mdd_start.iloc[i], df.mdd_end.iloc[i]) == metrics.mdd_dates
+        assert (df.mdd_start_3yr.iloc[i], df.mdd_end_3yr.iloc[i]) == metrics.mdd_dates_3yr
+        for year, ret in zip(metrics.annual_rets.year, metrics.annual_rets.ret):
+            assert math.isclose(df[year].iloc[i], ret, rel_tol=1e-9), (i, year)
+
+
+def test_bootstrap() -> None:
+    rets, _, metrics = _random_return_metrics(2, 400, 0.0005, '2020-01-01')
+    df = bootstrap_return_metrics(rets, num_resamples=2000, block_size=5, seed=3, chunk_size=500, max_workers=2)
+    for name in ['gmean', 'sharpe', 'sortino', 'mdd_pct', 'calmar']:
+        assert math.isclose(df.value[name], getattr(metrics, name), rel_tol=1e-9), name
+        assert df.lower[name] < df.value[name] < df.upper[name], name
+    # the sharpe of iid returns has a standard error of about sqrt(periods per year / number of returns)
+    assert math.isclose(df['std']['sharpe'], math.sqrt(252 / len(rets)), rel_tol=0.2)
+
+
+def test_plot_metrics() -> None:
+    rets, dates, metrics = _random_return_metrics(4, 3000, 0.0003, '2005-01-01')
+    fig = plot_metrics(metrics, max_points=200)
+    equity_trc, dd_trc = fig.data[0], fig.data[1]
+    assert equity_trc.type == 'scattergl' and len(equity_trc.x) <= 202
+    # extremes survive downsampling
+    assert math.isclose(max(dd_trc.y), metrics.mdd_pct)
+    assert math.isclose(min(equity_trc.y), metrics.equity.min() * 1e6)
+    boxes = [trc for trc in fig.data if trc.type == 'box']
+    assert len(boxes) == len(np.unique(dates.astype('M8[Y]'))) + 1
+    assert all(box.x is None for box in boxes)
+    assert math.isclose(boxes[-1].median[0], np.median(rets))
+
+
+def test_drawdown_episodes() -> None:
+    rets, dates, metrics = _random_return_metrics(6, 1500, 0.0003, '2010-01-01')
+    drawdowns = metrics.drawdowns
+    assert drawdowns is not None and len(drawdowns) > 1
+    assert math.isclose(drawdowns.depth.max(), metrics.mdd_pct)
+    # episodes tile the curve: each one recovers where the next starts and only the last may be unrecovered
+    assert np.all(drawdowns.recovery_idx.values[:-1] <= drawdowns.peak_idx.values[1:])
+    assert np.all(drawdowns.recovery_idx.values[:-1] >= 0)
+    assert np.all((drawdowns.peak_idx < drawdowns.trough_idx) & (drawdowns.trough_date <= drawdowns.recovery_date.fillna(dates[-1])))
+    equity = metrics.equity
+    for row in drawdowns.itertuples():
+        end = len(equity) if row.recovery_idx == -1 else row.recovery_idx
+        assert np.all(equity[row.peak_idx + 1:end] < equity[row.peak_idx])
+        assert math.isclose(1 - equity[row.peak_idx + 1:end].min() / equity[row.peak_idx], row.depth)
+
+
+def test_intraday_metrics() -> None:
+    # daily bars at a 1 day frequency give the same metrics as compute_return_metrics
+    calendar = Calendar('NYSE')
+    dates = cast(np.ndarray, calendar.get_trading_days(np.datetime64('2024-01-01'), np.datetime64('2024-12-31')))
+    rets = np.random.default_rng(7).normal(0.0005, 0.01, len(dates))
+    daily = compute_return_metrics(dates, rets, calendar)
+    intraday = compute_intraday_metrics(dates.astype('M8[m]') + np.timedelta64(16 * 60, 'm'), rets, calendar, '1d')
+    for name in ['amean', 'std', 'gmean', 'sharpe', 'sortino', 'k_ratio', 'mdd_pct', 'mar', 'calmar', 'up_days', 'down_days']:
+        assert math.isclose(getattr(intraday, name), getattr(daily, name), rel_tol=1e-9), name
+    assert intraday.mdd_dates[1].astype('M8[D]') == daily.mdd_dates[1]
+    assert intraday.session_rets is not None and np.allclose(intraday.session_rets.ret, rets)
+
+    timestamps, prices = _simple_prices()
+    strategy = _make_strategy(timestamps, prices, 10.15, exit_timestamps=timestamps[3:])
+    strategy.calendar = calendar
+    strategy.run()
+    close_prices = {('AAPL', timestamp): price for timestamp, price in prices.items()}
+    metrics = strategy.compute_metrics(close_prices, freq='1m')
+    equity = strategy.get_equity_curve(close_prices).equity.values
+    equity = np.concatenate([[strategy.initial_cash], equity])
+    assert np.allclose(metrics.returns, equity[1:] / equity[:-1] - 1)
+    assert math.isclose(metrics.amean, metrics.returns.mean() * 252 * 6)
+    assert metrics.dates[0] == timestamps[0] - np.timedelta64(1, 'm')
+    _, fig = strategy.evaluate(close_prices, show=False, freq='1m', max_points=4)
+    assert fig.data[0].type == 'scattergl' and len(fig.data[0].x) <= 6
+
+
+def test_price_store() -> None:
+    timestamps, prices = _simple_prices()
+    strategy = _make_strategy(timestamps, prices, 10.15, exit_timestamps=timestamps[3:])
+    strategy.run()
+    price_dict = {('AAPL', timestamp): price for timestamp, price in prices.items()}
+    price_store = PriceStore.from_dict(price_dict)
+    assert math.isclose(strategy.get_current_equity(timestamps[-1], price_dict), 
+                        strategy.get_current_equity(timestamps[-1], price_store))
+    pnl_dict = get_pnl_df(get_pnl(roundtrip_trades(strategy.trade_history), timestamps, price_dict))
+    pnl_store = get_pnl_df(get_pnl(roundtrip_trades(strategy.trade_history), timestamps, price_store))
+    pd.testing.assert_frame_equal(pnl_dict, pnl_store)
+    # a price missing from the dict is a NaN cell in the store, and must look missing from both
+    sparse_dict = dict(price_dict)
+    del sparse_dict[('AAPL', timestamps[-2])]
+    sparse_dict[('IBM', timestamps[-2])] = 100.
+    sparse_store = PriceStore.from_dict(sparse_dict)
+    assert len(sparse_store) == len(sparse_dict) and set(sparse_store.keys()) == set(sparse_dict.keys())
+    assert sparse_store.get(('AAPL', timestamps[-2])) is None and ('AAPL', timestamps[-2]) not in sparse_store
+    pnl_dict = get_pnl_df(get_pnl(roundtrip_trades(strategy.trade_history), timestamps, sparse_dict))
+    pnl_store = get_pnl_df(get_pnl(roundtrip_trades(strategy.trade_history), timestamps, sparse_store))
+    pd.testing.assert_frame_equal(pnl_dict, pnl_store)
+
+
+def test_skip_idle() -> None:
+    timestamps, prices = _sine_prices()
+    trade_histories = []
+    for skip_idle in [False, True]:
+        strategy = _make_strategy(timestamps, prices, 10.9)
+        strategy.run(skip_idle=skip_idle)
+        trade_histories.append([(trade.timestamp, trade.qty, trade.price) for trade in strategy.trade_history])
+    assert len(trade_histories[0]) > 2
+    assert trade_histories[0] == trade_histories[1]
+
+
+def test_order_book() -> None:
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:10'))
+    strategy = Strategy()
+    strategy.log_orders = False
+    strategy.set_market_timestamps(timestamps)
+    contract = Contract.get_or_create('AAPL')
+    fok = Order(order_id='fok', contract=contract, timestamp=timestamps[0], qty=10, time_in_force=TimeInForce.FOK)
+    gtc = Order(order_id='gtc', contract=contract, timestamp=timestamps[0], qty=-10, time_in_force=TimeInForce.GTC)
+    strategy.add_rule('place', lambda strategy, timestamp: [fok, gtc])
+    strategy.enable_rule('place', timestamps[:1])
+    book = strategy.order_book
+    strategy.run()
+    assert fok.status == OrderStatus.CANCELLED and gtc.status == OrderStatus.OPEN
+    assert book.cancelled_orders == [fok] and book.orders_for('AAPL') == [gtc] and book.has_live('AAPL')
+    # the book is keyed by order ids, which change when it is unpickled
+    book_copy, gtc_copy = pickle.loads(pickle.dumps((book, gtc)))
+    book_copy.request_modification(gtc_copy, ModRequest(ModificationType.CANCEL, timestamps[-1]))
+    assert book_copy.next_activation() == timestamps[-1] + strategy.trade_lag
+    book_copy.apply_mod_requests(timestamps[-1] + np.timedelta64(1, 'm'))
+    book_copy.update_order_lists()
+    assert gtc_copy.status == OrderStatus.CANCELLED and not book_copy.has_live() and book_copy.cancelled_orders[-1] is gtc_copy
+    strategy.request_modification(gtc, ModRequest(ModificationType.CANCEL, timestamps[-1]))
+    strategy.set_market_timestamps(timestamps + np.timedelta64(10, 'm'))
+    strategy.run()
+    assert gtc.status == OrderStatus.CANCELLED and not book.has_live()
+    assert book.cancelled_orders == [fok, gtc]
+    # live_orders is a snapshot, orders added through it go to the book
+    gtc2 = Order(order_id='gtc2', contract=contract, timestamp=timestamps[-1], qty=10, time_in_force=TimeInForce.GTC)
+    strategy.live_orders += (gtc2,)
+    assert strategy.live_orders == (gtc2,) and gtc2 in book
+    try:
+        strategy.live_orders = ()
+        assert False, 'removing live orders by assignment should fail'
+    except PQException:
+        pass
+    strategy.cancelled_orders = []
+    assert book.cancelled_orders == [] and strategy.filled_orders is book.filled_orders
+
+
+def test_run_stream() -> None:
+    timestamps, prices = _sine_prices()
+    price_dict = {('AAPL', timestamp): price for timestamp, price in prices.items()}
+    trade_histories, daily_pnls, curves = [], [], []
+    # run, run_stream with market timestamps and run_stream without them
+    for stream, market_timestamps in [(False, True), (True, True), (True, False)]:
+        strategy = _make_strategy(timestamps, prices, 10.9, market_timestamps=market_timestamps)
+        if stream:
+            strategy.run_stream((timestamp, price) for timestamp, price in prices.items())
+            assert strategy.current_bar == prices[timestamps[-1]]
+        else:
+            strategy.run()
+        np.testing.assert_array_equal(strategy.bar_timestamps(), timestamps)
+        trade_histories.append([(trade.timestamp, trade.qty, trade.price) for trade in strategy.trade_history])
+        daily_pnls.append(strategy.get_daily_pnl(price_dict, pnl_time=9 * 60 + 59))
+        curves.append(strategy.get_equity_curve(price_dict))
+    assert len(trade_histories[0]) > 2
+    assert len(daily_pnls[0]) == 1 and daily_pnls[0].pnl.iloc[0] != 0
+    assert len(curves[0]) == len(timestamps)
+    for trade_history, daily_pnl, curve in zip(trade_histories[1:], daily_pnls[1:], curves[1:]):
+        assert trade_history == trade_histories[0]
+        pd.testing.assert_frame_equal(daily_pnl, daily_pnls[0])
+        pd.testing.assert_frame_equal(curve, curves[0])
+
+
+_CRASH_AT: np.datetime64 | None = None
+
+
+class CrashingMarketSim(MarketSim):
+    def __call__(self, strategy: Strategy, timestamp: np.datetime64, orders: list[Order]) -> list[Trade]:
+        if timestamp == _CRASH_AT: raise RuntimeError('crash')
+        return super().__call__(strategy, timestamp, orders)
+
+
+def test_checkpoint() -> None:
+    global _CRASH_AT
+    timestamps, prices = _sine_prices()
+    strategies = [_make_strategy(timestamps, prices, 10.9, CrashingMarketSim) for _ in range(2)]
+    strategies[0].run()
+    with tempfile.TemporaryDirectory() as dirname:
+        _CRASH_AT = timestamps[45]
+        try:
+            strategies[1].run(checkpoint_dir=dirname, checkpoint_interval=10)
+        except RuntimeError:
+            pass
+        _CRASH_AT = None
+        resumed = Strategy.resume(dirname)
+        assert resumed.next_bar_idx == 40
+        resumed.run(checkpoint_dir=dirname, checkpoint_interval=10)
+        resumed = Strategy.resume(dirname)
+    expected = [(trade.timestamp, trade.qty, trade.price, trade.order.order_id) for trade in strategies[0].trade_history]
+    assert len(expected) > 2
+    assert [(trade.timestamp, trade.qty, trade.price, trade.order.order_id) for trade in resumed.trade_history] == expected
+    assert math.isclose(resumed.account.cash, strategies[0].account.cash)
+    assert resumed.roundtrips.num_roundtrips() == strategies[0].roundtrips.num_roundtrips() > 0
+    pd.testing.assert_frame_equal(resumed.df_roundtrip_trades(), strategies[0].df_roundtrip_trades())
+
+
+@dataclass
+class GTCEntryRule:
+    qty: int = 10
+
+    def __call__(self, strategy: Strategy, timestamp: np.datetime64) -> list[Order]:
+        return [Order(order_id='gtc', contract=Contract.get_or_create('AAPL'), timestamp=timestamp, qty=self.qty,
+                      time_in_force=TimeInForce.GTC)]
+
+
+class PartialFillMarketSim(CrashingMarketSim):
+    '''Fills at most 2 per bar'''
+    def __call__(self, strategy: Strategy, timestamp: np.datetime64, orders: list[Order]) -> list[Trade]:
+        if timestamp == _CRASH_AT: raise RuntimeError('crash')
+        trades: list[Trade] = []
+        for order in orders:
+            qty = min(order.remaining_qty, 2)
+            trades.append(Trade(order.contract, order, timestamp, qty, self.prices[timestamp]))
+            order.fill(qty)
+        return trades
+
+
+def test_checkpoint_partial_fill() -> None:
+    global _CRASH_AT
+    timestamps = np.arange(np.datetime64('2024-01-02 09:00'), np.datetime64('2024-01-02 09:10'))
+    prices = {timestamp: 10. + i for i, timestamp in enumerate(timestamps)}
+    strategies = []
+    for _ in range(2):
+        strategy = Strategy()
+        strategy.log_orders = False
+        strategy.set_market_timestamps(timestamps)
+        strategy.add_rule('entry', GTCEntryRule())
+        strategy.enable_rule('entry', timestamps[:1])
+        strategy.add_market_sim(PartialFillMarketSim(prices))
+        strategies.append(strategy)
+    strategies[0].run()
+    with tempfile.TemporaryDirectory() as dirname:
+        # the order is partly filled when the checkpoint is saved and filled after resuming
+        _CRASH_AT = timestamps[5]
+        try:
+            strategies[1].run(checkpoint_dir=dirname, checkpoint_interval=2)
+        except RuntimeError:
+            pass
+        _CRASH_AT = None
+        resumed = Strategy.resume(dirname)
+        assert resumed.next_bar_idx == 4 and len(resumed.trade_history) == 3
+        resumed.run(checkpoint_dir=dirname, checkpoint_interval=2)
+        reloaded = Strategy.resume(dirname)
+    for strategy in [strategies[0], resumed, reloaded]:
+        trade_history = strategy.trade_history
+        assert len(trade_history) == 5 and len(trade_history.orders) == 1
+        order = trade_history.orders[0]
+        assert order is not None and order.status == OrderStatus.FILLED and order.remaining_qty == 0
+        assert all(trade.order is order for trade in trade_history)
+        assert strategy.order_book.filled_orders == [order] and strategy.order_book.filled_orders[0] is order
+
+
+def _sweep_factory(params: dict, prices: PriceStore) -> Strategy:
+    timestamps = prices.timestamps
+    close = prices.symbol_prices('AAPL')
+    strategy = _make_strategy(timestamps, dict(zip(timestamps, close)), params['threshold'])
+    strategy.log_orders = False
+    strategy.log_trades = False
+    return strategy
+
+
+def test_sweep() -> None:
+    # 5 days of 9:30 - 15:59 bars so the 15:59 daily pnl time is inside the data
+    minutes = np.arange(9 * 60 + 30, 16 * 60).astype('m8[m]')
+    timestamps = (_business_days('2024-01-02', 5).astype('M8[m]')[:, None] + minutes).ravel()
+    close = 10. + np.sin(np.arange(len(timestamps)) / 5.) + np.arange(len(timestamps)) / 1000.
+    prices = PriceStore(['AAPL'], timestamps, close.reshape(1, -1))
+    param_grid = {'threshold': [10.5, 10.9]}
+    serial_df, serial_trades = run_sweep(_sweep_factory, param_grid, prices, include_trades=True, max_workers=1)
+    parallel_df, parallel_trades = run_sweep(_sweep_factory, param_grid, prices, include_trades=True, max_workers=2)
+    assert list(serial_df.threshold) == [10.5, 10.9]
+    assert np.all(serial_df[['amean', 'std']].values != 0) and not np.any(np.isnan(serial_df[['amean', 'std']].values))
+    assert serial_df.amean[0] != serial_df.amean[1]
+    pd.testing.assert_frame_equal(serial_df, parallel_df)
+    for run_id in [0, 1]:
+        assert len(serial_trades[run_id]) > 0
+        pd.testing.assert_frame_equal(serial_trades[run_id], parallel_trades[run_id])
+
+
 if __name__ == '__main__':
     test_simple_strat()
     test_stop_strat()
+    test_profiling()
+    test_roundtrip_trades()
+    test_fifo_fractional()
+    test_direct_trade_append()
+    test_pnl_arrays()
+    test_equity_curve()
+    test_account_equity()
+    test_contract_registry()
+    test_baskets()
+    test_rolling_metrics()
+    test_return_metrics_batch()
+    test_bootstrap()
+    test_plot_metrics()
+    test_drawdown_episodes()
+    test_intraday_metrics()
+    test_price_store()
+    test_skip_idle()
+    test_order_book()
+    test_run_stream()
+    test_checkpoint()
+    test_checkpoint_partial_fill()
+    test_sweep()
 # $$_end_code
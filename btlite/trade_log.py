@@ -0,0 +1,235 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+from typing import Any, Iterator, overload
+from numpy.typing import DTypeLike
+from btlite.bt_types import Contract, Order, Trade
+from btlite.bt_utils import assert_
+
+_COLUMNS: dict[str, DTypeLike] = {'symbol_id': np.int32,
+            'timestamp': 'M8[m]',
+            'qty': np.float64,
+            'price': np.float64,
+            'fee': np.float64,
+            'commission': np.float64,
+            'order_idx': np.int64}
+
+
+class TradeLog:
+    '''
+    Columnar, growable log of trades.  Indexing or iterating returns Trade objects created on the fly from the columns.
+    Quantities are stored as floats and returned as ints if every trade in the log had an integer quantity.
+    Timestamps use the finest resolution of the trades appended so far.
+
+    >>> Contract.clear_cache()
+    >>> contract = Contract.create('IBM')
+    >>> order = Order(order_id='1', contract=contract, timestamp=np.datetime64('2024-01-02 09:30'), qty=20)
+    >>> log = TradeLog()
+    >>> log.append(Trade(contract, order, np.datetime64('2024-01-02 09:31'), 10, 100.))
+    >>> log.append(Trade(contract, order, np.datetime64('2024-01-02 09:32'), 10, 101., properties=SimpleNamespace(x=1)))
+    >>> assert len(log) == 2 and np.array_equal(log.price, [100., 101.]) and log[1].order is order and log[1].properties.x == 1
+    >>> df = log.to_df()
+    >>> assert list(df.symbol) == ['IBM', 'IBM'] and list(df.qty) == [10., 10.] and type(log[0].qty) is int
+    >>> log.append(Trade(contract, order, np.datetime64('2024-01-02 09:33:30'), 0.5, 101.))
+    >>> assert log[2].timestamp == np.datetime64('2024-01-02 09:33:30') and log[0].qty == 10. and log[2].qty == 0.5
+    >>> import pickle
+    >>> log = pickle.loads(pickle.dumps(log))
+    >>> log.append(Trade(contract, log[0].order, np.datetime64('2024-01-02 09:34'), 1, 101.))
+    >>> assert len(log.orders) == 1
+    '''
+    def __init__(self, capacity: int = 1024) -> None:
+        self.contracts: list[Contract] = []
+        self.orders: list[Order | None] = []
+        self.properties: dict[int, SimpleNamespace] = {}  # trade index -> properties, only for trades that have them
+        self._symbol_ids: dict[str, int] = {}
+        self._order_idx: dict[int, int] = {}  # id(order) -> index in orders
+        self._columns: dict[str, np.ndarray] = {name: np.empty(capacity, dtype=dtype) for name, dtype in _COLUMNS.items()}
+        self._size = 0
+        self._int_qty = True  # whether all quantities so far were ints
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        # ids of the orders change when they are unpickled
+        self._order_idx = {id(order): i for i, order in enumerate(self.orders)}
+
+    def _grow(self) -> None:
+        capacity = max(2 * len(self._columns['qty']), 1024)
+        for name, column in self._columns.items():
+            new_column = np.empty(capacity, dtype=column.dtype)
+            new_column[:self._size] = column[:self._size]
+            self._columns[name] = new_column
+
+    def _get_symbol_id(self, contract: Contract) -> int:
+        symbol_id = self._symbol_ids.get(contract.symbol)
+        if symbol_id is None:
+            symbol_id = len(self.contracts)
+            self._symbol_ids[contract.symbol] = symbol_id
+            self.contracts.append(contract)
+        return symbol_id
+
+    def _get_order_idx(self, order: Order | None) -> int:
+        key = id(order)
+        order_idx = self._order_idx.get(key)
+        if order_idx is None:
+            order_idx = len(self.orders)
+            self._order_idx[key] = order_idx
+            self.orders.append(order)
+        return order_idx
+
+    def _set_timestamp_dtype(self, dtype: np.dtype) -> None:
+        '''Use the resolution of the first trades, and switch to a finer one if later trades need it'''
+        column = self._columns['timestamp']
+        if self._size: dtype = np.promote_types(column.dtype, dtype)
+        if dtype != column.dtype: self._columns['timestamp'] = column.astype(dtype)
+
+    def order_index(self, order: Order) -> int:
+        '''Index of order in orders, or -1 if none of the trades in the log are for it'''
+        return self._order_idx.get(id(order), -1)
+
+    def append(self, trade: Trade) -> None:
+        i = self._size
+        if isinstance(trade.timestamp, np.datetime64) and trade.timestamp.dtype != self._columns['timestamp'].dtype:
+            self._set_timestamp_dtype(trade.timestamp.dtype)
+        if self._int_qty and not isinstance(trade.qty, (int, np.integer)): self._int_qty = False
+        if i == len(self._columns['qty']): self._grow()
+        columns = self._columns
+        columns['symbol_id'][i] = self._get_symbol_id(trade.contract)
+        columns['timestamp'][i] = trade.timestamp
+        columns['qty'][i] = trade.qty
+        columns['price'][i] = trade.price
+        columns['fee'][i] = trade.fee
+        columns['commission'][i] = trade.commission
+        columns['order_idx'][i] = self._get_order_idx(trade.order)
+        if trade._properties is not None: self.properties[i] = trade._properties
+        self._size += 1
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _trade(self, i: int) -> Trade:
+        columns = self._columns
+        trade = Trade.__new__(Trade)
+        trade.contract = self.contracts[columns['symbol_id'][i]]
+        trade.order = self.orders[columns['order_idx'][i]]  # type: ignore
+        trade.timestamp = columns['timestamp'][i]
+        qty = float(columns['qty'][i])
+        trade.qty = int(qty) if self._int_qty else qty
+        trade.price = columns['price'][i]
+        trade.fee = columns['fee'][i]
+        trade.commission = columns['commission'][i]
+        trade._properties = self.properties.get(i)
+        return trade
+
+    @overload
+    def __getitem__(self, i: int) -> Trade: ...
+
+    @overload
+    def __getitem__(self, i: slice) -> list[Trade]: ...
+
+    def __getitem__(self, i: int | slice) -> Trade | list[Trade]:
+        if isinstance(i, slice): return [self._trade(j) for j in range(*i.indices(self._size))]
+        if i < 0: i += self._size
+        if i < 0 or i >= self._size: raise IndexError(i)
+        return self._trade(i)
+
+    def __iter__(self) -> Iterator[Trade]:
+        for i in range(self._size):
+            yield self._trade(i)
+
+    @property
+    def symbols(self) -> list[str]:
+        return [contract.symbol for contract in self.contracts]
+
+    @property
+    def symbol_id(self) -> np.ndarray:
+        return self._columns['symbol_id'][:self._size]
+
+    @property
+    def timestamp(self) -> np.ndarray:
+        return self._columns['timestamp'][:self._size]
+
+    @property
+    def qty(self) -> np.ndarray:
+        return self._columns['qty'][:self._size]
+
+    @property
+    def price(self) -> np.ndarray:
+        return self._columns['price'][:self._size]
+
+    @property
+    def fee(self) -> np.ndarray:
+        return self._columns['fee'][:self._size]
+
+    @property
+    def commission(self) -> np.ndarray:
+        return self._columns['commission'][:self._size]
+
+    @property
+    def order_idx(self) -> np.ndarray:
+        return self._columns['order_idx'][:self._size]
+
+    def contract_ids(self, registry: Any) -> np.ndarray:
+        '''Id of each trade's contract in a ContractRegistry, -1 if the contract is not in it'''
+        return registry.ids(self.symbols)[self.symbol_id]
+
+    def multiplier(self) -> np.ndarray:
+        '''Contract multiplier for each trade'''
+        multipliers = np.array([contract.multiplier for contract in self.contracts], dtype=np.float64)
+        return multipliers[self.symbol_id]
+
+    def reason_codes(self) -> np.ndarray:
+        '''Reason code of the order for each trade'''
+        reason_codes = np.array([order.reason_code if order is not None else '' for order in self.orders], dtype=object)
+        return reason_codes[self.order_idx]
+
+    def to_df(self) -> pd.DataFrame:
+        '''
+        Returns a dataframe that shares memory with the log, so it is only valid until the next append
+        '''
+        data: dict[str, Any] = {'symbol': pd.Categorical.from_codes(self.symbol_id, categories=self.symbols)}
+        for name in _COLUMNS.keys():
+            if name == 'symbol_id': continue
+            data[name] = self._columns[name][:self._size]
+        return pd.DataFrame(data, copy=False)
+
+    def get_chunk(self, start: int, start_order: int) -> dict[str, Any]:
+        '''
+        Trades from start onwards, along with orders from start_order onwards, for saving incrementally.
+        See append_chunk
+        '''
+        assert_(start <= self._size and start_order <= len(self.orders))
+        properties: dict[int, SimpleNamespace] = {}
+        for i in reversed(self.properties):  # keys are in increasing order
+            if i < start: break
+            properties[i] = self.properties[i]
+        return {'columns': {name: column[start:self._size].copy() for name, column in self._columns.items()},
+                'contracts': self.contracts[:],
+                'orders': self.orders[start_order:],
+                'properties': properties,
+                'int_qty': self._int_qty}
+
+    def append_chunk(self, chunk: dict[str, Any]) -> None:
+        '''Append a chunk created by get_chunk on a log that contained the same trades as this one up to start'''
+        columns = chunk['columns']
+        num_trades = len(columns['qty'])
+        while self._size + num_trades > len(self._columns['qty']): self._grow()
+        self._set_timestamp_dtype(columns['timestamp'].dtype)
+        self._int_qty = self._int_qty and chunk['int_qty']
+        for name, column in columns.items():
+            self._columns[name][self._size:self._size + num_trades] = column
+        for contract in chunk['contracts'][len(self.contracts):]:
+            self._get_symbol_id(contract)
+        for order in chunk['orders']:
+            self._get_order_idx(order)
+        self.properties.update(chunk['properties'])
+        self._size += num_trades
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code